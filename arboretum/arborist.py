@@ -9,14 +9,97 @@ formats ("trees types").
 """
 
 import os
+import tempfile
+import weakref
 from dataclasses import dataclass, field
 from threading import Lock
-from typing import Dict, Union
+from collections import OrderedDict
+from typing import IO, TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Set, Union
 import shutil
 
-from forest import PsmTree, TreeType, psm_tree_constructor
-from boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds
-from psm import PSM
+from arboretum.forest import PsmTree, TreeType, psm_tree_class, psm_tree_constructor
+from arboretum.boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds, get_mz_bounds_array, \
+    get_rt_bounds_array, get_ook0_bounds_array
+from arboretum.coalesce import Coalescing
+from arboretum.ingest import ingest
+from arboretum.memory import MemoryUsage
+from arboretum.neutralmass import NeutralMassIndex, mz_of, neutral_mass
+from arboretum.occupancy import Prefilter
+from arboretum.replay import ADD, REMOVE, REMOVE_MANY, UPDATE, Recorder
+from arboretum.replication import ReplicationLog
+from arboretum.tracing import Tracer, traced
+from arboretum.psm import PSM
+
+if TYPE_CHECKING:
+    from arboretum.blockfile import BlockFile
+    from arboretum.calibration import Correction
+    from arboretum.forest.psmmultiindextree import QueryPlan
+
+TEXT_FILE_EXTENSION = '.txt'
+BLOCK_FILE_EXTENSION = '.blk'
+PICKLE_FILE_EXTENSION = '.pkl'
+
+
+def _file_format(file_name: str) -> dict:
+    """
+    the PsmTree.save / load format arguments for a tree file, by its extension
+    """
+    return {'as_pickle': file_name.endswith(PICKLE_FILE_EXTENSION), 'as_blocks': file_name.endswith(BLOCK_FILE_EXTENSION)}
+
+
+def tree_files(directory) -> Dict[int, str]:
+    """
+    the tree files of a saved arborist: charge -> path of [charge].txt, .blk or .pkl
+    """
+    files = {}
+    for file in os.listdir(directory):
+        charge = int(os.path.splitext(file)[0])  # /path/to/file.pkl -> file
+        files[charge] = os.path.join(directory, file)
+    return files
+
+
+@dataclass(eq=False)
+class ArboristSnapshot:
+    """
+    A read-only, point-in-time view of an Arborist's trees, returned by PSMArborist.snapshot().
+    The Arborist copies a tree before changing it while a snapshot still holds it (copy-on-write),
+    so searching or saving a snapshot always sees the trees exactly as they were at that version,
+    no matter how many PSM's are added or removed in the meantime.
+    """
+    version: int
+    tree_type: Union[TreeType, str]
+    trees: Dict[int, PsmTree]
+
+    def save(self, directory, compressed: bool = False):
+        """
+        Create a directory folder (name passed in) and save all trees of the snapshot within.
+        compressed saves each tree as a block file ([charge].blk) instead of text ([charge].txt)
+        """
+        # Check if directory exists & remove it if it does
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+
+        # make new directory
+        print("Directory '% s' created" % directory)
+        os.makedirs(directory)
+
+        for charge, tree in self.trees.items():
+            file_name = f"{charge}{BLOCK_FILE_EXTENSION if compressed else TEXT_FILE_EXTENSION}"
+            tree.save(os.path.join(directory, file_name),
+                      as_pickle=False, as_blocks=compressed)  # save trees as [charge].txt or [charge].blk (i.e. "1.txt")
+
+    def search(self, charge: int, mz: float, rt: float, ook0: float, ppm: float, rt_offset: float,
+               ook0_tolerance: float) -> List[PSM]:
+        if charge not in self.trees:
+            return []
+
+        mz_bounds = get_mz_bounds(mz, ppm)
+        rt_bounds = get_rt_bounds(rt, rt_offset)
+        ook0_bounds = get_ook0_bounds(ook0, ook0_tolerance)
+        return self.trees[charge]._search(mz_bounds, rt_bounds, ook0_bounds)
+
+    def __len__(self):
+        return sum([len(self.trees[charge]) for charge in self.trees])
 
 
 @dataclass
@@ -27,71 +110,615 @@ class PSMArborist:
     Each Tree will have 1 consistent charge; therefore, expect 1 - 5 trees per TreeType.
     New Trees will be created for each new charge encountered
     The chosen TreeType, declared here, can be specific or "TreeType" to allow all options and specified elsewhere.
+    After a lazy load, trees stay on disk until a charge is first used, and max_loaded_psms (if set) bounds
+    how many psm's are kept in memory by evicting the least recently used trees back to disk.
     """
     tree_type: Union[TreeType, str] = TreeType.SORTED_LIST
     trees: Dict[int, PsmTree] = field(default_factory=dict)
+    version: int = 0  # incremented on every add / remove / load
+    max_loaded_psms: Optional[int] = None
+    coalescing: Optional[Coalescing] = None  # when set, repeated identifications are folded into one psm
+    prefilter: Optional[Prefilter] = None  # when set, searches are first checked against an occupancy grid
+    neutral_mass_index: Optional[NeutralMassIndex] = None  # when set, search_mass scans one index over every charge
+    tree_options: Dict[str, Any] = field(default_factory=dict)  # passed to psm_tree_constructor, e.g. {'ppm': 10}
+    tracer: Optional[Tracer] = field(default=None, repr=False, compare=False)  # see tracing.py
+    recorder: Optional[Recorder] = field(default=None, repr=False, compare=False)  # see replay.py
+    replication: Optional[ReplicationLog] = field(default=None, repr=False, compare=False)  # see replication.py
 
-    _lock: Lock = Lock()
+    _lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+    _snapshots: weakref.WeakSet = field(default_factory=weakref.WeakSet, repr=False, compare=False)
+    _directory: Optional[str] = field(default=None, repr=False, compare=False)  # backing store of a lazy load
+    _files: Dict[int, str] = field(default_factory=dict, repr=False, compare=False)  # charge -> backing file
+    _unloaded: Dict[int, str] = field(default_factory=dict, repr=False, compare=False)  # charge -> file
+    _block_files: Dict[int, 'BlockFile'] = field(default_factory=dict, repr=False, compare=False)
+    _dirty: Set[int] = field(default_factory=set, repr=False, compare=False)
+    _last_used: OrderedDict = field(default_factory=OrderedDict, repr=False, compare=False)
+    _loaded: int = field(default=0, repr=False, compare=False)  # psm's in self.trees, kept up to date for _evict
+    _spill: Optional[str] = field(default=None, repr=False, compare=False)  # private directory evicted trees go to
 
-    def save(self, directory):
+    def snapshot(self) -> ArboristSnapshot:
         """
-        Create a directory folder (name passed in) during runtime and save all trees within
+        Returns a consistent, point-in-time view of every tree. Taking a snapshot is cheap: trees are shared with
+        the snapshot and only copied when the Arborist next changes them while the snapshot is still alive.
+        Trees that are still on disk after a lazy load are read into the snapshot (not into the Arborist).
         """
-        # Check if directory exists & remove it if it does
-        if os.path.exists(directory):
-            shutil.rmtree(directory)
+        with self._lock:
+            trees = dict(self.trees)
+            for charge, file_name in self._unloaded.items():
+                trees[charge] = self._read_tree(file_name)
+            snapshot = ArboristSnapshot(version=self.version, tree_type=self.tree_type, trees=trees)
+            self._snapshots.add(snapshot)
+        return snapshot
 
-        # make new directory
-        print("Directory '% s' created" % directory)
-        os.makedirs(directory)
+    def _read_tree(self, file_name: str) -> PsmTree:
+        tree = psm_tree_constructor(self.tree_type, **self.tree_options)
+        tree.load(file_name, **_file_format(file_name))
+        return tree
 
-        self._lock.acquire()
-        for charge, tree in self.trees.items():
-            file_name = f"{charge}.txt"
-            tree.save(os.path.join(directory, file_name),
-                      as_pickle=False)  # save trees as [charge].pkl (i.e. "1.pkl", "2.pkl", etc)
-        self._lock.release()
+    def _tree(self, charge: int) -> Optional[PsmTree]:
+        """
+        Returns the tree for charge, reading it from disk first if it has not been loaded yet.
+        Returns None if there is no tree for charge. Must be called with the lock held.
+        """
+        if charge in self._unloaded:
+            file_name = self._files[charge] = self._unloaded.pop(charge)
+            tree = self.trees[charge] = self._read_tree(file_name)
+            self._block_files.pop(charge, None)
+            self._loaded += len(tree)
+        if charge not in self.trees:
+            return None
+        self._last_used[charge] = None
+        self._last_used.move_to_end(charge)
+        self._evict(keep=charge)
+        return self.trees[charge]
 
-    def load(self, directory):
+    def _shared(self, charge: int, tree: PsmTree) -> bool:
         """
-        pass a folder, look inside for saved files, and load them all as trees
+        whether a live snapshot still references tree. Must be called with the lock held.
         """
-        files = os.listdir(directory)
+        return any(snapshot.trees.get(charge) is tree for snapshot in self._snapshots)
 
-        self._lock.acquire()
-        for file in files:
-            charge = int(os.path.splitext(file)[0])  # /path/to/file.pkl -> file
-            tree = psm_tree_constructor(self.tree_type)
-            tree.load(os.path.join(directory, file), as_pickle=False)
+    def _unshare(self, charges: Iterable[int]):
+        """
+        Copies the trees of charges that live snapshots still reference before a change, without holding the lock
+        during the copy (O(n) in the tree's size), so searches & other writers are not held up. This is safe
+        because a tree shared with a snapshot is never changed in place: every writer copies it first. The copy
+        is swapped in only if the tree is still current; otherwise another writer got there first.
+        """
+        if not len(self._snapshots):
+            return
+        for charge in charges:
+            with self._lock:
+                tree = self.trees.get(charge)
+                if tree is None or not self._shared(charge, tree):
+                    continue
+            copy = tree.copy()
+            with self._lock:
+                if self.trees.get(charge) is tree:
+                    self.trees[charge] = copy
+
+    def _writable_tree(self, charge: int) -> PsmTree:
+        """
+        Returns the tree for charge, ready to be changed. Must be called with the lock held.
+        If a live snapshot still references the current tree, it is copied first (copy-on-write). Writers call
+        _unshare first, so this only copies under the lock when a snapshot was taken since.
+        """
+        tree = self._tree(charge)
+        if tree is None:
+            tree = self.trees[charge] = psm_tree_constructor(self.tree_type, **self.tree_options)
+            self._last_used[charge] = None
+        if self._shared(charge, tree):
+            tree = tree.copy()
             self.trees[charge] = tree
-        self._lock.release()
+        self._dirty.add(charge)
+        return tree
+
+    def _evict(self, keep: int):
+        """
+        Drops least recently used trees (other than keep) from memory until no more than max_loaded_psms psm's are
+        loaded. A tree unchanged since it was read is read again from the same file; changed trees are written to
+        a private spill directory (removed with the arborist), never over the files of the lazy-load directory.
+        Must be called with the lock held.
+        """
+        if self.max_loaded_psms is None or self._directory is None:
+            return
+        for charge in list(self._last_used):
+            if self._loaded <= self.max_loaded_psms:
+                break
+            if charge == keep or charge not in self.trees:
+                continue
+            tree = self.trees.pop(charge)
+            file_name = self._files.get(charge)
+            if charge in self._dirty or file_name is None:
+                if self._spill is None:
+                    self._spill = tempfile.mkdtemp(prefix='arboretum-')
+                    weakref.finalize(self, shutil.rmtree, self._spill, ignore_errors=True)
+                extension = os.path.splitext(file_name)[1] if file_name is not None else TEXT_FILE_EXTENSION
+                file_name = self._files[charge] = os.path.join(self._spill, f"{charge}{extension}")
+                tree.save(file_name, **_file_format(file_name))
+            self._dirty.discard(charge)
+            del self._last_used[charge]
+            self._unloaded[charge] = file_name
+            self._loaded -= len(tree)
+
+    @traced('save')
+    def save(self, directory, compressed: bool = False):
+        """
+        Create a directory folder (name passed in) during runtime and save all trees within.
+        Saves from a snapshot, so adds & removes may continue while the files are written.
+        """
+        self.snapshot().save(directory, compressed=compressed)
+
+    @traced('load')
+    def load(self, directory, lazy: bool = False):
+        """
+        pass a folder, look inside for saved files ([charge].txt, .blk or .pkl), and load them all as trees.
+        lazy only indexes the folder: each tree is read on the first add / remove to its charge, searches on
+        compressed (.blk) trees read just the blocks they need, and trees are evicted again when max_loaded_psms
+        is exceeded. The folder is only read: changed trees are evicted to a private spill directory.
+        """
+        files = tree_files(directory)
+        trees = {} if lazy else {charge: self._read_tree(file_name) for charge, file_name in files.items()}
+
+        with self._lock:
+            if lazy:
+                self._directory = directory
+                self._files.update(files)
+                for charge in files:
+                    self._loaded -= len(self.trees.pop(charge, ()))
+                    self._dirty.discard(charge)
+                self._unloaded.update(files)
+            for charge, tree in trees.items():
+                self._loaded += len(tree) - len(self.trees.get(charge, ()))
+            self.trees.update(trees)
+            if self.recorder is not None:
+                self.recorder.load(directory, lazy)
+            if self.prefilter is not None:
+                self.prefilter.invalidate()
+            if self.neutral_mass_index is not None:
+                self.neutral_mass_index.invalidate()
+            self.version += 1
+            if self.replication is not None:  # not replayable: replicas take a snapshot
+                self.replication.reset(self.version)
+
+    @staticmethod
+    def merge(directories: List[str], out_directory, dedup: bool = False, compressed: bool = False,
+              tree_type: Union[TreeType, str] = TreeType.SORTED_LIST) -> Dict[int, int]:
+        """
+        Merges saved arborists into one saved arborist at out_directory without loading them: each charge's files
+        are streamed through a k-way merge on mz, in bounded memory. See merge.merge.
+        Returns the number of psms written per charge.
+        """
+        from arboretum.merge import merge  # imported on use: merge imports this module
+        return merge(directories, out_directory, dedup=dedup, compressed=compressed, tree_type=tree_type)
+
+    def to_arrow(self) -> 'pyarrow.Table':
+        """
+        Every psm as a pyarrow Table (charge, mz, rt, ook0, then a column per data key), from a snapshot.
+        See arrow.arborist_to_table.
+        """
+        from arboretum.arrow import arborist_to_table  # imported on use: pyarrow is optional
+        return arborist_to_table(self)
 
-    def add(self, charge: int, mz: float, rt: float, ook0: float, data: dict):
+    def save_parquet(self, file_name: str, **kwargs):
+        """
+        Writes to_arrow() to a parquet file, read back with ingest(file_name). kwargs go to
+        pyarrow.parquet.write_table.
+        """
+        from arboretum.arrow import write_parquet  # imported on use: pyarrow is optional
+        write_parquet(self, file_name, **kwargs)
+
+    def from_arrow(self, source: Union['pyarrow.Table', 'pyarrow.RecordBatch']) -> int:
+        """
+        Adds the psm's of a pyarrow Table or RecordBatch with the columns of to_arrow(), in one update.
+        Returns the number of psms added.
+        """
+        from arboretum.arrow import to_psms  # imported on use: pyarrow is optional
+        psms = to_psms(source)
+        self.update(psms)
+        return len(psms)
+
+    def _window(self, ppm: Optional[float], rt_offset: Optional[float], ook0_tolerance: Optional[float]) -> dict:
+        """
+        the tolerance window given to add / update, as keyword arguments for the tree (unset values are left to
+        the tree's defaults, see tree_options)
+        """
+        window = {name: value for name, value in (('ppm', ppm), ('rt_offset', rt_offset),
+                                                  ('ook0_tolerance', ook0_tolerance)) if value is not None}
+        if window and not hasattr(psm_tree_class(self.tree_type), 'stab'):
+            raise ValueError(f'Tree type {self.tree_type} does not store tolerance windows')
+        return window
+
+    @traced('add', charged=True)
+    def add(self, charge: int, mz: float, rt: float, ook0: float, data: dict, ppm: Optional[float] = None,
+            rt_offset: Optional[float] = None, ook0_tolerance: Optional[float] = None):
         """
         Adds a psm to the currently-used tree type, to the tree of correct charge.
         All trees less than 3 Dimensions prioritize sorting by mz limits.
+        ppm, rt_offset & ook0_tolerance give the psm its own tolerance window for stab; only supported by tree
+        types that store windows (TreeType.INTERVAL). Windows are not recorded by the recorder or replication log.
         """
         psm = PSM(charge=charge, mz=mz, rt=rt, ook0=ook0, data=data)
-        if psm.charge not in self.trees:
-            self.trees[psm.charge] = psm_tree_constructor(self.tree_type)
-        self.trees[psm.charge].add(psm)
+        window = self._window(ppm, rt_offset, ook0_tolerance)
+        if self.recorder is not None:
+            self.recorder.add(psm)
+        self._unshare([psm.charge])
+        with self._lock:
+            tree = self._writable_tree(psm.charge)
+            if self.coalescing is None:
+                tree.add(psm, **window)
+                replaced = None
+            else:
+                replaced = tree.coalesce(psm, self.coalescing, **window)
+            self._loaded += replaced is None
+            if self.prefilter is not None and replaced is None:
+                self.prefilter.add(psm)
+            if self.neutral_mass_index is not None:
+                if replaced is not None:  # the entry psm was folded into was replaced
+                    self.neutral_mass_index.replace(*replaced)
+                else:
+                    self.neutral_mass_index.add(psm)
+            self.version += 1
+            if self.replication is not None:
+                self.replication.record(self.version, ADD, [psm])
 
+    @traced('update')
+    def update(self, psms: List[PSM], ppm: Optional[float] = None, rt_offset: Optional[float] = None,
+               ook0_tolerance: Optional[float] = None):
+        """
+        Adds a batch of psm's, grouped by charge, so each tree receives its psms in a single ordered update.
+        ppm, rt_offset & ook0_tolerance give every psm of the batch that tolerance window, as in add.
+        """
+        window = self._window(ppm, rt_offset, ook0_tolerance)
+        if self.recorder is not None:
+            psms = list(psms)
+            self.recorder.update(psms)
+        psms_by_charge = {}
+        for psm in psms:
+            psms_by_charge.setdefault(psm.charge, []).append(psm)
+
+        self._unshare(psms_by_charge)
+        with self._lock:
+            for charge, charge_psms in psms_by_charge.items():
+                tree = self._writable_tree(charge)
+                added, replaced = [], []
+                if self.coalescing is None:
+                    tree.update(tree.order_psms(charge_psms), **window)
+                    added = charge_psms
+                else:  # one at a time, so repeats within the batch are coalesced too
+                    for psm in charge_psms:
+                        entry = tree.coalesce(psm, self.coalescing, **window)
+                        if entry is None:
+                            added.append(psm)
+                        else:
+                            replaced.append(entry)
+                self._loaded += len(added)
+                if self.prefilter is not None:
+                    for psm in added:
+                        self.prefilter.add(psm)
+                if self.neutral_mass_index is not None:
+                    for psm in added:
+                        self.neutral_mass_index.add(psm)
+                    for entry, merged in replaced:  # in order: a merge may itself be replaced later in the batch
+                        self.neutral_mass_index.replace(entry, merged)
+            self.version += 1
+            if self.replication is not None:
+                self.replication.record(self.version, UPDATE, [psm for psms in psms_by_charge.values() for psm in psms])
+
+    @traced('ingest')
+    def ingest(self, source: Union[str, IO, Iterable[PSM]], batch_size: int = 10_000,
+               max_pending_batches: int = 4) -> int:
+        """
+        Streams psms from a JSONL file, directory, stdin ('-') or iterable of psms into the trees,
+        with bounded memory. See ingest.ingest. Returns the number of psms added.
+        """
+        return ingest(self, source, batch_size=batch_size, max_pending_batches=max_pending_batches)
+
+    @traced('search', charged=True)
     def search(self, charge: int, mz: float, rt: float, ook0: float, ppm: float, rt_offset: float,
                ook0_tolerance: float):
-        if charge not in self.trees:
+        if self.recorder is not None:
+            self.recorder.search(charge, mz, rt, ook0, ppm, rt_offset, ook0_tolerance)
+        tree = self.trees.get(charge)
+        if tree is None and charge not in self._unloaded:
             return []
 
         mz_bounds = get_mz_bounds(mz, ppm)
         rt_bounds = get_rt_bounds(rt, rt_offset)
         ook0_bounds = get_ook0_bounds(ook0, ook0_tolerance)
-        results = self.trees[charge]._search(mz_bounds, rt_bounds, ook0_bounds)
+        if tree is not None and self.prefilter is not None:
+            if not self._occupied(charge, tree, mz_bounds, rt_bounds):
+                return []
+            results = self._search_tree(charge, tree, mz_bounds, rt_bounds, ook0_bounds)
+            if not results:
+                with self._lock:
+                    self.prefilter.empty += 1
+            return results
+        return self._search_tree(charge, tree, mz_bounds, rt_bounds, ook0_bounds)
+
+    def exists(self, charge: int, mz: float, rt: float, ook0: float, ppm: float, rt_offset: float,
+               ook0_tolerance: float) -> bool:
+        """
+        Whether any psm lies inside the search window, e.g. for an exclusion check.
+        With a prefilter most misses are answered without searching the tree.
+        """
+        return bool(self.search(charge, mz, rt, ook0, ppm, rt_offset, ook0_tolerance))
+
+    @traced('search_mass')
+    def search_mass(self, mass: float, rt: float, ook0: float, ppm: float, rt_offset: float,
+                    ook0_tolerance: float) -> List[PSM]:
+        """
+        Searches every charge by neutral mass (neutralmass.neutral_mass converts a precursor mz), returning the
+        matches of all charges in neutral mass order. With a neutral_mass_index this is a single range scan of the
+        index, built from every tree on the first call; without, each charge's tree is searched over the mz
+        window of the mass at that charge.
+        """
+        mass_bounds = get_mz_bounds(mass, ppm)
+        rt_bounds = get_rt_bounds(rt, rt_offset)
+        ook0_bounds = get_ook0_bounds(ook0, ook0_tolerance)
+        if self.neutral_mass_index is not None:
+            with self._lock:
+                if not self.neutral_mass_index.built:
+                    trees = dict(self.trees)
+                    for charge, file_name in self._unloaded.items():  # read, like a snapshot, without loading
+                        trees[charge] = self._read_tree(file_name)
+                    self.neutral_mass_index.build(psm for tree in trees.values() for psm in tree.psms)
+                return self.neutral_mass_index.search(mass_bounds, rt_bounds, ook0_bounds)
+
+        results = []
+        for charge in sorted(set(self.trees) | set(self._unloaded)):
+            if charge > 0:
+                mz_bounds = Boundary(mz_of(mass_bounds.lower, charge), mz_of(mass_bounds.upper, charge))
+                results.extend(self._search_tree(charge, self.trees.get(charge), mz_bounds, rt_bounds, ook0_bounds))
+        results.sort(key=lambda psm: neutral_mass(psm.mz, psm.charge))
+        return results
+
+    def _occupied(self, charge: int, tree: PsmTree, mz_bounds: Boundary, rt_bounds: Boundary) -> bool:
+        """
+        checks a search window against the prefilter's grid of charge, building the grid if needed.
+        Runs under the lock: adds & removes change the grid's cells, and the counters are shared by every reader.
+        """
+        with self._lock:
+            self.prefilter.queries += 1
+            if self.prefilter.grid(charge, tree).occupied(mz_bounds, rt_bounds):
+                return True
+            self.prefilter.rejected += 1
+            return False
+
+    def _search_tree(self, charge: int, tree: Optional[PsmTree], mz_bounds: Boundary, rt_bounds: Boundary,
+                     ook0_bounds: Boundary) -> List[PSM]:
+        if tree is not None and self.max_loaded_psms is None:
+            return tree._search(mz_bounds, rt_bounds, ook0_bounds)
+
+        with self._lock:  # the tree may have to be read, or is tracked for eviction
+            block_file = self._block_file(charge)
+            if block_file is not None:
+                return block_file.search(mz_bounds, rt_bounds, ook0_bounds)
+            tree = self._tree(charge)
+            return [] if tree is None else tree._search(mz_bounds, rt_bounds, ook0_bounds)
+
+    @traced('search_array')
+    def search_array(self, charge, mz, rt, ook0, ppm: float, rt_offset: float,
+                     ook0_tolerance: float) -> List[List[PSM]]:
+        """
+        Searches a batch of queries given as arrays (numpy arrays or lists) of mz, rt & ook0 values.
+        charge is either one charge for every query or an array with one charge per query.
+        Returns one list of psm's per query, in query order. Bounds are computed for the whole batch at once.
+        """
+        import numpy as np  # imported on use, like the other array helpers
+
+        if self.recorder is not None:
+            self.recorder.search_array(charge, mz, rt, ook0, ppm, rt_offset, ook0_tolerance)
+        mz_lower, mz_upper = get_mz_bounds_array(mz, ppm)
+        rt_lower, rt_upper = get_rt_bounds_array(rt, rt_offset)
+        ook0_lower, ook0_upper = get_ook0_bounds_array(ook0, ook0_tolerance)
+        charges = np.broadcast_to(np.asarray(charge), mz_lower.shape)
+
+        results = [[] for _ in range(len(mz_lower))]
+        for query_charge in np.unique(charges).tolist():
+            with self._lock:
+                tree = self._tree(query_charge)
+            if tree is None:
+                continue
+            queries = np.flatnonzero(charges == query_charge)
+            if self.prefilter is not None:  # only the queries whose windows touch an occupied cell are searched
+                queries = np.array([i for i in queries.tolist() if self._occupied(
+                    query_charge, tree, Boundary(mz_lower[i], mz_upper[i]), Boundary(rt_lower[i], rt_upper[i]))],
+                    dtype=np.int64)
+                if not len(queries):
+                    continue
+            charge_results = tree.search_array(mz_lower[queries], mz_upper[queries], rt_lower[queries],
+                                               rt_upper[queries], ook0_lower[queries], ook0_upper[queries])
+            for i, psms in zip(queries.tolist(), charge_results):
+                results[i] = psms
+            if self.prefilter is not None:
+                with self._lock:
+                    self.prefilter.empty += sum(1 for psms in charge_results if not psms)
         return results
 
+    @traced('stab', charged=True)
+    def stab(self, charge: int, mz: float, rt: float, ook0: float) -> List[PSM]:
+        """
+        Returns every psm whose own tolerance window (given when it was added) covers the point.
+        Only supported by tree types that store windows (TreeType.INTERVAL).
+        """
+        with self._lock:
+            tree = self._tree(charge)
+        if tree is None:
+            return []
+        if not hasattr(tree, 'stab'):
+            raise ValueError(f'Tree type {self.tree_type} does not store tolerance windows')
+        return tree.stab(mz, rt, ook0)
+
+    def explain(self, charge: int, mz: float, rt: float, ook0: float, ppm: float, rt_offset: float,
+                ook0_tolerance: float) -> Optional['QueryPlan']:
+        """
+        Returns the plan a search with these arguments would run: the index it would scan and the candidates in
+        range of each index. Only supported by tree types with a query planner (TreeType.MULTI_INDEX).
+        Returns None if there is no tree for charge.
+        """
+        with self._lock:
+            tree = self._tree(charge)
+        if tree is None:
+            return None
+        if not hasattr(tree, 'explain'):
+            raise ValueError(f'Tree type {self.tree_type} does not plan its searches')
+        return tree.explain(get_mz_bounds(mz, ppm), get_rt_bounds(rt, rt_offset), get_ook0_bounds(ook0, ook0_tolerance))
+
+    def _block_file(self, charge: int) -> Optional['BlockFile']:
+        """
+        Returns a BlockFile for a compressed tree that has not been loaded yet, otherwise None.
+        Must be called with the lock held.
+        """
+        file_name = self._unloaded.get(charge)
+        if file_name is None or not file_name.endswith(BLOCK_FILE_EXTENSION):
+            return None
+        if charge not in self._block_files:
+            from arboretum.blockfile import BlockFile  # imported on use: pulls in numpy
+            self._block_files[charge] = BlockFile(file_name)
+        return self._block_files[charge]
+
+    @traced('remove', charged=True)
     def remove(self, charge: int, mz: float, rt: float, ook0: float, data: dict):
         psm = PSM(charge=charge, mz=mz, rt=rt, ook0=ook0, data=data)
-        if psm.charge not in self.trees:
+        if psm.charge not in self.trees and psm.charge not in self._unloaded:
             raise ValueError(f'PSM not found. No tree with charge {charge}')
-        self.trees[psm.charge].remove(psm)
+        self._unshare([psm.charge])
+        with self._lock:
+            self._writable_tree(psm.charge).remove(psm)
+            if self.recorder is not None:  # recorded once it succeeded, so a failed remove is not replayed
+                self.recorder.remove(psm)
+            self._loaded -= 1
+            if self.prefilter is not None:
+                self.prefilter.remove(psm)
+            if self.neutral_mass_index is not None:
+                self.neutral_mass_index.remove(psm)
+            self.version += 1
+            if self.replication is not None:
+                self.replication.record(self.version, REMOVE, [psm])
+
+    @traced('remove_many')
+    def remove_many(self, psms: Iterable[PSM]) -> int:
+        """
+        Removes a batch of psm's (e.g. search results), rebuilding each affected tree once instead of removing
+        psm's one by one. Psm's that are not stored are ignored. Returns the number of psm's removed.
+        """
+        psms_by_charge = {}
+        for psm in psms:
+            psms_by_charge.setdefault(psm.charge, []).append(psm)
+
+        removed = 0
+        self._unshare(psms_by_charge)
+        with self._lock:
+            if self.recorder is not None:
+                self.recorder.remove_many([psm for psms in psms_by_charge.values() for psm in psms])
+            for charge, charge_psms in psms_by_charge.items():
+                if charge in self.trees or charge in self._unloaded:
+                    charge_removed = self._writable_tree(charge).remove_many(charge_psms)
+                    self._loaded -= charge_removed
+                    removed += charge_removed
+                    if self.prefilter is not None:
+                        self.prefilter.invalidate(charge)
+                    if self.neutral_mass_index is not None:
+                        self.neutral_mass_index.invalidate()
+            self.version += 1
+            if self.replication is not None:
+                self.replication.record(self.version, REMOVE_MANY,
+                                        [psm for psms in psms_by_charge.values() for psm in psms])
+        return removed
+
+    @traced('retain')
+    def retain(self, predicate: Callable[[PSM], bool]) -> int:
+        """
+        Keeps only the psm's for which predicate is true (e.g. between-sample cleanup of an exclusion list),
+        filtering and rebuilding each tree in one pass. Returns the number of psm's removed.
+        """
+        if self.recorder is not None:  # the predicate cannot be recorded: the psm's it rejects are, instead
+            rejected, keep = [], predicate
+
+            def predicate(psm: PSM) -> bool:
+                if keep(psm):
+                    return True
+                rejected.append(psm)
+                return False
+
+        removed = 0
+        self._unshare(list(self.trees))
+        with self._lock:
+            for charge in list(self.trees) + list(self._unloaded):
+                charge_removed = self._writable_tree(charge).retain(predicate)
+                self._loaded -= charge_removed
+                removed += charge_removed
+            if self.prefilter is not None:
+                self.prefilter.invalidate()
+            if self.neutral_mass_index is not None:
+                self.neutral_mass_index.invalidate()
+            if self.recorder is not None:
+                self.recorder.retain(rejected)
+            self.version += 1
+            if self.replication is not None:  # not replayable: replicas take a snapshot
+                self.replication.reset(self.version)
+        return removed
+
+    @traced('recalibrate')
+    def recalibrate(self, correction: 'Correction') -> int:
+        """
+        Corrects mass calibration drift by shifting every stored mz by a ppm correction: a function of the numpy
+        arrays (mz, rt) returning ppm's, or the coefficients of a polynomial in mz (see calibration.py).
+        The correction is applied to each tree's columns at once and each tree is rebuilt once; SORTED_LIST and
+        BUFFERED_SORTED_LIST trees whose mz order the correction keeps are not re-sorted, and INTERVAL trees keep
+        each psm's own tolerance window. Returns the number of psm's moved.
+        """
+        from arboretum.calibration import mz_shift  # imported on use: pulls in numpy
+
+        shift = mz_shift(correction)
+        moved = 0
+        self._unshare(list(self.trees))
+        with self._lock:
+            for charge in list(self.trees) + list(self._unloaded):
+                moved += self._writable_tree(charge).recalibrate(shift)
+            if self.recorder is not None:
+                self.recorder.recalibrate(None if callable(correction) else list(correction))
+            if self.prefilter is not None:
+                self.prefilter.invalidate()
+            if self.neutral_mass_index is not None:
+                self.neutral_mass_index.invalidate()
+            self.version += 1
+            if self.replication is not None:  # not replayable: replicas take a snapshot
+                self.replication.reset(self.version)
+        return moved
+
+    @property
+    def loaded_charges(self) -> List[int]:
+        """
+        charges whose trees are currently in memory
+        """
+        return list(self.trees)
+
+    def memory_usage(self) -> Dict[int, MemoryUsage]:
+        """
+        deep size in bytes of each loaded tree (charge -> MemoryUsage, see PsmTree.memory_usage).
+        Trees still on disk after a lazy load use no memory and are not listed.
+        """
+        with self._lock:
+            return {charge: tree.memory_usage() for charge, tree in self.trees.items()}
+
+    @property
+    def sizes(self) -> Dict[int, int]:
+        """
+        number of psm's per charge, including trees still on disk after a lazy load
+        """
+        sizes = {charge: len(tree) for charge, tree in self.trees.items()}
+        for charge, file_name in self._unloaded.items():
+            if file_name.endswith(BLOCK_FILE_EXTENSION):
+                from arboretum.blockfile import BlockFile  # imported on use: pulls in numpy
+                sizes[charge] = len(BlockFile(file_name))
+            elif file_name.endswith(PICKLE_FILE_EXTENSION):
+                sizes[charge] = len(self._read_tree(file_name))
+            else:
+                with open(file_name, "r") as file:
+                    sizes[charge] = sum(1 for _ in file)
+        return sizes
 
     def __len__(self):
-        return sum([len(self.trees[charge]) for charge in self.trees])
+        return sum(self.sizes.values())
@@ -0,0 +1,163 @@
+"""
+-------------- Arrow --------------
+Hands PSM's to and from Apache Arrow (and
+Parquet files), for dataframe tools such as
+pandas or polars. One row per PSM:
+    charge : int32
+    mz, rt, ook0 : float64
+    one column per data key (null where
+    a PSM's data does not have the key)
+Data values Arrow cannot type (e.g. a key
+holding both ints and strings) are stored
+as their repr, listed in the schema metadata,
+and evaluated again on import.
+Coordinate columns are built with numpy in
+bulk; trees that already store them as
+arrays (PsmBufferedSortedList, when nothing
+is buffered) are exported without copying.
+Requires pyarrow (pip install arboretum[arrow]).
+-----------------------------------
+"""
+
+import ast
+import json
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from arboretum.psm import PSM
+
+if TYPE_CHECKING:
+    from arboretum.arborist import PSMArborist
+    from arboretum.forest import PsmTree
+
+COORDINATES = ('charge', 'mz', 'rt', 'ook0')
+REPR_COLUMNS_KEY = b'arboretum.repr_columns'  # schema metadata: json list of the columns stored as repr
+
+
+def _data_columns(psms: Sequence[PSM]) -> dict:
+    keys = {}
+    for psm in psms:
+        keys.update(dict.fromkeys(psm.data))
+    return {key: [psm.data.get(key) for psm in psms] for key in keys}
+
+
+def _data_arrays(psms: Sequence[PSM]) -> Tuple[List[str], List[pa.Array], List[str]]:
+    """
+    the names & arrays of the data columns of psms, and the names of those stored as repr
+    """
+    names, arrays, repr_columns = [], [], []
+    for key, values in _data_columns(psms).items():
+        if str(key) in COORDINATES:
+            raise ValueError(f'data key {key!r} clashes with a coordinate column')
+        try:
+            array = pa.array(values)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            array = pa.array([None if value is None else repr(value) for value in values], type=pa.string())
+            repr_columns.append(str(key))
+        names.append(str(key))
+        arrays.append(array)
+    return names, arrays, repr_columns
+
+
+def _metadata(repr_columns: List[str]) -> Optional[dict]:
+    return {REPR_COLUMNS_KEY: json.dumps(repr_columns)} if repr_columns else None
+
+
+def _coordinate_arrays(tree: 'PsmTree', psms: List[PSM], charge: int) -> List[pa.Array]:
+    """
+    the charge, mz, rt & ook0 arrays of a tree's psm's; columnar trees hand over their own columns
+    """
+    if hasattr(tree, 'mzs') and len(tree.mzs) == len(psms):  # nothing buffered: the columns hold every psm
+        columns = [tree.mzs, tree.rts, tree.ook0s]
+    else:
+        columns = [np.fromiter((getattr(psm, coordinate) for psm in psms), dtype=np.float64, count=len(psms))
+                   for coordinate in COORDINATES[1:]]
+    return [pa.array(np.full(len(psms), charge, dtype=np.int32))] + [pa.array(column) for column in columns]
+
+
+def to_record_batch(psms: Sequence[PSM]) -> pa.RecordBatch:
+    """
+    one row per psm
+    """
+    psms = list(psms)
+    charges = pa.array(np.fromiter((psm.charge for psm in psms), dtype=np.int32, count=len(psms)))
+    coordinates = [pa.array(np.fromiter((getattr(psm, coordinate) for psm in psms), dtype=np.float64,
+                                        count=len(psms))) for coordinate in COORDINATES[1:]]
+    names, arrays, repr_columns = _data_arrays(psms)
+    return pa.RecordBatch.from_arrays([charges] + coordinates + arrays, names=list(COORDINATES) + names,
+                                      metadata=_metadata(repr_columns))
+
+
+def tree_to_record_batch(tree: 'PsmTree', charge: int) -> pa.RecordBatch:
+    """
+    the psm's of a charge's tree. The mz, rt & ook0 columns of columnar trees are shared with the tree, not
+    copied (the tree replaces its arrays when it changes, so the batch stays as it was)
+    """
+    psms = tree.psms
+    names, arrays, repr_columns = _data_arrays(psms)
+    return pa.RecordBatch.from_arrays(_coordinate_arrays(tree, psms, charge) + arrays,
+                                      names=list(COORDINATES) + names, metadata=_metadata(repr_columns))
+
+
+def arborist_to_table(arborist: 'PSMArborist') -> pa.Table:
+    """
+    every psm of the arborist, in charge order, from a snapshot (trees on disk after a lazy load are read).
+    The coordinate columns have a chunk per charge (shared with columnar trees); data columns are typed
+    across every charge, so a key missing from one charge is null there.
+    """
+    chunks, psms = [[] for _ in COORDINATES], []
+    for charge, tree in sorted(arborist.snapshot().trees.items()):
+        tree_psms = tree.psms
+        if tree_psms:
+            for column, array in zip(chunks, _coordinate_arrays(tree, tree_psms, charge)):
+                column.append(array)
+            psms.extend(tree_psms)
+    types = [pa.int32()] + [pa.float64()] * 3
+    names, arrays, repr_columns = _data_arrays(psms)
+    return pa.Table.from_arrays([pa.chunked_array(column, type=type_) for column, type_ in zip(chunks, types)] +
+                                arrays, names=list(COORDINATES) + names, metadata=_metadata(repr_columns))
+
+
+def to_psms(source: Union[pa.RecordBatch, pa.Table]) -> List[PSM]:
+    """
+    the psm's of a record batch or table with the columns of to_record_batch. Columns are converted to python
+    values a column at a time; null data values are left out of the psm's data.
+    """
+    metadata = source.schema.metadata or {}
+    repr_columns = set(json.loads(metadata.get(REPR_COLUMNS_KEY, b'[]')))
+    charges = source.column('charge').to_pylist()
+    mzs, rts, ook0s = [source.column(coordinate).to_numpy().tolist() for coordinate in COORDINATES[1:]]
+    keys = [name for name in source.schema.names if name not in COORDINATES]
+    columns = [source.column(key).to_pylist() for key in keys]
+    for i, key in enumerate(keys):
+        if key in repr_columns:
+            columns[i] = [None if value is None else ast.literal_eval(value) for value in columns[i]]
+
+    psms = []
+    for row, (charge, mz, rt, ook0) in enumerate(zip(charges, mzs, rts, ook0s)):
+        data = {key: column[row] for key, column in zip(keys, columns) if column[row] is not None}
+        psms.append(PSM(charge, mz, rt, ook0, data))
+    return psms
+
+
+def write_parquet(arborist: 'PSMArborist', file_name: str, **kwargs):
+    """
+    writes arborist_to_table(arborist) to a parquet file. kwargs go to pyarrow.parquet.write_table
+    (e.g. compression='zstd')
+    """
+    pq.write_table(arborist_to_table(arborist), file_name, **kwargs)
+
+
+def read_parquet(file_name: str, batch_size: int = 65_536) -> Iterator[PSM]:
+    """
+    yields the psm's of a parquet file, reading batch_size rows at a time
+    """
+    file = pq.ParquetFile(file_name)
+    metadata = file.schema_arrow.metadata
+    for batch in file.iter_batches(batch_size=batch_size):
+        if metadata:
+            batch = batch.replace_schema_metadata(metadata)
+        yield from to_psms(batch)
@@ -0,0 +1,235 @@
+"""
+-------------- Block File --------------
+A compressed, randomly accessible file format
+for saved trees. PSM's are written in mz order
+and cut into blocks of a fixed number of PSM's.
+Inside a block each coordinate column is stored
+as deltas of its IEEE-754 bit patterns (small for
+sorted or clustered values), byte-shuffled and
+zlib compressed. A block index of mz ranges at
+the end of the file lets a search read and
+decompress only the blocks overlapping its query.
+
+Layout:
+    header  : magic, format version
+    blocks  : zlib(count, charge[], mz[], rt[], ook0[], data lines)
+    index   : (mz_min, mz_max, offset, length, count) per block
+    footer  : index offset, block count, magic
+----------------------------------------
+"""
+
+import ast
+import struct
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+from arboretum.boundary import Boundary
+from arboretum.kernel import in_bounds
+from arboretum.psm import PSM
+
+MAGIC = b'ARBB'
+FORMAT_VERSION = 1
+BLOCK_SIZE = 4096  # psms per block
+COMPRESSION_LEVEL = 6
+
+_HEADER = struct.Struct('<4sI')
+_INDEX_ENTRY = struct.Struct('<ddQQI')
+_FOOTER = struct.Struct('<QI4s')
+_COUNT = struct.Struct('<I')
+
+
+@dataclass
+class BlockIndexEntry:
+    __slots__ = "mz_min", "mz_max", "offset", "length", "count"
+    mz_min: float
+    mz_max: float
+    offset: int
+    length: int
+    count: int
+
+
+def _encode_floats(values: np.ndarray) -> bytes:
+    """
+    delta-encodes the bit patterns of a float64 column, then shuffles the bytes so that the (mostly zero)
+    high bytes of every delta are stored next to each other.
+    """
+    bits = values.astype('<f8').view('<u8')
+    deltas = np.diff(bits, prepend=np.uint64(0))
+    return deltas.view(np.uint8).reshape(-1, 8).T.tobytes()
+
+
+def _decode_floats(buffer: bytes, count: int) -> np.ndarray:
+    deltas = np.frombuffer(buffer, dtype=np.uint8).reshape(8, count).T.copy().view('<u8').ravel()
+    return np.cumsum(deltas, dtype=np.uint64).view('<f8')
+
+
+def _encode_block(psms: List[PSM]) -> bytes:
+    count = len(psms)
+    charges = np.fromiter((psm.charge for psm in psms), dtype='<i4', count=count)
+    mzs = np.fromiter((psm.mz for psm in psms), dtype='<f8', count=count)
+    rts = np.fromiter((psm.rt for psm in psms), dtype='<f8', count=count)
+    ook0s = np.fromiter((psm.ook0 for psm in psms), dtype='<f8', count=count)
+    data = '\n'.join(repr(psm.data) for psm in psms).encode('utf-8')
+    payload = b''.join([_COUNT.pack(count), charges.tobytes(),
+                        _encode_floats(mzs), _encode_floats(rts), _encode_floats(ook0s), data])
+    return zlib.compress(payload, COMPRESSION_LEVEL)
+
+
+@dataclass
+class Block:
+    """
+    A decompressed block: coordinate columns as arrays, data payloads still as unparsed lines.
+    """
+    charges: np.ndarray
+    mzs: np.ndarray
+    rts: np.ndarray
+    ook0s: np.ndarray
+    data: List[bytes]
+
+    @staticmethod
+    def decode(buffer: bytes) -> 'Block':
+        payload = zlib.decompress(buffer)
+        count = _COUNT.unpack_from(payload)[0]
+        position = _COUNT.size
+        charges = np.frombuffer(payload, dtype='<i4', count=count, offset=position)
+        position += 4 * count
+        columns = []
+        for _ in range(3):
+            columns.append(_decode_floats(payload[position:position + 8 * count], count))
+            position += 8 * count
+        data = payload[position:].split(b'\n')
+        return Block(charges, columns[0], columns[1], columns[2], data)
+
+    def psm(self, i: int) -> PSM:
+        return PSM(charge=int(self.charges[i]),
+                   mz=float(self.mzs[i]),
+                   rt=float(self.rts[i]),
+                   ook0=float(self.ook0s[i]),
+                   data=ast.literal_eval(self.data[i].decode('utf-8')))
+
+    def search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        # psm's are stored in mz order, so only the mz range needs filtering
+        start = int(np.searchsorted(self.mzs, mz_boundary.lower, side='left'))
+        end = int(np.searchsorted(self.mzs, mz_boundary.upper, side='right'))
+        indexes = in_bounds(self.mzs, self.rts, self.ook0s, start, end,
+                            float(mz_boundary.lower), float(mz_boundary.upper),
+                            float(rt_boundary.lower), float(rt_boundary.upper),
+                            float(ook0_boundary.lower), float(ook0_boundary.upper))
+        return [self.psm(i) for i in indexes.tolist()]
+
+    def __len__(self):
+        return len(self.mzs)
+
+
+def write_blocks(file_name: str, psms: Iterable[PSM], block_size: int = BLOCK_SIZE) -> int:
+    """
+    Writes psms, which must arrive in ascending mz order, to a block file. Only one block is held in memory,
+    so psms may be a generator. Returns the number of psms written.
+    """
+    index = []
+    with open(file_name, "wb") as file:
+        file.write(_HEADER.pack(MAGIC, FORMAT_VERSION))
+
+        def flush(block: List[PSM]):
+            buffer = _encode_block(block)
+            index.append(BlockIndexEntry(block[0].mz, block[-1].mz, file.tell(), len(buffer), len(block)))
+            file.write(buffer)
+
+        block = []
+        last_mz = None
+        for psm in psms:
+            if last_mz is not None and psm.mz < last_mz:
+                raise ValueError('psms must be written to a block file in ascending mz order')
+            last_mz = psm.mz
+            block.append(psm)
+            if len(block) >= block_size:
+                flush(block)
+                block = []
+        if block:
+            flush(block)
+
+        index_offset = file.tell()
+        for entry in index:
+            file.write(_INDEX_ENTRY.pack(entry.mz_min, entry.mz_max, entry.offset, entry.length, entry.count))
+        file.write(_FOOTER.pack(index_offset, len(index), MAGIC))
+    return sum(entry.count for entry in index)
+
+
+class BlockFile:
+    """
+    Read access to a block file. Opening one only reads its block index; searches read & decompress just the
+    blocks whose mz range overlaps the query, keeping the most recently used blocks decompressed.
+    """
+
+    def __init__(self, file_name: str, cache_size: int = 8):
+        self.file_name = file_name
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        with open(file_name, "rb") as file:
+            magic, version = _HEADER.unpack(file.read(_HEADER.size))
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f'{file_name} is not a block file')
+            file.seek(-_FOOTER.size, 2)
+            index_offset, block_count, magic = _FOOTER.unpack(file.read(_FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f'{file_name} is truncated')
+            file.seek(index_offset)
+            buffer = file.read(block_count * _INDEX_ENTRY.size)
+
+        self.index = [BlockIndexEntry(*_INDEX_ENTRY.unpack_from(buffer, i * _INDEX_ENTRY.size))
+                      for i in range(block_count)]
+        self._mz_maxes = [entry.mz_max for entry in self.index]
+
+    def block(self, i: int) -> Block:
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+
+        entry = self.index[i]
+        with open(self.file_name, "rb") as file:
+            file.seek(entry.offset)
+            block = Block.decode(file.read(entry.length))
+
+        self._cache[i] = block
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return block
+
+    def overlapping_blocks(self, mz_boundary: Boundary) -> List[int]:
+        """
+        returns the indexes of every block whose mz range overlaps the boundary
+        """
+        blocks = []
+        for i in range(bisect_left(self._mz_maxes, mz_boundary.lower), len(self.index)):
+            if self.index[i].mz_min > mz_boundary.upper:
+                break
+            blocks.append(i)
+        return blocks
+
+    def search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        return [psm for i in self.overlapping_blocks(mz_boundary)
+                for psm in self.block(i).search(mz_boundary, rt_boundary, ook0_boundary)]
+
+    def iter_psms(self) -> Iterator[PSM]:
+        """
+        yields every psm in mz order, decompressing one block at a time (bypasses the cache)
+        """
+        with open(self.file_name, "rb") as file:
+            for entry in self.index:
+                file.seek(entry.offset)
+                block = Block.decode(file.read(entry.length))
+                for i in range(len(block)):
+                    yield block.psm(i)
+
+    @property
+    def psms(self) -> List[PSM]:
+        return list(self.iter_psms())
+
+    def __len__(self):
+        return sum(entry.count for entry in self.index)
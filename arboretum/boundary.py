@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Tuple
 
 @dataclass
 class Boundary:
@@ -38,3 +39,29 @@ returns lower bound & upper bound as a class Boundary object
 def get_ook0_bounds(ook0: float, tolerance: float) -> Boundary:
     return Boundary(lower=ook0 - abs(ook0) * tolerance,
                     upper=ook0 + abs(ook0) * tolerance)
+
+
+
+"""
+Array versions of the above, for batches of queries: take arrays (or scalars) of values and tolerances,
+return a (lower, upper) pair of numpy arrays, with one element per query.
+numpy is imported on first use, so importing boundary stays cheap.
+"""
+def get_mz_bounds_array(mz, ppm) -> Tuple['np.ndarray', 'np.ndarray']:
+    import numpy as np
+    mz = np.asarray(mz, dtype=np.float64)
+    offset = np.abs(mz) * ppm / 1_000_000
+    return mz - offset, mz + offset
+
+
+def get_rt_bounds_array(rt, offset) -> Tuple['np.ndarray', 'np.ndarray']:
+    import numpy as np
+    rt = np.asarray(rt, dtype=np.float64)
+    return rt - offset, rt + offset
+
+
+def get_ook0_bounds_array(ook0, tolerance) -> Tuple['np.ndarray', 'np.ndarray']:
+    import numpy as np
+    ook0 = np.asarray(ook0, dtype=np.float64)
+    offset = np.abs(ook0) * tolerance
+    return ook0 - offset, ook0 + offset
@@ -0,0 +1,50 @@
+"""
+-------------- Calibration --------------
+Corrections of mass calibration drift. A
+correction is a ppm shift of each PSM's mz:
+    corrected mz = mz * (1 + ppm / 1e6)
+given either as a function of the numpy
+arrays of the PSM's mz and rt, returning
+the ppm of each (or one ppm for all), or as
+the coefficients of a polynomial in mz,
+lowest order first ([2.5] shifts every mz
+by +2.5 ppm).
+Corrections are applied to a whole tree at
+once; when the corrected mz's are still in
+order (any correction increasing with mz),
+sorted trees keep their order as it is.
+-----------------------------------------
+"""
+
+from typing import Callable, Sequence, Union
+
+import numpy as np
+
+Correction = Union[Callable[[np.ndarray, np.ndarray], Union[np.ndarray, float]], Sequence[float]]
+
+
+def mz_shift(correction: Correction) -> Callable[[np.ndarray, np.ndarray], np.ndarray]:
+    """
+    the function taking the mz & rt arrays of psm's to their corrected mz's
+    """
+    if callable(correction):
+        ppm = correction
+    else:
+        coefficients = np.asarray(correction, dtype=np.float64)
+        if coefficients.ndim != 1 or not len(coefficients):
+            raise ValueError('a correction is a function of (mz, rt) or a sequence of polynomial coefficients')
+
+        def ppm(mzs: np.ndarray, rts: np.ndarray) -> np.ndarray:
+            return np.polynomial.polynomial.polyval(mzs, coefficients)
+
+    def shift(mzs: np.ndarray, rts: np.ndarray) -> np.ndarray:
+        return mzs * (1.0 + np.asarray(ppm(mzs, rts), dtype=np.float64) * 1e-6)
+
+    return shift
+
+
+def keeps_order(mzs: np.ndarray) -> bool:
+    """
+    true if mzs are non-decreasing, i.e. corrected mz's of psm's in mz order are still in mz order
+    """
+    return bool(np.all(mzs[1:] >= mzs[:-1]))
@@ -0,0 +1,61 @@
+"""
+-------------- Coalesce --------------
+Folds repeated identifications of a peptide
+into one entry. With an Arborist's coalescing
+set, a PSM with the same sequence as an entry
+already within epsilon of it (in mz, rt and
+ook0) is not added: the entry is replaced by
+a copy with its count incremented, the last
+rt seen and any aggregated fields combined.
+The entry keeps the coordinates of the first
+identification, so later ones are matched
+against a fixed point.
+Entries are replaced, never changed, as trees
+share their PSM objects with snapshots.
+--------------------------------------
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict
+
+from arboretum.boundary import Boundary
+from arboretum.constants import PSM_COUNT_KEY, PSM_LAST_RT_KEY, PSM_SEQUENCE_KEY
+from arboretum.psm import PSM
+
+
+@dataclass
+class Coalescing:
+    """
+    when two psm's are the same identification, and how their data is combined.
+    aggregates maps a data field to a function combining the entry's value with the new psm's,
+    e.g. {'score': max}. Other fields keep the entry's value.
+    """
+    mz_epsilon: float = 0.0001
+    rt_epsilon: float = 1.0
+    ook0_epsilon: float = 0.001
+    key: str = PSM_SEQUENCE_KEY
+    aggregates: Dict[str, Callable[[Any, Any], Any]] = field(default_factory=dict)
+
+    def boundaries(self, psm: PSM):
+        """
+        the mz, rt & ook0 Boundaries an entry must lie in to be coalesced with psm
+        """
+        return Boundary(psm.mz - self.mz_epsilon, psm.mz + self.mz_epsilon), \
+            Boundary(psm.rt - self.rt_epsilon, psm.rt + self.rt_epsilon), \
+            Boundary(psm.ook0 - self.ook0_epsilon, psm.ook0 + self.ook0_epsilon)
+
+    def matches(self, entry: PSM, psm: PSM) -> bool:
+        return entry.charge == psm.charge and self.key in psm.data and entry.data.get(self.key) == psm.data[self.key]
+
+    def merged(self, entry: PSM, psm: PSM) -> PSM:
+        """
+        a new entry: entry's coordinates & data, with the count, last rt & aggregated fields updated by psm.
+        Psm's that are themselves coalesced entries count as many identifications as they hold.
+        """
+        data = dict(entry.data)
+        data[PSM_COUNT_KEY] = entry.data.get(PSM_COUNT_KEY, 1) + psm.data.get(PSM_COUNT_KEY, 1)
+        data[PSM_LAST_RT_KEY] = psm.data.get(PSM_LAST_RT_KEY, psm.rt)
+        for name, aggregate in self.aggregates.items():
+            if name in psm.data:
+                data[name] = aggregate(entry.data[name], psm.data[name]) if name in entry.data else psm.data[name]
+        return PSM(entry.charge, entry.mz, entry.rt, entry.ook0, data)
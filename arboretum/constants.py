@@ -1,4 +1,8 @@
 PSM_MZ_KEY = 'mono_mz'
 PSM_OOK0_KEY = 'ook0'
 PSM_RT_KEY = 'rt'
-PSM_CHARGE_KEY = 'charge'
\ No newline at end of file
+PSM_CHARGE_KEY = 'charge'
+PSM_SEQUENCE_KEY = 'sequence'
+PSM_COUNT_KEY = 'count'  # identifications folded into a coalesced psm (see coalesce.py)
+PSM_LAST_RT_KEY = 'last_rt'
+PROTON_MASS = 1.007276466812  # Da, added per charge to a neutral peptide's mass (see neutralmass.py)
@@ -1,43 +1,86 @@
-import sys
-from typing import Union
+from importlib import import_module
+from typing import Optional, Union
 
-from forest.psmtree import PsmTree
-from forest.psmbintree import PsmBinaryTree, PsmAvlTree, PsmRBTree, PsmFastBinaryTree, PsmFastAVLTree, PsmFastRBTree
-from forest.psmintervaltree import PsmIntervalTree
-from forest.psmkdtree import PsmKdTree
-from forest.psmsortedlist import PsmSortedList, PsmHashtable
-from forest.treetypes import TreeType
+from arboretum.forest.psmtree import PsmTree
+from arboretum.forest.treetypes import TreeType
 
-sys.setrecursionlimit(10 ** 6)
+# Backends are only imported the first time a tree of their type is constructed, so programs never pay for
+# (or need to install) the packages of backends they do not use.
+# TreeType -> (name, backend module, backend class, keyword arguments). Entries without a module are not implemented.
+_TREE_TYPES = {
+    TreeType.KD: ('kd_tree', None, None, {}),
+    TreeType.BINARY: ('binary', 'psmbintree', 'PsmBinaryTree', {}),
+    TreeType.AVL: ('avl', 'psmbintree', 'PsmAvlTree', {}),
+    TreeType.RB: ('rb', 'psmbintree', 'PsmRBTree', {}),
+    TreeType.FAST_BINARY: ('fast_binary', 'psmbintree', 'PsmFastBinaryTree', {}),
+    TreeType.FAST_AVL: ('fast_avl', 'psmbintree', 'PsmFastAVLTree', {}),
+    TreeType.FAST_RB: ('fast_rb', 'psmbintree', 'PsmFastRBTree', {}),
+    TreeType.INTERVAL: ('interval', 'psmintervaltree', 'PsmIntervalTree', {}),
+    TreeType.SORTED_LIST: ('sorted_list', 'psmsortedlist', 'PsmSortedList', {}),
+    TreeType.HASHTABLE: ('hashtable', 'psmsortedlist', 'PsmHashtable', {}),
+    TreeType.HASHTABLE_MED: ('hashtable_med', 'psmsortedlist', 'PsmHashtable', {'precision': 3}),
+    TreeType.HASHTABLE_LARGE: ('hashtable_large', 'psmsortedlist', 'PsmHashtable', {'precision': 4}),
+    TreeType.RANGE: ('range', 'psmrangetree', 'PsmRangeTree', {}),
+    TreeType.PARTITIONED: ('partitioned', 'psmpartitionedtree', 'PsmPartitionedTree', {}),
+    TreeType.BUFFERED_SORTED_LIST: ('buffered_sorted_list', 'psmlist', 'PsmBufferedSortedList', {}),
+    TreeType.MULTI_INDEX: ('multi_index', 'psmmultiindextree', 'PsmMultiIndexTree', {}),
+}
+_TREE_TYPE_NAMES = {name: tree_type for tree_type, (name, _, _, _) in _TREE_TYPES.items()}
+
+# backend class -> module, for "from arboretum.forest import PsmSortedList" style access
+_BACKENDS = {
+    'PsmBinTree': 'psmbintree',
+    'PsmBinaryTree': 'psmbintree',
+    'PsmAvlTree': 'psmbintree',
+    'PsmBufferedSortedList': 'psmlist',
+    'PsmRBTree': 'psmbintree',
+    'PsmFastBinaryTree': 'psmbintree',
+    'PsmFastAVLTree': 'psmbintree',
+    'PsmFastRBTree': 'psmbintree',
+    'PsmIntervalTree': 'psmintervaltree',
+    'PsmKdTree': 'psmkdtree',
+    'PsmMultiIndexTree': 'psmmultiindextree',
+    'PsmPartitionedTree': 'psmpartitionedtree',
+    'PsmRangeTree': 'psmrangetree',
+    'PsmSortedList': 'psmsortedlist',
+    'PsmHashtable': 'psmsortedlist',
+}
+
+
+def _import_backend(module: str):
+    return import_module(f'arboretum.forest.{module}')
+
+
+def __getattr__(name: str):
+    if name in _BACKENDS:
+        return getattr(_import_backend(_BACKENDS[name]), name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+def _tree_type(tree_type: Union[TreeType, str]) -> TreeType:
+    if isinstance(tree_type, str):
+        tree_type = _TREE_TYPE_NAMES.get(tree_type, tree_type)
+    if tree_type not in _TREE_TYPES:
+        raise Exception("Tree type not supported")
+    return tree_type
+
+
+def psm_tree_class(tree_type: Union[TreeType, str]) -> Optional[type]:
+    """
+    the backend class of tree_type (None if it is not implemented), e.g. to check what a tree type supports
+    without constructing a tree
+    """
+    _, module, backend, _ = _TREE_TYPES[_tree_type(tree_type)]
+    return None if module is None else getattr(_import_backend(module), backend)
 
 
 # TreeType assignments corresponding to above
-def psm_tree_constructor(tree_type: Union[TreeType, str]):
-    if tree_type == TreeType.KD or tree_type == 'kd_tree':
-        # return PsmKdTree()
-        return NotImplementedError
-    elif tree_type == TreeType.BINARY or tree_type == 'binary':
-        return PsmBinaryTree()
-    elif tree_type == TreeType.AVL or tree_type == 'avl':
-        return PsmAvlTree()
-    elif tree_type == TreeType.RB or tree_type == 'rb':
-        return PsmRBTree()
-    elif tree_type == TreeType.FAST_BINARY or tree_type == 'fast_binary':
-        return PsmFastBinaryTree()
-    elif tree_type == TreeType.FAST_AVL or tree_type == 'fast_avl':
-        return PsmFastAVLTree()
-    elif tree_type == TreeType.FAST_RB or tree_type == 'fast_rb':
-        return PsmFastRBTree()
-    elif tree_type == TreeType.INTERVAL or tree_type == 'interval':
-        # return PsmIntervalTree()
+def psm_tree_constructor(tree_type: Union[TreeType, str], **options):
+    """
+    a new tree of tree_type. options override the backend's keyword arguments, e.g. the default tolerance
+    window of interval trees: psm_tree_constructor(TreeType.INTERVAL, ppm=10, rt_offset=30)
+    """
+    _, module, backend, kwargs = _TREE_TYPES[_tree_type(tree_type)]
+    if module is None:
         return NotImplementedError
-    elif tree_type == TreeType.SORTED_LIST or tree_type == 'sorted_list':
-        return PsmSortedList()
-    elif tree_type == TreeType.HASHTABLE or tree_type == 'hashtable':
-        return PsmHashtable()
-    elif tree_type == TreeType.HASHTABLE_MED or tree_type == 'hashtable_med':
-        return PsmHashtable(precision=3)
-    elif tree_type == TreeType.HASHTABLE_LARGE or tree_type == 'hashtable_large':
-        return PsmHashtable(precision=4)
-    else:
-        raise Exception("Tree type not supported")
\ No newline at end of file
+    return getattr(_import_backend(module), backend)(**{**kwargs, **options})
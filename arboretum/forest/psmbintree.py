@@ -1,13 +1,16 @@
+import sys
 from dataclasses import dataclass, field
 from typing import List
 
 from bintrees.abctree import update_queue
 
-from boundary import Boundary
-from forest.psmtree import PsmTree
-from psm import PSM
+from arboretum.boundary import Boundary
+from arboretum.forest.psmtree import PsmTree
+from arboretum.psm import PSM
 from bintrees import BinaryTree, FastBinaryTree, AVLTree, FastAVLTree, RBTree, FastRBTree
 
+sys.setrecursionlimit(10 ** 6)  # the pure-python bintrees recurse once per level of (unbalanced) tree depth
+
 
 @dataclass
 class PsmBinTree(PsmTree):
@@ -2,9 +2,9 @@ import math
 from dataclasses import dataclass, field
 from typing import List
 
-from boundary import Boundary
-from forest.psmtree import PsmTree
-from psm import PSM
+from arboretum.boundary import Boundary
+from arboretum.forest.psmtree import PsmTree
+from arboretum.psm import PSM
 
 
 def convert_to_int(mz:float, precision:int, floor=True):
@@ -1,47 +1,153 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, Tuple
 
-from intervaltree import IntervalTree
+import numpy as np
+from intervaltree import Interval, IntervalTree
 
-from boundary import Boundary
-from forest.psmtree import PsmTree
-from psm import PSM
+from arboretum.boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds
+from arboretum.forest.psmtree import PsmTree, _column
+from arboretum.psm import PSM
+
+if TYPE_CHECKING:
+    from arboretum.coalesce import Coalescing
+
+
+def _after(value: float) -> float:
+    """
+    the next float above value. Interval ends are exclusive, so windows are stored as [lower, _after(upper))
+    to keep both of their edges inclusive (and zero-width windows non-empty).
+    """
+    return float(np.nextafter(value, np.inf))
+
+
+@dataclass(eq=False)
+class IntervalEntry:
+    """
+    A psm stored with the tolerance window it was given when added.
+    Entries compare by identity, so identical psm's added twice are kept as two intervals.
+    """
+    __slots__ = "psm", "rt_boundary", "ook0_boundary"
+    psm: PSM
+    rt_boundary: Boundary
+    ook0_boundary: Boundary
+
+    def covers(self, rt: float, ook0: float) -> bool:
+        return self.rt_boundary.lower <= rt <= self.rt_boundary.upper and \
+               self.ook0_boundary.lower <= ook0 <= self.ook0_boundary.upper
 
 
 @dataclass
 class PsmIntervalTree(PsmTree):
     """
-    Standard Interval Tree. Performs O(n * log n).
+    Interval Tree. Each psm is stored with its own tolerance window (ppm, rt_offset & ook0_tolerance, taken from the
+    tree's defaults unless given to add), indexed on the window's mz interval.
+    stab() returns every psm whose window covers a point, which is the natural query for exclusion lists where
+    each entry carries its own tolerance. Boundary searches behave like every other tree type.
+    Text files only store the psm's, so windows are recreated from the tree defaults on load; pickles keep them.
     """
     tree: IntervalTree = field(default_factory=lambda: IntervalTree())
-    ppm: int = 50
+    ppm: float = 50
+    rt_offset: float = 100
+    ook0_tolerance: float = 0.05
 
     @staticmethod
     def order_psms(psms: List[PSM]) -> List[PSM]:
         return psms
 
-    def add(self, psm: PSM):
-        ppm_offset = psm.mz * self.ppm / 1_000_000
-        self.tree[psm.mz - ppm_offset:psm.mz + ppm_offset] = psm
+    def _interval(self, psm: PSM, ppm: Optional[float] = None, rt_offset: Optional[float] = None,
+                  ook0_tolerance: Optional[float] = None) -> Interval:
+        mz_bounds = get_mz_bounds(psm.mz, self.ppm if ppm is None else ppm)
+        entry = IntervalEntry(psm,
+                              get_rt_bounds(psm.rt, self.rt_offset if rt_offset is None else rt_offset),
+                              get_ook0_bounds(psm.ook0, self.ook0_tolerance if ook0_tolerance is None else ook0_tolerance))
+        return Interval(mz_bounds.lower, _after(mz_bounds.upper), entry)
+
+    def add(self, psm: PSM, ppm: Optional[float] = None, rt_offset: Optional[float] = None,
+            ook0_tolerance: Optional[float] = None):
+        self.tree.add(self._interval(psm, ppm, rt_offset, ook0_tolerance))
+
+    def update(self, psms: List[PSM], ppm: Optional[float] = None, rt_offset: Optional[float] = None,
+               ook0_tolerance: Optional[float] = None) -> None:
+        self.tree.update(self._interval(psm, ppm, rt_offset, ook0_tolerance) for psm in psms)
+
+    def coalesce(self, psm: PSM, coalescing: 'Coalescing', ppm: Optional[float] = None,
+                 rt_offset: Optional[float] = None, ook0_tolerance: Optional[float] = None
+                 ) -> Optional[Tuple[PSM, PSM]]:
+        """
+        as PsmTree.coalesce, but a merged entry keeps the window of the entry it replaces (merges keep the entry's
+        coordinates), and an added psm gets the window given
+        """
+        mz_bounds, rt_bounds, ook0_bounds = coalescing.boundaries(psm)
+        for interval in self.tree.overlap(mz_bounds.lower, _after(mz_bounds.upper)):
+            entry = interval.data.psm
+            if entry.in_boundary(mz_bounds, rt_bounds, ook0_bounds) and coalescing.matches(entry, psm):
+                merged = coalescing.merged(entry, psm)
+                self.tree.remove(interval)
+                self.tree.add(Interval(interval.begin, interval.end,
+                                       IntervalEntry(merged, interval.data.rt_boundary, interval.data.ook0_boundary)))
+                return entry, merged
+        self.add(psm, ppm, rt_offset, ook0_tolerance)
+        return None
 
     def remove(self, psm: PSM):
-        psms = [psm.data for psm in self.tree[psm.mz]]
-        psms.remove(psm)
+        for interval in self.tree.at(psm.mz):
+            if interval.data.psm == psm:
+                self.tree.remove(interval)
+                return
+        raise ValueError(f'psm not found: {psm}')
+
+    def remove_many(self, psms: Iterable[PSM]) -> int:
+        """
+        a removal only touches the intervals at the psm's mz, so removing one at a time beats a rebuild
+        """
+        return sum(self.discard(psm) for psm in psms)
+
+    def retain(self, predicate: Callable[[PSM], bool]) -> int:
+        """
+        filters the stored intervals directly, so every kept psm keeps its own tolerance window
+        """
+        size = len(self.tree)
+        self.tree = IntervalTree(interval for interval in self.tree if predicate(interval.data.psm))
+        return size - len(self.tree)
+
+    def recalibrate(self, shift: Callable[[np.ndarray, np.ndarray], np.ndarray]) -> int:
+        """
+        moves every interval with its psm, keeping its width, so each psm keeps its own tolerance window instead
+        of being given the tree's defaults by a rebuild
+        """
+        intervals = list(self.tree)
+        psms = [interval.data.psm for interval in intervals]
+        mzs = shift(_column(psms, 'mz'), _column(psms, 'rt')).tolist()
+        moved = []
+        for interval, psm, mz in zip(intervals, psms, mzs):
+            lower = interval.begin + (mz - psm.mz)
+            entry = IntervalEntry(PSM(psm.charge, mz, psm.rt, psm.ook0, psm.data), interval.data.rt_boundary,
+                                  interval.data.ook0_boundary)
+            moved.append(Interval(lower, max(interval.end + (mz - psm.mz), _after(lower)), entry))
+        self.tree = IntervalTree(moved)
+        return len(psms)
+
+    def stab(self, mz: float, rt: float, ook0: float) -> List[PSM]:
+        """
+        Returns every psm whose stored tolerance window covers the point (mz, rt, ook0)
+        """
+        return [interval.data.psm for interval in self.tree.at(mz) if interval.data.covers(rt, ook0)]
 
     def _search(self, mz_bounds: Boundary, rt_bounds: Boundary, ook0_bounds: Boundary):
-        psms = [interval.data for interval in self.tree[mz_bounds.lower:mz_bounds.upper+0.0001]]  # make inclusive
-        return [psm for psm in psms if psm.in_boundary(mz_bounds, rt_bounds, ook0_bounds)]
+        intervals = self.tree.overlap(mz_bounds.lower, _after(mz_bounds.upper))
+        return [interval.data.psm for interval in intervals
+                if interval.data.psm.in_boundary(mz_bounds, rt_bounds, ook0_bounds)]
 
     def get(self, mz: float, rt: float, ook0: float) -> List[PSM]:
-        psms = [interval.data for interval in self.tree[mz]]
-        if len(psms) > 0 and psms[0].mz == mz and psms[0].rt == rt and psms[0].ook0 == ook0:
-            return psms
-        else:
-            raise ValueError
+        psms = [interval.data.psm for interval in self.tree.at(mz)]
+        psms = [psm for psm in psms if psm.mz == mz and psm.rt == rt and psm.ook0 == ook0]
+        if not psms:
+            raise ValueError(f'no psm found with mz: {mz}, rt: {rt}, ook0: {ook0}')
+        return psms
 
     @property
     def psms(self) -> List[PSM]:
-        return [interval.data for interval in self.tree.items()]
+        return [interval.data.psm for interval in self.tree]
 
     def clear(self):
         self.tree.clear()
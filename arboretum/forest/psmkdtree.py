@@ -3,10 +3,10 @@ from typing import List
 
 from kdtree import KdTree
 
-from boundary import Boundary
-from forest.psmtree import PsmTree
-from point_util import Point
-from psm import PSM
+from arboretum.boundary import Boundary
+from arboretum.forest.psmtree import PsmTree
+from arboretum.point_util import Point
+from arboretum.psm import PSM
 
 # TODO: Fix kd-tree package to support deletion
 
@@ -1,11 +1,19 @@
+import math
+import pickle
 from bisect import bisect, bisect_left
 from collections import deque
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Tuple
 
-from boundary import Boundary, psm_attributes_in_bound
-from forest.psmtree import PsmTree
-from psm import PSM
+import numpy as np
+
+from arboretum.boundary import Boundary, psm_attributes_in_bound
+from arboretum.calibration import keeps_order
+from arboretum.forest.psmtree import PsmTree, _column
+from arboretum.kernel import in_bounds, in_bounds_batch
+from arboretum.psm import PSM
+
+BUFFER_SCALE = 2  # the buffer holds up to max(max_buffer_size, BUFFER_SCALE * sqrt(n)) psm's
 
 
 @dataclass
@@ -37,6 +45,26 @@ class PsmSortedList(PsmTree):
         del (self.tree[i])
         del (self.mz_list[i])
 
+    def rebuild(self, psms: List[PSM]) -> None:
+        self.tree = type(self.tree)(sorted(psms, key=lambda x: x.mz))
+        self.mz_list = type(self.mz_list)(psm.mz for psm in self.tree)
+
+    def recalibrate(self, shift) -> int:
+        """
+        when the shifted mz's keep their order, the psm's are replaced in place of the old ones without sorting
+        """
+        mzs = shift(np.asarray(self.mz_list, dtype=np.float64), _column(self.tree, 'rt'))
+        if not keeps_order(mzs):
+            return super().recalibrate(shift)
+        mzs = mzs.tolist()
+        self.tree = type(self.tree)(PSM(psm.charge, mz, psm.rt, psm.ook0, psm.data) for psm, mz in zip(self.tree, mzs))
+        self.mz_list = type(self.mz_list)(mzs)
+        return len(mzs)
+
+    def clear(self):
+        self.tree.clear()
+        self.mz_list.clear()
+
     def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
         start_i = bisect_left(self.mz_list, mz_boundary.lower)
         if start_i == len(self.mz_list):
@@ -61,6 +89,196 @@ class PsmSortedList(PsmTree):
         return self.tree
 
 
+def _object_array(psms: List[PSM]) -> np.ndarray:
+    array = np.empty(len(psms), dtype=object)
+    array[:] = psms
+    return array
+
+
+@dataclass
+class PsmBufferedSortedList(PsmTree):
+    """
+    A sorted list without the insert on every add: new psm's are appended to a small unsorted buffer (searched
+    linearly) and merged into the sorted arrays once it is full. The buffer grows with the tree: it holds
+    max_buffer_size psm's, or BUFFER_SCALE * sqrt(n) once that is larger.
+    The sorted part is columnar: psm's in an object array, with float64 mz, rt & ook0 columns alongside. A merge
+    inserts the whole (sorted) buffer into each array with one np.insert, so the arrays are copied once per merge
+    instead of once per add. Each merge copies all n elements, so an add costs O(sqrt(n)) amortized element
+    copies (memmoves, not python work), not O(log n). Searches bisect the mz column and filter the candidates'
+    columns with the compiled kernel (kernel.py): O(log n + k), plus a linear scan of the O(sqrt(n)) buffer.
+    Reads never change the tree, so they may run while a writer adds: a change builds new arrays and publishes
+    them, with the buffer, as one tuple (view) that reads take in a single attribute access.
+    """
+    tree: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=object))  # psm's in mz order
+    mzs: np.ndarray = field(default_factory=lambda: np.empty(0))
+    rts: np.ndarray = field(default_factory=lambda: np.empty(0))
+    ook0s: np.ndarray = field(default_factory=lambda: np.empty(0))
+    buffer: List[PSM] = field(default_factory=lambda: list())
+    max_buffer_size: int = 256
+    _view: tuple = field(default=None, repr=False, compare=False)  # (tree, mzs, rts, ook0s, buffer), see _publish
+
+    def __post_init__(self):
+        super().__post_init__()
+        self._publish(self.tree, self.mzs, self.rts, self.ook0s, self.buffer)
+
+    def _publish(self, tree: np.ndarray, mzs: np.ndarray, rts: np.ndarray, ook0s: np.ndarray, buffer: List[PSM]):
+        self.tree, self.mzs, self.rts, self.ook0s, self.buffer = tree, mzs, rts, ook0s, buffer
+        self._view = (tree, mzs, rts, ook0s, buffer)
+
+    @staticmethod
+    def order_psms(psms: List[PSM]) -> List[PSM]:
+        psms.sort(key=lambda x: x.mz)
+        return psms
+
+    def _buffer_limit(self) -> int:
+        return max(self.max_buffer_size, BUFFER_SCALE * math.isqrt(len(self.tree)))
+
+    def add(self, psm: PSM) -> None:
+        self.buffer.append(psm)
+        if len(self.buffer) >= self._buffer_limit():
+            self.merge()
+
+    def update(self, psms: List[PSM]) -> None:
+        self.buffer.extend(psms)
+        if len(self.buffer) >= self._buffer_limit():
+            self.merge()
+
+    def merge(self):
+        """
+        merges the buffer into the sorted arrays. Equal mz's keep their insertion order, as with add.
+        Only writers merge: the arrays are rebuilt, not changed, so reads in progress keep the view they took.
+        """
+        if not self.buffer:
+            return
+        buffer = sorted(self.buffer, key=lambda x: x.mz)
+        mzs = _column(buffer, 'mz')
+        positions = np.searchsorted(self.mzs, mzs, side='right')
+        self._publish(np.insert(self.tree, positions, _object_array(buffer)),
+                      np.insert(self.mzs, positions, mzs),
+                      np.insert(self.rts, positions, _column(buffer, 'rt')),
+                      np.insert(self.ook0s, positions, _column(buffer, 'ook0')), [])
+
+    def remove(self, psm: PSM):
+        for i, buffered in enumerate(self.buffer):
+            if buffered == psm:
+                self._publish(self.tree, self.mzs, self.rts, self.ook0s, self.buffer[:i] + self.buffer[i + 1:])
+                return
+        start, end = _range(self.mzs, psm.mz, psm.mz)
+        for i in range(start, end):
+            if self.tree[i] == psm:
+                self._publish(*[np.delete(array, i) for array in (self.tree, self.mzs, self.rts, self.ook0s)],
+                              self.buffer)
+                return
+        raise ValueError(f'psm not found: {psm}')
+
+    def rebuild(self, psms: List[PSM]) -> None:
+        psms = self.order_psms(list(psms))
+        self._publish(_object_array(psms), _column(psms, 'mz'), _column(psms, 'rt'), _column(psms, 'ook0'), [])
+
+    def recalibrate(self, shift) -> int:
+        """
+        shifts the mz column in one array operation. The rt & ook0 columns are kept as they are; when the shifted
+        mz's keep their order no column is sorted, otherwise all are permuted by one stable argsort
+        """
+        self.merge()
+        mzs = shift(self.mzs, self.rts)
+        psms = _object_array([PSM(psm.charge, mz, psm.rt, psm.ook0, psm.data)
+                              for psm, mz in zip(self.tree.tolist(), mzs.tolist())])
+        if keeps_order(mzs):
+            self._publish(psms, mzs, self.rts, self.ook0s, [])
+        else:
+            order = np.argsort(mzs, kind='stable')
+            self._publish(psms[order], mzs[order], self.rts[order], self.ook0s[order], [])
+        return len(psms)
+
+    def clear(self):
+        self.rebuild([])
+
+    def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        tree, mzs, rts, ook0s, buffer = self._view
+        start, end = _range(mzs, mz_boundary.lower, mz_boundary.upper)
+        res = []
+        if start < end:
+            indexes = in_bounds(mzs, rts, ook0s, start, end,
+                                float(mz_boundary.lower), float(mz_boundary.upper),
+                                float(rt_boundary.lower), float(rt_boundary.upper),
+                                float(ook0_boundary.lower), float(ook0_boundary.upper))
+            res = tree[indexes].tolist()
+        mz_lower, mz_upper = mz_boundary.lower, mz_boundary.upper
+        res.extend(psm for psm in list(buffer) if mz_lower <= psm.mz <= mz_upper and
+                   psm.in_boundary(mz_boundary, rt_boundary, ook0_boundary))
+        return res
+
+    def search_array(self, mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper) -> List[List[PSM]]:
+        """
+        filters the candidates of every query in one kernel call over the sorted arrays, and one over the
+        (sorted) buffer
+        """
+        tree, mzs, rts, ook0s, buffer = self._view
+        bounds = [np.asarray(values, dtype=np.float64)
+                  for values in (mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper)]
+        results = _batch(tree, mzs, rts, ook0s, bounds)
+        buffer = sorted(buffer, key=lambda x: x.mz)
+        if buffer:
+            buffered = _batch(_object_array(buffer), _column(buffer, 'mz'), _column(buffer, 'rt'),
+                              _column(buffer, 'ook0'), bounds)
+            for psms, buffered_psms in zip(results, buffered):
+                psms.extend(buffered_psms)
+        return results
+
+    def get(self, mz: float, rt: float, ook0: float) -> List[PSM]:
+        tree, mzs, _, _, buffer = self._view
+        start, end = _range(mzs, mz, mz)
+        psms = [psm for psm in tree[start:end].tolist() + list(buffer)
+                if psm.mz == mz and psm.rt == rt and psm.ook0 == ook0]
+        if not psms:
+            raise ValueError(f'no psm found with mz: {mz}, rt: {rt}, ook0: {ook0}')
+        return psms
+
+    @property
+    def psms(self) -> List[PSM]:
+        """
+        in mz order, buffered psm's after sorted ones of equal mz (as a merge would place them)
+        """
+        tree, _, _, _, buffer = self._view
+        psms = tree.tolist()
+        if buffer:
+            psms = sorted(psms + list(buffer), key=lambda x: x.mz)
+        return psms
+
+    def __len__(self) -> int:
+        tree, _, _, _, buffer = self._view
+        return len(tree) + len(buffer)
+
+    def to_pickle(self, file_name: str):
+        with open(file_name, "wb") as file:
+            pickle.dump(_object_array(self.psms), file, -1)  # the buffer too
+
+    def from_pickle(self, file_name: str):
+        super().from_pickle(file_name)
+        self.rebuild(self.tree.tolist())
+
+
+def _range(mzs: np.ndarray, lower: float, upper: float) -> Tuple[int, int]:
+    """
+    the index range of the sorted mz's with lower <= mz <= upper
+    """
+    return int(np.searchsorted(mzs, lower, side='left')), int(np.searchsorted(mzs, upper, side='right'))
+
+
+def _batch(tree: np.ndarray, mzs: np.ndarray, rts: np.ndarray, ook0s: np.ndarray,
+           bounds: List[np.ndarray]) -> List[List[PSM]]:
+    """
+    the psm's of mz-sorted columns inside each query's bounds, see kernel.in_bounds_batch
+    """
+    starts = np.searchsorted(mzs, bounds[0], side='left')
+    ends = np.searchsorted(mzs, bounds[1], side='right')
+    indexes, offsets = in_bounds_batch(mzs, rts, ook0s, starts, ends, *bounds)
+    psms = tree[indexes].tolist()
+    offsets = offsets.tolist()
+    return [psms[offsets[q]:offsets[q + 1]] for q in range(len(starts))]
+
+
 @dataclass
 class PsmSortedLinkedList(PsmSortedList):
     """
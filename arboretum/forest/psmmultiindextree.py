@@ -0,0 +1,118 @@
+from dataclasses import dataclass, field
+from operator import attrgetter
+from typing import Dict, List, Optional, Tuple
+
+from sortedcontainers import SortedKeyList
+
+from arboretum.boundary import Boundary
+from arboretum.forest.psmtree import PsmTree
+from arboretum.psm import PSM
+
+DIMENSIONS = ('mz', 'rt', 'ook0')
+
+
+def _index(dimension: str, psms=None) -> SortedKeyList:
+    return SortedKeyList(psms, key=attrgetter(dimension))
+
+
+@dataclass
+class QueryPlan:
+    dimension: str  # the index the search scans
+    candidates: Dict[str, int]  # per index: the psm's inside its dimension's range, i.e. what scanning it would cost
+    hits: Optional[int] = None  # psm's returned, set once the search has run
+
+
+@dataclass
+class PsmMultiIndexTree(PsmTree):
+    """
+    A sorted list of psm's by mz, plus secondary sorted lists of the same psm's by each dimension in secondary.
+    A search first counts the psm's inside each indexed dimension's range (two bisections per index) and scans
+    only the index with the fewest, so a narrow rt window under a wide ppm window is driven by rt.
+    explain() plans a search without running it; planned_search() runs one and returns its plan with the hits.
+    Every index costs a reference per psm and is updated on every add and remove.
+    """
+    tree: SortedKeyList = field(default_factory=lambda: _index('mz'))
+    secondary: Tuple[str, ...] = ('rt', 'ook0')
+    indexes: Dict[str, SortedKeyList] = field(default=None)  # dimension -> secondary index
+
+    def __post_init__(self):
+        if not set(self.secondary) <= set(DIMENSIONS[1:]):
+            raise ValueError(f'secondary indexes must be among {DIMENSIONS[1:]}')
+        if self.indexes is None:
+            self.indexes = {dimension: _index(dimension) for dimension in self.secondary}
+        super().__post_init__()
+
+    @staticmethod
+    def order_psms(psms: List[PSM]) -> List[PSM]:
+        psms.sort(key=lambda x: x.mz)
+        return psms
+
+    def add(self, psm: PSM) -> None:
+        self.tree.add(psm)
+        for index in self.indexes.values():
+            index.add(psm)
+
+    def update(self, psms: List[PSM]) -> None:
+        self.tree.update(psms)
+        for index in self.indexes.values():
+            index.update(psms)
+
+    def remove(self, psm: PSM) -> None:
+        self.tree.remove(psm)
+        for index in self.indexes.values():
+            index.remove(psm)
+
+    def rebuild(self, psms: List[PSM]) -> None:
+        self.tree = _index('mz', psms)
+        self.indexes = {dimension: _index(dimension, psms) for dimension in self.secondary}
+
+    def clear(self):
+        self.tree.clear()
+        for index in self.indexes.values():
+            index.clear()
+
+    def explain(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> QueryPlan:
+        """
+        the plan of a search over the given boundaries: the candidates in range of every index, and the index
+        with the fewest (mz on a tie)
+        """
+        boundaries = {'mz': mz_boundary, 'rt': rt_boundary, 'ook0': ook0_boundary}
+        candidates = {}
+        for dimension, index in [('mz', self.tree)] + list(self.indexes.items()):
+            boundary = boundaries[dimension]
+            candidates[dimension] = index.bisect_key_right(boundary.upper) - index.bisect_key_left(boundary.lower)
+        return QueryPlan(min(candidates, key=candidates.get), candidates)
+
+    def planned_search(self, mz_boundary: Boundary, rt_boundary: Boundary,
+                       ook0_boundary: Boundary) -> Tuple[List[PSM], QueryPlan]:
+        """
+        searches like search(), and also returns the plan it ran with hits set. The plan is not kept on the
+        tree, so concurrent searches never see each other's plans
+        """
+        plan = self.explain(mz_boundary, rt_boundary, ook0_boundary)
+        index = self.tree if plan.dimension == 'mz' else self.indexes[plan.dimension]
+        boundary = {'mz': mz_boundary, 'rt': rt_boundary, 'ook0': ook0_boundary}[plan.dimension]
+        res = [psm for psm in index.irange_key(boundary.lower, boundary.upper)
+               if psm.in_boundary(mz_boundary, rt_boundary, ook0_boundary)]
+        plan.hits = len(res)
+        return res, plan
+
+    def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        return self.planned_search(mz_boundary, rt_boundary, ook0_boundary)[0]
+
+    def get(self, mz: float, rt: float, ook0: float) -> List[PSM]:
+        psms = [psm for psm in self.tree.irange_key(mz, mz) if psm.rt == rt and psm.ook0 == ook0]
+        if not psms:
+            raise ValueError(f'no psm found with mz: {mz}, rt: {rt}, ook0: {ook0}')
+        return psms
+
+    @property
+    def psms(self) -> List[PSM]:
+        return list(self.tree)
+
+    def from_pickle(self, file_name: str):
+        """
+        only the mz index is pickled: the secondary indexes are built again from it
+        """
+        super().from_pickle(file_name)
+        self.rebuild(list(self.tree))
@@ -0,0 +1,239 @@
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from arboretum.boundary import Boundary
+from arboretum.forest.psmtree import PsmTree, _to_list
+from arboretum.psm import PSM
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+
+@dataclass
+class PsmPartitionedTree(PsmTree):
+    """
+    Splits the mz axis into contiguous segments, each an independent tree of the backend type (any name accepted by
+    psm_tree_constructor). Every operation only touches the segments overlapping its mz range, so their cost
+    follows the segment size rather than the size of the whole tree.
+    Segments are adaptive: one holding more than max_segment_size psm's is split at its median mz, and neighbours
+    that shrink to a quarter of max_segment_size between them are merged. With max_segment_size=None the segments
+    are fixed: pass their lower mz edges as mz_mins (the first must be -inf) and they are never rebalanced.
+    """
+    tree: List[PsmTree] = field(default_factory=list)
+    mz_mins: List[float] = field(default_factory=lambda: [float('-inf')])  # lowest mz each segment may hold
+    sizes: List[int] = field(default_factory=lambda: [0])  # psm's in each segment (some backends count in O(n))
+    backend: str = 'sorted_list'
+    max_segment_size: Optional[int] = 100_000
+
+    def __post_init__(self):
+        if len(self.tree) != len(self.mz_mins):
+            self.tree = [self._new_segment() for _ in self.mz_mins]
+        if len(self.sizes) != len(self.tree):
+            self.sizes = [len(segment) for segment in self.tree]
+        super().__post_init__()
+
+    @staticmethod
+    def order_psms(psms: List[PSM]) -> List[PSM]:
+        psms.sort(key=lambda x: x.mz)
+        return psms
+
+    def _new_segment(self, psms: Optional[List[PSM]] = None) -> PsmTree:
+        from arboretum.forest import psm_tree_constructor  # the package imports this module lazily
+        segment = psm_tree_constructor(self.backend)
+        if psms:
+            segment.rebuild(psms)
+        return segment
+
+    def _segment_index(self, mz: float) -> int:
+        return bisect_right(self.mz_mins, mz) - 1
+
+    def overlapping_segments(self, mz_boundary: Boundary) -> range:
+        """
+        the indexes of the segments a search over mz_boundary is dispatched to
+        """
+        return range(self._segment_index(mz_boundary.lower), self._segment_index(mz_boundary.upper) + 1)
+
+    @property
+    def segments(self) -> List[Tuple[float, float, PsmTree]]:
+        """
+        (mz_min, mz_max, tree) of every segment, mz_max exclusive. Each segment can be searched, saved or
+        loaded on its own.
+        """
+        mz_maxes = self.mz_mins[1:] + [float('inf')]
+        return list(zip(self.mz_mins, mz_maxes, self.tree))
+
+    def _split(self, i: int):
+        """
+        splits segment i at its median mz until no part holds more than max_segment_size psm's. Psm's sharing an
+        mz are never separated, so a segment of one repeated mz is left oversized.
+        """
+        psms = self.order_psms(self.tree[i].psms)
+        mzs = [psm.mz for psm in psms]
+        split_mz = mzs[len(mzs) // 2]
+        split = bisect_left(mzs, split_mz)
+        if split == 0:
+            split = bisect_right(mzs, split_mz)
+            if split == len(mzs):
+                return
+            split_mz = mzs[split]
+        self.tree[i:i + 1] = [self._new_segment(psms[:split]), self._new_segment(psms[split:])]
+        self.sizes[i:i + 1] = [split, len(psms) - split]
+        self.mz_mins.insert(i + 1, split_mz)
+        for j in (i + 1, i):
+            if self.sizes[j] > self.max_segment_size:
+                self._split(j)
+
+    def _merge(self, i: int):
+        """
+        merges segment i into its lower neighbour (or its upper one, for the first segment) when both are small
+        """
+        if len(self.tree) < 2:
+            return
+        if i == 0:
+            i = 1
+        if self.sizes[i - 1] + self.sizes[i] > self.max_segment_size // 4:
+            return
+        self.tree[i - 1:i + 1] = [self._new_segment(self.tree[i - 1].psms + self.tree[i].psms)]
+        self.sizes[i - 1:i + 1] = [self.sizes[i - 1] + self.sizes[i]]
+        del self.mz_mins[i]
+
+    def _rebalance(self, indexes: Iterable[int]):
+        if self.max_segment_size is None:
+            return
+        # highest index first, so splitting or merging a segment never shifts the ones still to be checked
+        for i in sorted(set(indexes), reverse=True):
+            if i >= len(self.tree):
+                continue
+            if self.sizes[i] > self.max_segment_size:
+                self._split(i)
+            else:
+                self._merge(i)
+
+    def _group(self, psms: Iterable[PSM]) -> dict:
+        groups = {}
+        for psm in psms:
+            groups.setdefault(self._segment_index(psm.mz), []).append(psm)
+        return groups
+
+    def add(self, psm: PSM) -> None:
+        i = self._segment_index(psm.mz)
+        self.tree[i].add(psm)
+        self.sizes[i] += 1
+        if self.max_segment_size is not None and self.sizes[i] > self.max_segment_size:
+            self._split(i)
+
+    def update(self, psms: List[PSM]) -> None:
+        if len(self) == 0 and self.max_segment_size is not None:
+            self.rebuild(psms)
+            return
+        groups = self._group(psms)
+        for i, group in groups.items():
+            segment = self.tree[i]
+            segment.update(segment.order_psms(group))
+            self.sizes[i] += len(group)
+        self._rebalance(groups)
+
+    def rebuild(self, psms: List[PSM]) -> None:
+        """
+        cuts the mz-sorted psm's straight into half-full segments (fixed segments are refilled in place)
+        """
+        if self.max_segment_size is None:
+            groups = self._group(psms)
+            self.tree = [self._new_segment(groups.get(i)) for i in range(len(self.mz_mins))]
+            self.sizes = [len(groups.get(i, [])) for i in range(len(self.mz_mins))]
+            return
+
+        psms = self.order_psms(list(psms))
+        step = max(1, self.max_segment_size // 2)
+        segments = [[]]
+        mz_mins = [float('-inf')]
+        for psm in psms:
+            if len(segments[-1]) >= step and psm.mz != segments[-1][-1].mz:
+                segments.append([])
+                mz_mins.append(psm.mz)
+            segments[-1].append(psm)
+        self.tree = [self._new_segment(segment) for segment in segments]
+        self.sizes = [len(segment) for segment in segments]
+        self.mz_mins = mz_mins
+
+    def remove(self, psm: PSM) -> None:
+        i = self._segment_index(psm.mz)
+        self.tree[i].remove(psm)
+        self.sizes[i] -= 1
+        self._rebalance([i])
+
+    def remove_many(self, psms: Iterable[PSM]) -> int:
+        groups = self._group(psms)
+        removed = 0
+        for i, group in groups.items():
+            count = self.tree[i].remove_many(group)
+            self.sizes[i] -= count
+            removed += count
+        self._rebalance(groups)
+        return removed
+
+    def retain(self, predicate: Callable[[PSM], bool]) -> int:
+        removed = 0
+        for i, segment in enumerate(self.tree):
+            count = segment.retain(predicate)
+            self.sizes[i] -= count
+            removed += count
+        self._rebalance(range(len(self.tree)))
+        return removed
+
+    def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        res = []
+        for i in self.overlapping_segments(mz_boundary):
+            res.extend(self.tree[i]._search(mz_boundary, rt_boundary, ook0_boundary))
+        return res
+
+    def search_array(self, mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper) -> List[List[PSM]]:
+        """
+        each segment receives a single batch holding every query that overlaps it
+        """
+        import numpy as np  # imported on use
+
+        columns = [np.asarray(_to_list(values), dtype=np.float64)
+                   for values in (mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper)]
+        firsts = np.searchsorted(self.mz_mins, columns[0], side='right') - 1
+        lasts = np.searchsorted(self.mz_mins, columns[1], side='right') - 1
+
+        results = [[] for _ in range(len(firsts))]
+        for i, segment in enumerate(self.tree):
+            queries = np.flatnonzero((firsts <= i) & (lasts >= i))
+            if len(queries) == 0 or self.sizes[i] == 0:
+                continue
+            for query, psms in zip(queries.tolist(), segment.search_array(*[column[queries] for column in columns])):
+                results[query].extend(psms)
+        return results
+
+    def get(self, mz: float, rt: float, ook0: float) -> List[PSM]:
+        return self.tree[self._segment_index(mz)].get(mz, rt, ook0)
+
+    @property
+    def psms(self) -> List[PSM]:
+        return [psm for segment in self.tree for psm in segment.psms]
+
+    def clear(self):
+        if self.max_segment_size is None:
+            for segment in self.tree:
+                segment.clear()
+            self.sizes = [0] * len(self.tree)
+        else:
+            self.tree = [self._new_segment()]
+            self.sizes = [0]
+            self.mz_mins = [float('-inf')]
+
+    def __len__(self) -> int:
+        return sum(self.sizes)
+
+    def to_pickle(self, file_name: str):
+        with open(file_name, "wb") as file:
+            pickle.dump((self.mz_mins, self.sizes, self.tree), file, -1)
+
+    def from_pickle(self, file_name: str):
+        with open(file_name, "rb") as file:
+            self.mz_mins, self.sizes, self.tree = pickle.load(file)
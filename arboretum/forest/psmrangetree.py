@@ -0,0 +1,160 @@
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Iterable, List
+
+from arboretum.boundary import Boundary
+from arboretum.forest.psmtree import PsmTree
+from arboretum.psm import PSM
+
+
+@dataclass
+class RangeBucket:
+    """
+    The psm's of one mz range of a PsmRangeTree, kept in rt order (rts holds the matching rt values).
+    """
+    __slots__ = "rts", "psms"
+    rts: List[float]
+    psms: List[PSM]
+
+    def insert(self, psm: PSM):
+        i = bisect_right(self.rts, psm.rt)
+        self.rts.insert(i, psm.rt)
+        self.psms.insert(i, psm)
+
+    @staticmethod
+    def build(psms: List[PSM]) -> 'RangeBucket':
+        psms = sorted(psms, key=lambda psm: psm.rt)
+        return RangeBucket([psm.rt for psm in psms], psms)
+
+
+@dataclass
+class PsmRangeTree(PsmTree):
+    """
+    Two-dimensional range tree over (mz, rt). The first level partitions mz into contiguous buckets of at most
+    bucket_size psm's (split as they fill); the second level keeps each bucket sorted by rt.
+    A search bisects to the buckets overlapping the mz window, then within each bucket bisects to the rt window.
+    Buckets lying wholly inside the mz window only examine psm's inside both ranges, but the two edge buckets
+    also examine their rt-matching psm's outside the mz window, up to two buckets of extra candidates per
+    search (mz and ook0 are the final filter). This is a bucketed approximation of a range tree: it keeps
+    O(n) memory and cheap adds where a true range tree's O(n log n) structure would not.
+    Narrow rt windows over long gradients therefore scan far fewer candidates than the mz-only tree types.
+    """
+    tree: List[RangeBucket] = field(default_factory=lambda: [RangeBucket([], [])])
+    mz_mins: List[float] = field(default_factory=lambda: [float('-inf')])  # lowest mz each bucket may hold
+    bucket_size: int = 256
+
+    @staticmethod
+    def order_psms(psms: List[PSM]) -> List[PSM]:
+        psms.sort(key=lambda x: x.mz)
+        return psms
+
+    def _bucket_index(self, mz: float) -> int:
+        return bisect_right(self.mz_mins, mz) - 1
+
+    def add(self, psm: PSM) -> None:
+        i = self._bucket_index(psm.mz)
+        bucket = self.tree[i]
+        bucket.insert(psm)
+        if len(bucket.psms) > self.bucket_size:
+            self._split(i)
+
+    def _split(self, i: int):
+        """
+        splits bucket i at its median mz. Psm's sharing an mz are never separated, so a bucket of one repeated
+        mz is left oversized.
+        """
+        psms = sorted(self.tree[i].psms, key=lambda psm: psm.mz)
+        mzs = [psm.mz for psm in psms]
+        split_mz = mzs[len(mzs) // 2]
+        split = bisect_left(mzs, split_mz)
+        if split == 0:
+            split = bisect_right(mzs, split_mz)
+            if split == len(mzs):
+                return
+            split_mz = mzs[split]
+        self.tree[i:i + 1] = [RangeBucket.build(psms[:split]), RangeBucket.build(psms[split:])]
+        self.mz_mins.insert(i + 1, split_mz)
+
+    def update(self, psms: List[PSM]) -> None:
+        if len(self) > 0:
+            for psm in psms:
+                self.add(psm)
+            return
+
+        # empty tree: cut the mz-sorted psm's straight into half-full buckets
+        psms = sorted(psms, key=lambda psm: psm.mz)
+        step = max(1, self.bucket_size // 2)
+        buckets = [[]]
+        mz_mins = [float('-inf')]
+        for psm in psms:
+            if len(buckets[-1]) >= step and psm.mz != buckets[-1][-1].mz:
+                buckets.append([])
+                mz_mins.append(psm.mz)
+            buckets[-1].append(psm)
+        self.tree = [RangeBucket.build(bucket) for bucket in buckets]
+        self.mz_mins = mz_mins
+
+    def _find(self, psm: PSM):
+        bucket_i = self._bucket_index(psm.mz)
+        bucket = self.tree[bucket_i]
+        for i in range(bisect_left(bucket.rts, psm.rt), bisect_right(bucket.rts, psm.rt)):
+            if bucket.psms[i] == psm:
+                return bucket_i, i
+        raise ValueError(f'psm not found: {psm}')
+
+    def remove(self, psm: PSM) -> None:
+        bucket_i, i = self._find(psm)
+        bucket = self.tree[bucket_i]
+        del bucket.rts[i]
+        del bucket.psms[i]
+        if not bucket.psms and len(self.tree) > 1:
+            del self.tree[bucket_i]
+            del self.mz_mins[bucket_i]
+            self.mz_mins[0] = float('-inf')
+
+    def remove_many(self, psms: Iterable[PSM]) -> int:
+        """
+        a removal only touches the psm's own bucket, so removing one at a time beats a rebuild
+        """
+        return sum(self.discard(psm) for psm in psms)
+
+    def candidates(self, mz_boundary: Boundary, rt_boundary: Boundary) -> int:
+        """
+        the number of psm's a search over these boundaries examines
+        """
+        count = 0
+        for i in range(self._bucket_index(mz_boundary.lower), self._bucket_index(mz_boundary.upper) + 1):
+            rts = self.tree[i].rts
+            count += max(0, bisect_right(rts, rt_boundary.upper) - bisect_left(rts, rt_boundary.lower))
+        return count
+
+    def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        res = []
+        for i in range(self._bucket_index(mz_boundary.lower), self._bucket_index(mz_boundary.upper) + 1):
+            bucket = self.tree[i]
+            start = bisect_left(bucket.rts, rt_boundary.lower)
+            end = bisect_right(bucket.rts, rt_boundary.upper)
+            for psm in bucket.psms[start:end]:
+                if mz_boundary.lower <= psm.mz <= mz_boundary.upper and \
+                        ook0_boundary.lower <= psm.ook0 <= ook0_boundary.upper:
+                    res.append(psm)
+        return res
+
+    def get(self, mz: float, rt: float, ook0: float) -> List[PSM]:
+        bucket = self.tree[self._bucket_index(mz)]
+        psms = [psm for psm in bucket.psms[bisect_left(bucket.rts, rt):bisect_right(bucket.rts, rt)]
+                if psm.mz == mz and psm.ook0 == ook0]
+        if not psms:
+            raise ValueError(f'no psm found with mz: {mz}, rt: {rt}, ook0: {ook0}')
+        return psms
+
+    @property
+    def psms(self) -> List[PSM]:
+        return [psm for bucket in self.tree for psm in bucket.psms]
+
+    def clear(self):
+        self.tree = [RangeBucket([], [])]
+        self.mz_mins = [float('-inf')]
+
+    def __len__(self) -> int:
+        return sum(len(bucket.psms) for bucket in self.tree)
@@ -1,12 +1,14 @@
 import math
 from dataclasses import dataclass, field
-from typing import List
+from typing import Iterable, List
 
 from sortedcontainers import SortedDict
 
-from boundary import Boundary
-from forest.psmtree import PsmTree
-from psm import PSM
+from arboretum.boundary import Boundary
+from arboretum.forest.psmtree import PsmTree, _column, _to_list
+from arboretum.psm import PSM
+
+BATCH_SEARCH_RATIO = 16  # batches of at least 1/16th of the tree's mz keys are searched with searchsorted
 
 
 @dataclass
@@ -28,6 +30,35 @@ class PsmSortedList(PsmTree):
             raise ValueError
         self.tree[psm.mz].remove(psm)
 
+    def rebuild(self, psms: List[PSM]) -> None:
+        tree = {}
+        for psm in psms:
+            tree.setdefault(psm.mz, []).append(psm)
+        self.tree = SortedDict(tree)
+
+    def remove_many(self, psms: Iterable[PSM]) -> int:
+        """
+        psm's are found by their mz key without searching, so removing them one at a time beats a rebuild
+        """
+        return _remove_keyed(self.tree, ((psm.mz, psm) for psm in psms))
+
+    def recalibrate(self, shift) -> int:
+        """
+        when the shifted mz's keep their order, the psm's are regrouped under their new mz keys in the order they
+        are already in, without sorting them again
+        """
+        from arboretum.calibration import keeps_order  # imported on use: pulls in numpy
+
+        psms = self.psms
+        mzs = shift(_column(psms, 'mz'), _column(psms, 'rt'))
+        if not keeps_order(mzs):
+            return super().recalibrate(shift)
+        tree = {}
+        for psm, mz in zip(psms, mzs.tolist()):
+            tree.setdefault(mz, []).append(PSM(psm.charge, mz, psm.rt, psm.ook0, psm.data))
+        self.tree = SortedDict(tree)  # keys arrive in order: a single pass
+        return len(psms)
+
     def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
         keys = self.tree.irange(mz_boundary.lower, mz_boundary.upper)
         psms = []
@@ -35,6 +66,25 @@ class PsmSortedList(PsmTree):
             psms.extend(self.tree[key])
         return [psm for psm in psms if psm.in_boundary(mz_boundary, rt_boundary, ook0_boundary)]
 
+    def search_array(self, mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper) -> List[List[PSM]]:
+        """
+        Large batches locate every query's mz range with a single searchsorted over the mz-ordered psm's, at the
+        one-off cost of flattening the tree. Small batches (relative to the tree) search query by query.
+        """
+        import numpy as np  # imported on use
+
+        mz_lower = np.asarray(mz_lower, dtype=np.float64)
+        if len(mz_lower) * BATCH_SEARCH_RATIO < len(self.tree):
+            return super().search_array(mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper)
+
+        psms = self.psms
+        mzs = np.fromiter((psm.mz for psm in psms), dtype=np.float64, count=len(psms))
+        starts = np.searchsorted(mzs, mz_lower, side='left').tolist()
+        ends = np.searchsorted(mzs, np.asarray(mz_upper, dtype=np.float64), side='right').tolist()
+        return [[psm for psm in psms[start:end] if rt_min <= psm.rt <= rt_max and ook0_min <= psm.ook0 <= ook0_max]
+                for start, end, rt_min, rt_max, ook0_min, ook0_max in
+                zip(starts, ends, _to_list(rt_lower), _to_list(rt_upper), _to_list(ook0_lower), _to_list(ook0_upper))]
+
     def get(self, mz: float, rt: float, ook0: float) -> List[PSM]:
         if mz not in self.tree:
             raise ValueError
@@ -52,6 +102,25 @@ class PsmSortedList(PsmTree):
         self.tree.clear()
 
 
+def _remove_keyed(tree: SortedDict, keyed_psms) -> int:
+    """
+    removes each (key, psm) from the list stored at key, dropping lists left empty. Returns the number removed
+    """
+    removed = 0
+    for key, psm in keyed_psms:
+        psms = tree.get(key)
+        if psms is None:
+            continue
+        try:
+            psms.remove(psm)
+        except ValueError:
+            continue
+        removed += 1
+        if not psms:
+            del tree[key]
+    return removed
+
+
 def convert_to_int(mz:float, precision:int, floor=True):
     if floor == True:
         return math.floor(round(mz, precision)*(10**precision))
@@ -80,6 +149,18 @@ class PsmHashtable(PsmTree):
             raise ValueError
         self.tree[key].remove(psm)
 
+    def rebuild(self, psms: List[PSM]) -> None:
+        tree = {}
+        for psm in psms:
+            tree.setdefault(convert_to_int(psm.mz, self.precision), []).append(psm)
+        self.tree = SortedDict(tree)
+
+    def remove_many(self, psms: Iterable[PSM]) -> int:
+        """
+        psm's are found by their hash key without searching, so removing them one at a time beats a rebuild
+        """
+        return _remove_keyed(self.tree, ((convert_to_int(psm.mz, self.precision), psm) for psm in psms))
+
     def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
         lower_key = convert_to_int(mz_boundary.lower, self.precision)
         upper_key = convert_to_int(mz_boundary.upper, self.precision, floor=False)
@@ -1,9 +1,18 @@
-from abc import ABC, abstractmethod
+from abc import ABC, ABCMeta, abstractmethod
+from copy import deepcopy
 from dataclasses import dataclass
-from typing import Any, Union, List
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Iterable, Optional, Tuple, Union, List
 
-from boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds
-from psm import PSM
+from arboretum.boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds, get_mz_bounds_array, \
+    get_rt_bounds_array, get_ook0_bounds_array
+from arboretum.memory import MemoryUsage, measure
+from arboretum.psm import PSM
+from arboretum.tracing import COUNTS, Tracer, traced
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    from arboretum.coalesce import Coalescing
 
 try:
     import cPickle as pickle
@@ -11,13 +20,55 @@ except:
     import pickle
 
 
+def _as_boundary(boundary: Union[Boundary, List[float]]) -> Boundary:
+    if isinstance(boundary, Boundary):
+        return boundary
+    if len(boundary) != 2:
+        raise ValueError('Incorrect boundary arguments. Boundary should contain two items: [lower, upper]')
+    return Boundary(boundary[0], boundary[1])
+
+
+def _column(psms: List[PSM], attribute: str) -> 'np.ndarray':
+    import numpy as np  # imported on use: pulls in numpy
+
+    return np.fromiter((getattr(psm, attribute) for psm in psms), dtype=np.float64, count=len(psms))
+
+
+def _to_list(values) -> list:
+    return values.tolist() if hasattr(values, 'tolist') else list(values)
+
+
+_tracing = False  # whether the operations of every tree type are wrapped, i.e. some tree type has a tracer
+
+
+class _TracedTreeType(ABCMeta):
+    """
+    Setting tracer on any tree type wraps the traced operations of every tree type, and clearing the last tracer
+    unwraps them again, so untraced trees call their operations directly.
+    """
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+        if name == 'tracer':
+            _retrace()
+
+
 @dataclass
-class PsmTree(ABC):
+class PsmTree(ABC, metaclass=_TracedTreeType):
     """
     The abstract schematic of a tree that each of our tree types should follow, even when they are not true trees.
     """
     tree: Any
     __psms: Union[List[PSM], None] = None
+    tracer: ClassVar[Optional[Tracer]] = None  # when set, every tree reports its operations (see tracing.py)
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        while a tracer is set, wraps each traced operation a new tree type defines, so that overrides are reported
+        like the base methods
+        """
+        super().__init_subclass__(**kwargs)
+        if _tracing:
+            _trace_operations(cls)
 
     def __post_init__(self):
         if self.__psms:
@@ -43,14 +94,36 @@ class PsmTree(ABC):
         ook0_bounds = get_ook0_bounds(ook0, ook0_tolerance)
         return self._search(mz_bounds, rt_bounds, ook0_bounds)
 
-    def search(self, mz_boundary: List[float], rt_boundary: List[float], ook0_boundary: List[float]) -> List[PSM]:
+    def search(self, mz_boundary: Union[Boundary, List[float]], rt_boundary: Union[Boundary, List[float]],
+               ook0_boundary: Union[Boundary, List[float]]) -> List[PSM]:
+        """
+        searches the tree over the given boundaries, each either a Boundary or a [lower, upper] list
+        """
+        return self._search(_as_boundary(mz_boundary), _as_boundary(rt_boundary), _as_boundary(ook0_boundary))
 
-        if len(mz_boundary) != 2 or len(rt_boundary) != 2 or len(ook0_boundary) != 2:
-            raise ValueError('Incorrect boundary arguments. Boundary should contain two items: [lower, upper]')
+    def search_array(self, mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper) -> List[List[PSM]]:
+        """
+        batch search: query i is bounded by the i-th element of each array (numpy arrays or lists), such as the
+        arrays returned by boundary.get_mz_bounds_array etc. Returns one list of psm's per query.
+        No objects are created per query: the same three Boundary objects are refilled for each one.
+        """
+        mz_boundary, rt_boundary, ook0_boundary = Boundary(0.0, 0.0), Boundary(0.0, 0.0), Boundary(0.0, 0.0)
+        results = []
+        for bounds in zip(*[_to_list(values) for values in (mz_lower, mz_upper, rt_lower, rt_upper,
+                                                            ook0_lower, ook0_upper)]):
+            mz_boundary.lower, mz_boundary.upper, rt_boundary.lower, rt_boundary.upper, \
+                ook0_boundary.lower, ook0_boundary.upper = bounds
+            results.append(self._search(mz_boundary, rt_boundary, ook0_boundary))
+        return results
 
-        return self._search(Boundary(mz_boundary[0], mz_boundary[1]),
-                     Boundary(rt_boundary[0], rt_boundary[1]),
-                     Boundary(ook0_boundary[0], ook0_boundary[1]))
+    def tsearch_array(self, mz, rt, ook0, ppm: float, rt_offset: float, ook0_tolerance: float) -> List[List[PSM]]:
+        """
+        tolerance search over arrays of query values, see search_array.
+        """
+        mz_lower, mz_upper = get_mz_bounds_array(mz, ppm)
+        rt_lower, rt_upper = get_rt_bounds_array(rt, rt_offset)
+        ook0_lower, ook0_upper = get_ook0_bounds_array(ook0, ook0_tolerance)
+        return self.search_array(mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper)
 
     @abstractmethod
     def _search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
@@ -80,6 +153,21 @@ class PsmTree(ABC):
         for psm in psms:
             self.add(psm)
 
+    def coalesce(self, psm: PSM, coalescing: 'Coalescing') -> Optional[Tuple[PSM, PSM]]:
+        """
+        adds psm, unless an entry within coalescing's epsilons is the same identification: that entry is then
+        replaced by its merge with psm (see coalesce.py). Returns the replaced entry and its merge if psm was
+        coalesced, None if psm was added
+        """
+        for entry in self._search(*coalescing.boundaries(psm)):
+            if coalescing.matches(entry, psm):
+                merged = coalescing.merged(entry, psm)
+                self.remove(entry)
+                self.add(merged)
+                return entry, merged
+        self.add(psm)
+        return None
+
     @abstractmethod
     def remove(self, psm: PSM) -> None:
         """
@@ -97,6 +185,60 @@ class PsmTree(ABC):
             return False
         return True
 
+    def rebuild(self, psms: List[PSM]) -> None:
+        """
+        replaces the contents of the tree with psms, in a single bulk build
+        """
+        self.clear()
+        self.update(self.order_psms(list(psms)))
+
+    def retain(self, predicate: Callable[[PSM], bool]) -> int:
+        """
+        keeps only the psm's for which predicate is true, filtering and rebuilding the tree in one pass.
+        Returns the number of psm's removed
+        """
+        psms = self.psms
+        kept = [psm for psm in psms if predicate(psm)]
+        removed = len(psms) - len(kept)
+        if removed:
+            self.rebuild(kept)
+        return removed
+
+    def remove_many(self, psms: Iterable[PSM]) -> int:
+        """
+        removes every given psm (each one once) in a single pass over the tree. Psm's not in the tree are ignored.
+        Returns the number of psm's removed
+        """
+        targets = {}
+        for psm in psms:
+            targets.setdefault((psm.mz, psm.rt, psm.ook0), []).append(psm)
+
+        def keep(psm: PSM) -> bool:
+            matches = targets.get((psm.mz, psm.rt, psm.ook0))
+            if matches:
+                for i, target in enumerate(matches):
+                    if target == psm:
+                        del matches[i]
+                        return False
+            return True
+
+        return self.retain(keep) if targets else 0
+
+    def recalibrate(self, shift: Callable[['np.ndarray', 'np.ndarray'], 'np.ndarray']) -> int:
+        """
+        moves every psm to the mz given by shift(mzs, rts), applied to the arrays of all the psm's mz's & rt's at
+        once (see calibration.mz_shift). The psm's are replaced, not changed (snapshots share them), and the tree
+        is rebuilt once. Returns the number of psm's moved
+        """
+        psms = self.psms
+        mzs = shift(_column(psms, 'mz'), _column(psms, 'rt')).tolist()
+        if psms:
+            self.rebuild([PSM(psm.charge, mz, psm.rt, psm.ook0, psm.data) for psm, mz in zip(psms, mzs)])
+        return len(psms)
+
+    def clear(self):
+        self.tree.clear()
+
     @property
     @abstractmethod
     def psms(self) -> List[PSM]:
@@ -111,21 +253,39 @@ class PsmTree(ABC):
         """
         return len(self.tree)
 
-    def save(self, file_name: str, as_pickle: bool = False):
+    def memory_usage(self) -> MemoryUsage:
+        """
+        deep size in bytes of the tree, split into its index structure, the psm objects and their payloads
+        """
+        return measure(self, self.psms)
+
+    def copy(self) -> 'PsmTree':
         """
-        loads psms to file: either pkl or txt
+        returns a new tree of the same type. The containers are copied but the psm objects are shared,
+        so either tree can be changed without affecting the other (used for copy-on-write snapshots).
+        """
+        memo = {id(psm): psm for psm in self.psms}
+        return deepcopy(self, memo)
+
+    def save(self, file_name: str, as_pickle: bool = False, as_blocks: bool = False):
+        """
+        saves psms to file: either pkl, compressed blocks (blk) or txt
         """
         if as_pickle:
             self.to_pickle(file_name)
+        elif as_blocks:
+            self.to_blocks(file_name)
         else:
             self.to_file(file_name)
 
-    def load(self, file_name: str, as_pickle: bool = False):
+    def load(self, file_name: str, as_pickle: bool = False, as_blocks: bool = False):
         """
-        loads psms from file: either pkl or txt
+        loads psms from file: either pkl, compressed blocks (blk) or txt
         """
         if as_pickle:
             self.from_pickle(file_name)
+        elif as_blocks:
+            self.from_blocks(file_name)
         else:
             self.from_file(file_name)
 
@@ -138,8 +298,11 @@ class PsmTree(ABC):
             self.tree = pickle.load(file)
 
     def to_file(self, file_name: str):
+        """
+        writes one psm per line, in mz order (so saved trees can be merged as streams, see merge.py)
+        """
         with open(file_name, "w") as file:
-            for psm in self.psms:
+            for psm in sorted(self.psms, key=lambda psm: psm.mz):
                 file.write(psm.serialize())
 
     def from_file(self, file_name: str):
@@ -149,3 +312,46 @@ class PsmTree(ABC):
                 psms.append(PSM.deserialize(line))
         psms = self.order_psms(psms)
         self.update(psms)
+
+    def to_blocks(self, file_name: str):
+        from arboretum.blockfile import write_blocks  # imported on use: pulls in numpy
+        write_blocks(file_name, sorted(self.psms, key=lambda psm: psm.mz))
+
+    def from_blocks(self, file_name: str):
+        from arboretum.blockfile import BlockFile  # imported on use: pulls in numpy
+        psms = self.order_psms(BlockFile(file_name).psms)
+        self.update(psms)
+
+
+def _trace_operations(cls: type):
+    for operation in COUNTS:
+        method = cls.__dict__.get(operation)
+        if callable(method) and not hasattr(method, 'traced'):
+            wrapper = traced(operation)(method)
+            wrapper.untraced = method
+            setattr(cls, operation, wrapper)
+
+
+def _untrace_operations(cls: type):
+    for operation in COUNTS:
+        method = cls.__dict__.get(operation)
+        if hasattr(method, 'untraced'):
+            setattr(cls, operation, method.untraced)
+
+
+def _tree_types(cls: type = PsmTree) -> set:
+    tree_types = {cls}
+    for subclass in cls.__subclasses__():
+        tree_types |= _tree_types(subclass)
+    return tree_types
+
+
+def _retrace():
+    global _tracing
+    tree_types = _tree_types()
+    _tracing = any(tree_type.tracer is not None for tree_type in tree_types)
+    for tree_type in tree_types:
+        if _tracing:
+            _trace_operations(tree_type)
+        else:
+            _untrace_operations(tree_type)
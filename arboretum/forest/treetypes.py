@@ -15,3 +15,7 @@ class TreeType(Enum):
     BINARY = auto()
     AVL = auto()
     RB = auto()
+    RANGE = auto()
+    PARTITIONED = auto()
+    BUFFERED_SORTED_LIST = auto()
+    MULTI_INDEX = auto()
@@ -0,0 +1,146 @@
+"""
+-------------- Ingest --------------
+Streams search-engine PSM records (one JSON
+object per line) into an Arborist without
+building an intermediate list of every PSM.
+Records are mapped to PSM's using the keys
+in constants.py; all other keys become data.
+Parquet files (see arrow.py) are streamed a
+record batch at a time.
+------------------------------------
+"""
+
+import json
+import os
+import sys
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import IO, Iterable, Iterator, List, Union
+
+from arboretum.constants import PSM_CHARGE_KEY, PSM_MZ_KEY, PSM_OOK0_KEY, PSM_RT_KEY
+from arboretum.psm import PSM
+
+JSONL_EXTENSIONS = ('.jsonl', '.json')
+PARQUET_EXTENSION = '.parquet'
+
+_END = object()  # marks the end of the stream on the ingest queue
+
+
+def read_psm_records(source: Union[str, IO]) -> Iterator[dict]:
+    """
+    Yields one record (dict) per non-empty line of a JSONL source.
+    source can be a file path, a directory (every .jsonl / .json file within, in name order),
+    '-' for stdin, or an already open text file object.
+    """
+    if not isinstance(source, str):
+        yield from _read_lines(source)
+    elif source == '-':
+        yield from _read_lines(sys.stdin)
+    elif os.path.isdir(source):
+        for file in sorted(os.listdir(source)):
+            if os.path.splitext(file)[1] in JSONL_EXTENSIONS:
+                yield from read_psm_records(os.path.join(source, file))
+    else:
+        with open(source, "r") as file:
+            yield from _read_lines(file)
+
+
+def _read_lines(file: IO) -> Iterator[dict]:
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def record_to_psm(record: dict) -> PSM:
+    """
+    Maps a search-engine record to a PSM. Raises KeyError if one of the required keys is missing.
+    """
+    data = {key: value for key, value in record.items()
+            if key not in (PSM_CHARGE_KEY, PSM_MZ_KEY, PSM_RT_KEY, PSM_OOK0_KEY)}
+    return PSM(charge=int(record[PSM_CHARGE_KEY]),
+               mz=float(record[PSM_MZ_KEY]),
+               rt=float(record[PSM_RT_KEY]),
+               ook0=float(record[PSM_OOK0_KEY]),
+               data=data)
+
+
+def read_psms(source: Union[str, IO]) -> Iterator[PSM]:
+    """
+    Yields a PSM for every record in the source (see read_psm_records)
+    """
+    for record in read_psm_records(source):
+        yield record_to_psm(record)
+
+
+def batch_psms(psms: Iterable[PSM], batch_size: int) -> Iterator[List[PSM]]:
+    """
+    Groups a stream of psms into lists of at most batch_size psms
+    """
+    batch = []
+    for psm in psms:
+        batch.append(psm)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest(arborist, source: Union[str, IO, Iterable[PSM]], batch_size: int = 10_000,
+           max_pending_batches: int = 4) -> int:
+    """
+    Streams psms from source into the arborist in batches, using PSMArborist.update.
+    source is anything read_psms accepts, a parquet file written by arrow.write_parquet, or an iterable of PSM's.
+    Parsing runs on a reader thread and hands batches over through a bounded queue: once max_pending_batches
+    are waiting, the reader blocks until the arborist catches up (backpressure), so at most
+    (max_pending_batches + 2) * batch_size psms are held in memory at any time.
+    If the arborist raises, the reader is stopped and the error re-raised.
+    Returns the number of psms added.
+    """
+    if batch_size < 1 or max_pending_batches < 1:
+        raise ValueError('batch_size and max_pending_batches must be at least 1')
+
+    if isinstance(source, str) and source.endswith(PARQUET_EXTENSION):
+        from arboretum.arrow import read_parquet  # imported on use: pyarrow is optional
+        psms = read_parquet(source, batch_size=batch_size)
+    else:
+        psms = read_psms(source) if isinstance(source, str) or hasattr(source, 'read') else source
+    queue = Queue(maxsize=max_pending_batches)
+    stop = Event()  # set when the consumer gives up, so a reader blocked on a full queue returns
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for batch in batch_psms(psms, batch_size):
+                if not put(batch):
+                    return
+            put(_END)
+        except BaseException as e:  # hand the error to the consuming thread
+            put(e)
+
+    thread = Thread(target=reader, daemon=True)
+    thread.start()
+
+    count = 0
+    try:
+        while True:
+            batch = queue.get()
+            if batch is _END:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+            arborist.update(batch)
+            count += len(batch)
+    finally:
+        stop.set()
+        thread.join()
+    return count
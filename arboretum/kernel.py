@@ -0,0 +1,94 @@
+"""
+-------------- Kernel --------------
+Filters coordinate arrays (mz, rt, ook0
+columns) against search bounds: the inner
+loop of every search, run once per candidate.
+Compiled with numba when it is installed
+(compiled once and cached on disk next to
+this module, so later processes load the
+compiled kernel); otherwise the same filters
+run as numpy masks. Both return the indexes of
+the matching candidates, in order.
+------------------------------------
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _in_bounds_numpy(mzs: np.ndarray, rts: np.ndarray, ook0s: np.ndarray, start: int, end: int,
+                     mz_lower: float, mz_upper: float, rt_lower: float, rt_upper: float,
+                     ook0_lower: float, ook0_upper: float) -> np.ndarray:
+    mzs, rts, ook0s = mzs[start:end], rts[start:end], ook0s[start:end]
+    mask = (mzs >= mz_lower) & (mzs <= mz_upper) & (rts >= rt_lower) & (rts <= rt_upper) & \
+           (ook0s >= ook0_lower) & (ook0s <= ook0_upper)
+    return np.flatnonzero(mask) + start
+
+
+def _in_bounds_batch_numpy(mzs: np.ndarray, rts: np.ndarray, ook0s: np.ndarray, starts: np.ndarray,
+                           ends: np.ndarray, mz_lower: np.ndarray, mz_upper: np.ndarray, rt_lower: np.ndarray,
+                           rt_upper: np.ndarray, ook0_lower: np.ndarray,
+                           ook0_upper: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    matches = []
+    for q in range(len(starts)):
+        found = _in_bounds_numpy(mzs, rts, ook0s, starts[q], ends[q], mz_lower[q], mz_upper[q],
+                                 rt_lower[q], rt_upper[q], ook0_lower[q], ook0_upper[q])
+        matches.append(found)
+        offsets[q + 1] = offsets[q] + len(found)
+    indexes = np.concatenate(matches) if matches else np.zeros(0, dtype=np.int64)
+    return indexes, offsets
+
+
+def _in_bounds_loop(mzs, rts, ook0s, start, end, mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper):
+    """
+    indexes i in [start, end) whose (mzs[i], rts[i], ook0s[i]) lie inside every bound (inclusive)
+    """
+    indexes = np.empty(max(end - start, 0), dtype=np.int64)
+    count = 0
+    for i in range(start, end):
+        if mz_lower <= mzs[i] <= mz_upper and rt_lower <= rts[i] <= rt_upper and \
+                ook0_lower <= ook0s[i] <= ook0_upper:
+            indexes[count] = i
+            count += 1
+    return indexes[:count]
+
+
+def _in_bounds_batch_loop(mzs, rts, ook0s, starts, ends, mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower,
+                          ook0_upper):
+    """
+    in_bounds for many queries: query q scans [starts[q], ends[q]) against the q-th bounds.
+    Returns (indexes, offsets): the matches of query q are indexes[offsets[q]:offsets[q + 1]]
+    """
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    for q in range(len(starts)):  # first pass: count, to size the output
+        count = 0
+        for i in range(starts[q], ends[q]):
+            if mz_lower[q] <= mzs[i] <= mz_upper[q] and rt_lower[q] <= rts[i] <= rt_upper[q] and \
+                    ook0_lower[q] <= ook0s[i] <= ook0_upper[q]:
+                count += 1
+        offsets[q + 1] = offsets[q] + count
+    indexes = np.empty(offsets[-1], dtype=np.int64)
+    for q in range(len(starts)):
+        count = offsets[q]
+        for i in range(starts[q], ends[q]):
+            if mz_lower[q] <= mzs[i] <= mz_upper[q] and rt_lower[q] <= rts[i] <= rt_upper[q] and \
+                    ook0_lower[q] <= ook0s[i] <= ook0_upper[q]:
+                indexes[count] = i
+                count += 1
+    return indexes, offsets
+
+
+if HAS_NUMBA:
+    in_bounds = njit(nogil=True, cache=True)(_in_bounds_loop)
+    in_bounds_batch = njit(nogil=True, cache=True)(_in_bounds_batch_loop)
+else:
+    in_bounds = _in_bounds_numpy
+    in_bounds_batch = _in_bounds_batch_numpy
@@ -0,0 +1,82 @@
+"""
+-------------- Memory --------------
+Deep memory accounting of trees. Every
+object reachable from a tree is counted
+once, in one of three parts:
+    payloads : the psm data dicts
+    psms     : the PSM objects (and their values)
+    index    : everything else, i.e. the
+               tree type's own structure
+Objects a C extension does not expose to
+the garbage collector (e.g. the nodes of the
+Fast* bintrees) are not reachable, so their
+structure is under-counted.
+------------------------------------
+"""
+
+import gc
+import sys
+from dataclasses import dataclass
+from types import BuiltinFunctionType, FunctionType, ModuleType
+from typing import Iterable, Set
+
+from arboretum.psm import PSM
+
+# shared by every tree, so never attributed to one
+_SHARED_TYPES = (type, ModuleType, FunctionType, BuiltinFunctionType)
+
+
+@dataclass
+class MemoryUsage:
+    """
+    deep sizes in bytes
+    """
+    index: int = 0
+    psms: int = 0
+    payloads: int = 0
+    count: int = 0  # number of psm's measured
+
+    @property
+    def total(self) -> int:
+        return self.index + self.psms + self.payloads
+
+    @property
+    def per_psm(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def __add__(self, other: 'MemoryUsage') -> 'MemoryUsage':
+        return MemoryUsage(self.index + other.index, self.psms + other.psms, self.payloads + other.payloads,
+                           self.count + other.count)
+
+
+def deep_sizeof(obj, seen: Set[int]) -> int:
+    """
+    sys.getsizeof of obj and of everything it references that is not already in seen (ids).
+    Every object counted is added to seen, so sharing seen between calls counts each object once.
+    """
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def measure(container, psms: Iterable[PSM]) -> MemoryUsage:
+    """
+    splits the deep size of container (a tree, holding psms) into payloads, psm's and index
+    """
+    seen = set()
+    usage = MemoryUsage()
+    psms = list(psms)
+    for psm in psms:
+        usage.payloads += deep_sizeof(psm.data, seen)
+    for psm in psms:
+        usage.psms += deep_sizeof(psm, seen)
+    usage.index = deep_sizeof(container, seen)
+    usage.count = len(psms)
+    return usage
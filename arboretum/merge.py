@@ -0,0 +1,143 @@
+"""
+-------------- Merge --------------
+Combines saved arborists (directories of
+[charge].txt / .blk / .pkl tree files) into
+one saved arborist without loading them:
+per charge, the mz-ordered files are read
+as streams and k-way merged (heapq.merge)
+straight into the output file, so only one
+psm per input file (one block for .blk) is
+held in memory at a time.
+A file found out of mz order (e.g. saved by
+a tree type that does not keep mz order) is
+sorted into a temporary block file on its
+own and the charge is merged again.
+-----------------------------------
+"""
+
+import heapq
+import os
+import shutil
+import tempfile
+from operator import attrgetter
+from typing import Dict, Iterable, Iterator, List, Union
+
+from arboretum.arborist import BLOCK_FILE_EXTENSION, PICKLE_FILE_EXTENSION, TEXT_FILE_EXTENSION, tree_files
+from arboretum.forest import TreeType, psm_tree_constructor
+from arboretum.psm import PSM
+
+
+class UnsortedFileError(ValueError):
+    def __init__(self, file_name: str):
+        super().__init__(f'{file_name} is not in mz order')
+        self.file_name = file_name
+
+
+def iter_tree_file(file_name: str, tree_type: Union[TreeType, str] = TreeType.SORTED_LIST) -> Iterator[PSM]:
+    """
+    yields the psms of a saved tree file in file order. Text and block files are streamed; pickles are
+    loaded whole, as a tree of tree_type (the type they were saved from).
+    """
+    if file_name.endswith(BLOCK_FILE_EXTENSION):
+        from arboretum.blockfile import BlockFile  # imported on use: pulls in numpy
+        yield from BlockFile(file_name).iter_psms()
+    elif file_name.endswith(PICKLE_FILE_EXTENSION):
+        tree = psm_tree_constructor(tree_type)
+        tree.load(file_name, as_pickle=True)
+        yield from tree.psms
+    else:
+        with open(file_name, "r") as file:
+            for line in file:
+                yield PSM.deserialize(line)
+
+
+def _mz_ordered(psms: Iterable[PSM], file_name: str) -> Iterator[PSM]:
+    """
+    passes psms through, raising UnsortedFileError at the first one out of mz order
+    """
+    last_mz = float('-inf')
+    for psm in psms:
+        if psm.mz < last_mz:
+            raise UnsortedFileError(file_name)
+        last_mz = psm.mz
+        yield psm
+
+
+def dedup_psms(psms: Iterable[PSM]) -> Iterator[PSM]:
+    """
+    drops repeats of equal psm's from an mz-ordered stream. Equal psm's share their mz, so only the psm's of the
+    current mz are remembered.
+    """
+    group_mz = None
+    group = []
+    for psm in psms:
+        if psm.mz != group_mz:
+            group_mz = psm.mz
+            group = []
+        elif psm in group:
+            continue
+        group.append(psm)
+        yield psm
+
+
+def _write(file_name: str, psms: Iterable[PSM]) -> int:
+    if file_name.endswith(BLOCK_FILE_EXTENSION):
+        from arboretum.blockfile import write_blocks  # imported on use: pulls in numpy
+        return write_blocks(file_name, psms)
+    count = 0
+    with open(file_name, "w") as file:
+        for psm in psms:
+            file.write(psm.serialize())
+            count += 1
+    return count
+
+
+def _sorted_copy(file_name: str, tree_type: Union[TreeType, str], directory: str) -> str:
+    from arboretum.blockfile import write_blocks  # imported on use: pulls in numpy
+    psms = sorted(iter_tree_file(file_name, tree_type), key=attrgetter('mz'))
+    copy_name = os.path.join(directory, f'{len(os.listdir(directory))}{BLOCK_FILE_EXTENSION}')
+    write_blocks(copy_name, psms)
+    return copy_name
+
+
+def merge_files(file_names: List[str], out_file: str, dedup: bool = False,
+                tree_type: Union[TreeType, str] = TreeType.SORTED_LIST) -> int:
+    """
+    k-way merges tree files (of one charge) into out_file, a text or block file by its extension.
+    Returns the number of psms written.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        sorted_copies = {}
+        while True:
+            streams = [_mz_ordered(iter_tree_file(sorted_copies.get(file_name, file_name), tree_type), file_name)
+                       for file_name in file_names]
+            psms = heapq.merge(*streams, key=attrgetter('mz'))
+            try:
+                return _write(out_file, dedup_psms(psms) if dedup else psms)
+            except UnsortedFileError as e:
+                sorted_copies[e.file_name] = _sorted_copy(e.file_name, tree_type, directory)
+
+
+def merge(directories: List[str], out_directory: str, dedup: bool = False, compressed: bool = False,
+          tree_type: Union[TreeType, str] = TreeType.SORTED_LIST) -> Dict[int, int]:
+    """
+    Merges saved arborists into a new one at out_directory (replaced if it exists), one charge at a time.
+    compressed writes block files ([charge].blk) instead of text. dedup keeps one of each set of equal psm's.
+    tree_type is only needed to read pickled trees. Returns the number of psms written per charge.
+    """
+    out_directory = os.path.abspath(out_directory)
+    if any(os.path.abspath(directory) == out_directory for directory in directories):
+        raise ValueError('out_directory cannot be one of the merged directories')
+
+    charge_files = {}
+    for directory in directories:
+        for charge, file_name in tree_files(directory).items():
+            charge_files.setdefault(charge, []).append(file_name)
+
+    if os.path.exists(out_directory):
+        shutil.rmtree(out_directory)
+    os.makedirs(out_directory)
+
+    extension = BLOCK_FILE_EXTENSION if compressed else TEXT_FILE_EXTENSION
+    return {charge: merge_files(file_names, os.path.join(out_directory, f'{charge}{extension}'), dedup, tree_type)
+            for charge, file_names in sorted(charge_files.items())}
@@ -0,0 +1,84 @@
+"""
+-------------- Neutral Mass --------------
+One index over the PSM's of every charge,
+ordered by neutral mass:
+    mass = (mz - proton mass) * charge
+so a peptide seen at several charge states
+is found with a single range scan instead
+of one search per charge tree. Set
+arborist.neutral_mass_index and query with
+PSMArborist.search_mass; a precursor mz is
+converted with neutral_mass(mz, charge).
+The index is built from every tree on its
+first query, then kept up to date by adds &
+removes. It holds a reference to every PSM.
+PSM's with a charge below 1 have no neutral
+mass and are left out.
+------------------------------------------
+"""
+
+from dataclasses import dataclass, field
+from operator import itemgetter
+from typing import Iterable, List, Optional
+
+from sortedcontainers import SortedKeyList
+
+from arboretum.boundary import Boundary
+from arboretum.constants import PROTON_MASS
+from arboretum.psm import PSM
+
+
+def neutral_mass(mz: float, charge: int) -> float:
+    return (mz - PROTON_MASS) * charge
+
+
+def mz_of(mass: float, charge: int) -> float:
+    """
+    the mz of an ion of neutral mass at charge
+    """
+    return mass / charge + PROTON_MASS
+
+
+@dataclass
+class NeutralMassIndex:
+    index: Optional[SortedKeyList] = field(default=None, repr=False)  # (neutral mass, psm), None until built
+
+    @property
+    def built(self) -> bool:
+        return self.index is not None
+
+    def build(self, psms: Iterable[PSM]):
+        self.index = SortedKeyList(((neutral_mass(psm.mz, psm.charge), psm) for psm in psms if psm.charge > 0),
+                                   key=itemgetter(0))
+
+    def add(self, psm: PSM):
+        if self.index is not None and psm.charge > 0:
+            self.index.add((neutral_mass(psm.mz, psm.charge), psm))
+
+    def remove(self, psm: PSM):
+        if self.index is not None and psm.charge > 0:
+            self.index.discard((neutral_mass(psm.mz, psm.charge), psm))
+
+    def replace(self, entry: PSM, merged: PSM):
+        """
+        swaps a coalesced entry for its merge
+        """
+        self.remove(entry)
+        self.add(merged)
+
+    def invalidate(self):
+        """
+        drops the index, to be built again on its next query (e.g. after a bulk remove)
+        """
+        self.index = None
+
+    def search(self, mass_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        """
+        the psm's of any charge inside the boundaries, in neutral mass order
+        """
+        return [psm for _, psm in self.index.irange_key(mass_boundary.lower, mass_boundary.upper)
+                if rt_boundary.lower <= psm.rt <= rt_boundary.upper and
+                ook0_boundary.lower <= psm.ook0 <= ook0_boundary.upper]
+
+    def __len__(self):
+        return 0 if self.index is None else len(self.index)
@@ -0,0 +1,139 @@
+"""
+-------------- Occupancy --------------
+A coarse map of where a tree has PSM's,
+checked before searching it. (mz, rt) space
+is cut into cells of mz_cell by rt_cell and
+each charge's grid counts the PSM's in every
+occupied cell, so adds and removes keep it
+exact. A search window touching no occupied
+cell cannot match anything and is answered
+without walking the tree; windows that do
+touch one are searched as usual.
+Only occupied cells are stored (a dict of
+mz cell -> rt cell -> count), and a window
+is checked against the occupied cells or the
+cells it spans, whichever are fewer.
+---------------------------------------
+"""
+
+import math
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterable
+
+from arboretum.boundary import Boundary
+from arboretum.psm import PSM
+
+if TYPE_CHECKING:
+    from arboretum.forest import PsmTree
+
+
+def _cells(counts: dict, boundary: Boundary, size: float) -> Iterable[int]:
+    """
+    the keys of counts (cell numbers) whose cells overlap the boundary
+    """
+    lower, upper = boundary.lower / size, boundary.upper / size
+    if upper - lower < len(counts):
+        first, last = math.floor(lower), math.floor(upper)
+        if first == last:  # the usual narrow window
+            return (first,) if first in counts else ()
+        return [cell for cell in range(first, last + 1) if cell in counts]
+    return [cell for cell in counts if cell <= upper and cell + 1 > lower]
+
+
+@dataclass
+class OccupancyGrid:
+    mz_cell: float = 0.05
+    rt_cell: float = 10.0
+    cells: Dict[int, Counter] = field(default_factory=dict)  # mz cell -> rt cell -> psm's
+
+    def add(self, psm: PSM):
+        rt_counts = self.cells.setdefault(math.floor(psm.mz / self.mz_cell), Counter())
+        rt_counts[math.floor(psm.rt / self.rt_cell)] += 1
+
+    def update(self, psms: Iterable[PSM]):
+        for psm in psms:
+            self.add(psm)
+
+    def remove(self, psm: PSM):
+        mz_cell = math.floor(psm.mz / self.mz_cell)
+        rt_cell = math.floor(psm.rt / self.rt_cell)
+        rt_counts = self.cells.get(mz_cell)
+        if not rt_counts or not rt_counts[rt_cell]:
+            return
+        rt_counts[rt_cell] -= 1
+        if not rt_counts[rt_cell]:
+            del rt_counts[rt_cell]
+            if not rt_counts:
+                del self.cells[mz_cell]
+
+    def occupied(self, mz_boundary: Boundary, rt_boundary: Boundary) -> bool:
+        """
+        false if no psm can lie inside both boundaries
+        """
+        for mz_cell in _cells(self.cells, mz_boundary, self.mz_cell):
+            if _cells(self.cells[mz_cell], rt_boundary, self.rt_cell):
+                return True
+        return False
+
+    def __len__(self):
+        """
+        occupied cells
+        """
+        return sum(len(rt_counts) for rt_counts in self.cells.values())
+
+
+@dataclass
+class Prefilter:
+    """
+    the occupancy grids of an Arborist's charges (set arborist.prefilter = Prefilter()), with the count of
+    queries they answered. A grid is built from its tree on the first search of the charge after it was
+    created or invalidated (e.g. by a bulk remove), then kept up to date by adds & removes.
+    """
+    mz_cell: float = 0.05
+    rt_cell: float = 10.0
+    grids: Dict[int, OccupancyGrid] = field(default_factory=dict)
+    queries: int = 0  # searches checked against a grid
+    rejected: int = 0  # of which answered empty without a search
+    empty: int = 0  # of which searched and found nothing (the grid's false positives)
+
+    def grid(self, charge: int, tree: 'PsmTree') -> OccupancyGrid:
+        """
+        the grid of charge, built from the psm's of tree (the charge's tree) if there is none
+        """
+        grid = self.grids.get(charge)
+        if grid is None:
+            grid = self.grids[charge] = OccupancyGrid(self.mz_cell, self.rt_cell)
+            grid.update(tree.psms)
+        return grid
+
+    def add(self, psm: PSM):
+        grid = self.grids.get(psm.charge)
+        if grid is not None:
+            grid.add(psm)
+
+    def remove(self, psm: PSM):
+        grid = self.grids.get(psm.charge)
+        if grid is not None:
+            grid.remove(psm)
+
+    def invalidate(self, charge: int = None):
+        """
+        drops the grid of charge (of every charge if None), to be built again on its next search
+        """
+        if charge is None:
+            self.grids.clear()
+        else:
+            self.grids.pop(charge, None)
+
+    def stats(self) -> dict:
+        """
+        hit rate: the share of checked queries answered by the grid alone.
+        false positive rate: the share of queries the grid passed that found nothing.
+        """
+        passed = self.queries - self.rejected
+        return {'queries': self.queries,
+                'rejected': self.rejected,
+                'hit_rate': self.rejected / self.queries if self.queries else 0.0,
+                'false_positive_rate': self.empty / passed if passed else 0.0,
+                'cells': {charge: len(grid) for charge, grid in self.grids.items()}}
@@ -1,7 +1,7 @@
 import ast
 from dataclasses import dataclass
 
-from boundary import Boundary
+from arboretum.boundary import Boundary
 
 
 @dataclass
@@ -33,7 +33,7 @@ class PSM:
 
     @staticmethod
     def deserialize(line: str) -> 'PSM':
-        line_elems = line.rstrip().split(",")
+        line_elems = line.rstrip().split(",", 4)  # the data repr holds commas of its own
         psm = PSM(charge=int(line_elems[0]),
                   mz=float(line_elems[1]),
                   rt=float(line_elems[2]),
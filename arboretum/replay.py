@@ -0,0 +1,273 @@
+"""
+-------------- Replay --------------
+Captures the operations an Arborist really
+receives and replays them against any tree
+type. Set arborist.recorder = Recorder(file)
+and every add, update, remove, remove_many,
+retain, recalibrate, load, search and
+search_array is appended to the trace, with
+its arguments and the time it was called.
+Changes are recorded once they succeed.
+retain is recorded with the psm's it removed
+(its predicate cannot be saved) and replayed
+as a retain of every other psm; recalibrate
+with a correction function (rather than
+polynomial coefficients) and load, whose
+directory must still exist for a replay,
+cannot always be reproduced: a correction
+function is recorded as a marker and not
+replayed.
+replay() runs a trace on a new Arborist, at
+the recorded pace, faster, or flat out, and
+reports throughput and latency percentiles
+per operation (see trace_replay.py).
+
+Trace file (little-endian, gzip'd if the name
+ends with .gz):
+    header : magic, format version, start time
+    record : operation, seconds since start,
+             operation arguments
+------------------------------------
+"""
+
+import ast
+import gzip
+import math
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import IO, Dict, Iterator, List, Optional, Tuple, Union
+
+from arboretum.forest import TreeType
+from arboretum.psm import PSM
+
+MAGIC = b'ARBR'
+FORMAT_VERSION = 1
+
+ADD, UPDATE, REMOVE, SEARCH, SEARCH_ARRAY, REMOVE_MANY, RETAIN, RECALIBRATE, LOAD = range(9)
+OPERATIONS = {ADD: 'add', UPDATE: 'update', REMOVE: 'remove', SEARCH: 'search', SEARCH_ARRAY: 'search_array',
+              REMOVE_MANY: 'remove_many', RETAIN: 'retain', RECALIBRATE: 'recalibrate', LOAD: 'load'}
+
+_HEADER = struct.Struct('<4sId')
+_RECORD = struct.Struct('<Bd')  # operation, seconds since start
+_PSM = struct.Struct('<idddI')  # charge, mz, rt, ook0, data size
+_SEARCH = struct.Struct('<idddddd')  # charge, mz, rt, ook0, ppm, rt_offset, ook0_tolerance
+_COUNT = struct.Struct('<I')
+_TOLERANCES = struct.Struct('<ddd')  # ppm, rt_offset, ook0_tolerance
+
+
+def _open(file_name: str, mode: str) -> IO:
+    return gzip.open(file_name, mode) if file_name.endswith('.gz') else open(file_name, mode)
+
+
+def _pack_psm(psm: PSM) -> bytes:
+    data = repr(psm.data).encode('utf-8')
+    return _PSM.pack(psm.charge, psm.mz, psm.rt, psm.ook0, len(data)) + data
+
+
+def _pack_psms(psms: List[PSM]) -> bytes:
+    return _COUNT.pack(len(psms)) + b''.join(_pack_psm(psm) for psm in psms)
+
+
+def _key(psm: PSM) -> tuple:
+    return psm.charge, psm.mz, psm.rt, psm.ook0, repr(psm.data)
+
+
+class Recorder:
+    """
+    appends the operations of an Arborist to a trace file. Safe to share between threads.
+    """
+
+    def __init__(self, file_name: str):
+        self.file = _open(file_name, "wb")
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, self.start))
+
+    def _write(self, operation: int, body: bytes):
+        record = _RECORD.pack(operation, time.perf_counter() - self._start) + body
+        with self._lock:
+            self.file.write(record)
+
+    def add(self, psm: PSM):
+        self._write(ADD, _pack_psm(psm))
+
+    def update(self, psms: List[PSM]):
+        self._write(UPDATE, _pack_psms(psms))
+
+    def remove(self, psm: PSM):
+        self._write(REMOVE, _pack_psm(psm))
+
+    def remove_many(self, psms: List[PSM]):
+        self._write(REMOVE_MANY, _pack_psms(psms))
+
+    def retain(self, removed: List[PSM]):
+        """
+        removed: the psm's the retain removed
+        """
+        self._write(RETAIN, _pack_psms(removed))
+
+    def recalibrate(self, coefficients: Optional[List[float]]):
+        """
+        coefficients: those of a polynomial correction, None for a correction function (recorded as a marker)
+        """
+        coefficients = coefficients or []
+        self._write(RECALIBRATE, _COUNT.pack(len(coefficients)) + struct.pack(f'<{len(coefficients)}d',
+                                                                               *coefficients))
+
+    def load(self, directory: str, lazy: bool):
+        path = str(directory).encode('utf-8')
+        self._write(LOAD, _COUNT.pack(len(path)) + path + struct.pack('<?', lazy))
+
+    def search(self, charge: int, mz: float, rt: float, ook0: float, ppm: float, rt_offset: float,
+               ook0_tolerance: float):
+        self._write(SEARCH, _SEARCH.pack(charge, mz, rt, ook0, ppm, rt_offset, ook0_tolerance))
+
+    def search_array(self, charge, mz, rt, ook0, ppm: float, rt_offset: float, ook0_tolerance: float):
+        mz, rt, ook0 = [float(value) for value in mz], [float(value) for value in rt], [float(value) for value in ook0]
+        count = len(mz)
+        charges = [int(value) for value in charge] if hasattr(charge, '__len__') else [int(charge)] * count
+        self._write(SEARCH_ARRAY, _COUNT.pack(count) + _TOLERANCES.pack(ppm, rt_offset, ook0_tolerance) +
+                    struct.pack(f'<{count}i{3 * count}d', *charges, *mz, *rt, *ook0))
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _read(file: IO, size: int) -> bytes:
+    buffer = file.read(size)
+    if len(buffer) != size:
+        raise ValueError('truncated trace record')
+    return buffer
+
+
+def _read_psm(file: IO) -> PSM:
+    charge, mz, rt, ook0, size = _PSM.unpack(_read(file, _PSM.size))
+    return PSM(charge, mz, rt, ook0, ast.literal_eval(_read(file, size).decode('utf-8')))
+
+
+def _read_count(file: IO) -> int:
+    return _COUNT.unpack(_read(file, _COUNT.size))[0]
+
+
+def read_trace(file_name: str) -> Iterator[Tuple[float, int, tuple]]:
+    """
+    yields (seconds since start, operation, arguments) for every record of a trace, where the arguments are
+    those of the PSMArborist method: add is given its PSM and update a list of PSM's. retain is given the list
+    of PSM's it removed, and recalibrate its polynomial coefficients (an empty list for a correction function)
+    """
+    with _open(file_name, "rb") as file:
+        magic, version, _ = _HEADER.unpack(_read(file, _HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'{file_name} is not a trace file (version {FORMAT_VERSION})')
+        while True:
+            header = file.read(_RECORD.size)
+            if not header:
+                return
+            operation, timestamp = _RECORD.unpack(header)
+            if operation in (ADD, REMOVE):
+                args = (_read_psm(file),)
+            elif operation in (UPDATE, REMOVE_MANY, RETAIN):
+                args = ([_read_psm(file) for _ in range(_read_count(file))],)
+            elif operation == SEARCH:
+                args = _SEARCH.unpack(_read(file, _SEARCH.size))
+            elif operation == SEARCH_ARRAY:
+                count = _COUNT.unpack(_read(file, _COUNT.size))[0]
+                tolerances = _TOLERANCES.unpack(_read(file, _TOLERANCES.size))
+                values = struct.unpack(f'<{count}i{3 * count}d', _read(file, 28 * count))
+                args = (list(values[:count]), list(values[count:2 * count]), list(values[2 * count:3 * count]),
+                        list(values[3 * count:])) + tolerances
+            elif operation == RECALIBRATE:
+                count = _read_count(file)
+                args = (list(struct.unpack(f'<{count}d', _read(file, 8 * count))),)
+            elif operation == LOAD:
+                directory = _read(file, _read_count(file)).decode('utf-8')
+                args = (directory,) + struct.unpack('<?', _read(file, 1))
+            else:
+                raise ValueError(f'unknown trace operation {operation}')
+            yield timestamp, operation, args
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    """
+    nearest-rank percentile of sorted values
+    """
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+@dataclass
+class ReplayReport:
+    tree_type: str
+    duration: float = 0.0  # wall clock seconds of the whole replay
+    lag: float = 0.0  # at a set speed, the most an operation started after its scheduled time
+    latencies: Dict[str, List[float]] = field(default_factory=dict)  # operation -> seconds per call, in call order
+    sizes: Dict[int, int] = field(default_factory=dict)  # psm's per charge at the end, as arborist.sizes
+
+    @property
+    def operations(self) -> int:
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    @property
+    def throughput(self) -> float:
+        """
+        operations per second spent in the arborist (reading the trace & waiting for the schedule excluded)
+        """
+        busy = sum(sum(latencies) for latencies in self.latencies.values())
+        return self.operations / busy if busy else 0.0
+
+    def percentiles(self, operation: str, percents=(50, 90, 99, 99.9)) -> Dict[float, float]:
+        latencies = sorted(self.latencies.get(operation, []))
+        return {percent: _percentile(latencies, percent) for percent in percents} if latencies else {}
+
+
+def replay(file_name: str, tree_type: Union[TreeType, str] = TreeType.SORTED_LIST,
+           speed: Optional[float] = None) -> ReplayReport:
+    """
+    Runs a trace on a new Arborist of tree_type. With speed, operations start at their recorded times divided by
+    speed (1.0 is the recorded pace, 10.0 ten times faster); without, one after the other as fast as possible.
+    The trace is read as it is replayed, so it may be larger than memory.
+    """
+    from arboretum.arborist import PSMArborist  # imported on use: the arborist imports this module
+
+    arborist = PSMArborist(tree_type)
+
+    def retain(removed: List[PSM]):
+        keys = {_key(psm) for psm in removed}
+        arborist.retain(lambda psm: _key(psm) not in keys)
+
+    methods = {ADD: lambda psm: arborist.add(psm.charge, psm.mz, psm.rt, psm.ook0, psm.data),
+               UPDATE: arborist.update,
+               REMOVE: lambda psm: arborist.remove(psm.charge, psm.mz, psm.rt, psm.ook0, psm.data),
+               SEARCH: arborist.search,
+               SEARCH_ARRAY: arborist.search_array,
+               REMOVE_MANY: arborist.remove_many,
+               RETAIN: retain,
+               RECALIBRATE: lambda coefficients: arborist.recalibrate(coefficients) if coefficients else None,
+               LOAD: lambda directory, lazy: arborist.load(directory, lazy=lazy)}
+    report = ReplayReport(tree_type.name.lower() if isinstance(tree_type, TreeType) else tree_type,
+                          latencies={name: [] for name in OPERATIONS.values()})
+
+    start = time.perf_counter()
+    for timestamp, operation, args in read_trace(file_name):
+        if speed is not None:
+            delay = start + timestamp / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                report.lag = max(report.lag, -delay)
+        operation_start = time.perf_counter()
+        methods[operation](*args)
+        report.latencies[OPERATIONS[operation]].append(time.perf_counter() - operation_start)
+    report.duration = time.perf_counter() - start
+    report.sizes = arborist.sizes
+    report.latencies = {name: latencies for name, latencies in report.latencies.items() if latencies}
+    return report
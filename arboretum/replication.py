@@ -0,0 +1,343 @@
+"""
+-------------- Replication --------------
+Keeps replica arborists (e.g. on an analysis
+machine) in step with a primary without full
+save / load cycles. The primary's
+ReplicationLog keeps the adds & removes of
+its recent versions; a replica asks for the
+changes since the version it has and applies
+them in batches. A replica that is too far
+behind (the log was trimmed, or reset by a
+retain, load or recalibrate), or that follows
+a different primary, gets a full snapshot.
+Changes travel over a socket
+(ReplicationServer, Replica.connect) or as
+files dropped in a shared directory
+(FileDrop, Replica.apply_directory).
+Replicas should be made with the primary's
+coalescing, so adds are folded the same way.
+
+Message (little-endian, PSM's as in replay.py):
+    header : magic, kind (delta or snapshot),
+             primary id, from version,
+             to version, record count
+    delta record : operation, version, PSM
+                   (add, remove) or count &
+                   PSM's (update, remove_many)
+    snapshot record : PSM
+Request: magic, primary id, version.
+-----------------------------------------
+"""
+
+import os
+import socket
+import socketserver
+import struct
+import threading
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import IO, TYPE_CHECKING, Callable, Deque, List, Optional, Tuple, Union
+
+from arboretum.psm import PSM
+from arboretum.replay import ADD, REMOVE, REMOVE_MANY, UPDATE, _pack_psm, _pack_psms, _read, _read_psm
+
+if TYPE_CHECKING:
+    from arboretum.arborist import PSMArborist
+
+MAGIC = b'ARBD'
+DELTA, SNAPSHOT = range(2)
+DELTA_EXTENSION = '.delta'
+SNAPSHOT_EXTENSION = '.snapshot'
+
+_HEADER = struct.Struct('<4sB16sqqI')  # magic, kind, primary id, from version, to version, records
+_RECORD = struct.Struct('<Bq')  # operation, version
+_REQUEST = struct.Struct('<4s16sq')  # magic, primary id, version
+_COUNT = struct.Struct('<I')
+_NO_PRIMARY = bytes(16)
+
+
+@dataclass
+class ReplicationLog:
+    """
+    the changes of a primary arborist (set arborist.replication = ReplicationLog()), as
+    (version, operation, psm's) in version order. Every version from start + 1 on is in the log, until more than
+    max_psms psm's are held and the oldest changes are dropped.
+    """
+    max_psms: int = 1_000_000
+    id: bytes = field(default_factory=lambda: uuid.uuid4().bytes)  # tells the logs of different primaries apart
+    start: Optional[int] = None  # the oldest version a replica can catch up from, None before the first change
+    entries: Deque[Tuple[int, int, List[PSM]]] = field(default_factory=deque, repr=False)
+    psms: int = 0
+
+    def record(self, version: int, operation: int, psms: List[PSM]):
+        """
+        called by the arborist, with its lock held, for every change it makes
+        """
+        if self.start is None:
+            self.start = version - 1
+        self.entries.append((version, operation, psms))
+        self.psms += len(psms)
+        while self.psms > self.max_psms and self.entries:
+            self.start, _, dropped = self.entries.popleft()
+            self.psms -= len(dropped)
+
+    def reset(self, version: int):
+        """
+        called for changes that cannot be replayed (retain, load, recalibrate): replicas behind version need a
+        snapshot
+        """
+        self.entries.clear()
+        self.psms = 0
+        self.start = version
+
+    def since(self, version: int, current: int) -> Optional[List[Tuple[int, int, List[PSM]]]]:
+        """
+        the changes after version, given the arborist's current version, or None if the log cannot provide them
+        """
+        if version == current:
+            return []
+        if self.start is None or not self.start <= version < current:
+            return None
+        return [entry for entry in self.entries if entry[0] > version]
+
+
+def changes(arborist: 'PSMArborist', primary: bytes = _NO_PRIMARY, version: int = -1) -> bytes:
+    """
+    the message bringing a replica of primary at version up to date with arborist: a delta when the arborist's
+    replication log covers it, a snapshot otherwise
+    """
+    log = arborist.replication
+    with arborist._lock:
+        current = arborist.version
+        entries = log.since(version, current) if primary == log.id else None
+    if entries is not None:
+        body = b''.join(_RECORD.pack(operation, entry_version) +
+                        (_pack_psm(psms[0]) if operation in (ADD, REMOVE) else _pack_psms(psms))
+                        for entry_version, operation, psms in entries)
+        to_version = entries[-1][0] if entries else version
+        return _HEADER.pack(MAGIC, DELTA, log.id, version, to_version, len(entries)) + body
+    snapshot = arborist.snapshot()
+    psms = [psm for tree in snapshot.trees.values() for psm in tree.psms]
+    return _HEADER.pack(MAGIC, SNAPSHOT, log.id, -1, snapshot.version, len(psms)) + \
+        b''.join(_pack_psm(psm) for psm in psms)
+
+
+class Replica:
+    """
+    a copy of a primary arborist. Search self.arborist (a snapshot replaces it with a new arborist, made by
+    factory, so keep the replica rather than the arborist).
+    version is the primary's version the replica has reached (-1 before its first snapshot).
+    """
+
+    def __init__(self, factory: Callable[[], 'PSMArborist'] = None):
+        from arboretum.arborist import PSMArborist  # imported on use: the arborist imports this module
+
+        self.factory = factory or PSMArborist
+        self.arborist = self.factory()
+        self.primary = _NO_PRIMARY
+        self.version = -1
+        self._socket = None
+        self._file = None
+
+    def apply(self, file: IO) -> bool:
+        """
+        reads one message from file and applies it. A delta that does not start at the replica's version (or
+        comes from another primary) is ignored. Consecutive adds are applied as one update and consecutive
+        removes as one remove_many. Returns true if the message was applied.
+        """
+        magic, kind, primary, from_version, to_version, count = _HEADER.unpack(_read(file, _HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('not a replication message')
+        if kind == SNAPSHOT:
+            arborist = self.factory()
+            arborist.update([_read_psm(file) for _ in range(count)])
+            self.arborist = arborist
+        elif primary != self.primary or from_version != self.version:
+            return False
+        else:
+            run, removing = [], False
+            for _ in range(count):
+                operation, _ = _RECORD.unpack(_read(file, _RECORD.size))
+                if operation in (ADD, REMOVE):
+                    psms = [_read_psm(file)]
+                else:
+                    psms = [_read_psm(file) for _ in range(_COUNT.unpack(_read(file, _COUNT.size))[0])]
+                if run and removing != (operation in (REMOVE, REMOVE_MANY)):
+                    self._apply_run(run, removing)
+                    run = []
+                run.extend(psms)
+                removing = operation in (REMOVE, REMOVE_MANY)
+            if run:
+                self._apply_run(run, removing)
+        self.primary, self.version = primary, to_version
+        return True
+
+    def _apply_run(self, psms: List[PSM], removing: bool):
+        if not removing:
+            self.arborist.update(psms)
+        elif len(psms) == 1:
+            psm = psms[0]
+            self.arborist.remove(psm.charge, psm.mz, psm.rt, psm.ook0, psm.data)
+        else:
+            self.arborist.remove_many(psms)
+
+    def connect(self, address: Union[Tuple[str, int], str]):
+        """
+        connects to a ReplicationServer: a (host, port) or the path of a unix socket
+        """
+        self.close()
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.connect(address)
+        self._file = self._socket.makefile('rwb')
+
+    def pull(self) -> bool:
+        """
+        asks the connected server for the changes since the replica's version and applies them.
+        Returns true if anything changed
+        """
+        version = self.version
+        self._file.write(_REQUEST.pack(MAGIC, self.primary, version))
+        self._file.flush()
+        return self.apply(self._file) and self.version != version
+
+    def follow(self, address: Union[Tuple[str, int], str], interval: float = 1.0,
+               stop: threading.Event = None) -> threading.Thread:
+        """
+        pulls every interval seconds on a daemon thread until stop is set, reconnecting (and catching up from
+        the replica's version) whenever the connection is lost. Returns the thread
+        """
+        stop = stop or threading.Event()
+
+        def run():
+            while not stop.is_set():
+                try:
+                    if self._file is None:
+                        self.connect(address)
+                    self.pull()
+                except (OSError, ValueError):  # primary unreachable, or the connection dropped mid-message
+                    self.close()
+                stop.wait(interval)
+            self.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def apply_directory(self, directory: str) -> int:
+        """
+        applies the files of a FileDrop directory the replica has not seen yet, in order.
+        Returns the number of files applied
+        """
+        applied = 0
+        for file_name in sorted(os.listdir(directory)):
+            if os.path.splitext(file_name)[1] not in (DELTA_EXTENSION, SNAPSHOT_EXTENSION):
+                continue
+            with open(os.path.join(directory, file_name), "rb") as file:
+                _, kind, primary, _, to_version, _ = _HEADER.unpack(_read(file, _HEADER.size))
+                if primary == self.primary and to_version <= self.version:
+                    continue
+                file.seek(0)
+                applied += self.apply(file)
+        return applied
+
+    def close(self):
+        if self._socket is not None:
+            self._file.close()
+            self._socket.close()
+            self._socket = self._file = None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            request = self.rfile.read(_REQUEST.size)
+            if len(request) != _REQUEST.size:
+                return
+            magic, primary, version = _REQUEST.unpack(request)
+            if magic != MAGIC:
+                return
+            self.wfile.write(changes(self.server.arborist, primary, version))
+            self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class ReplicationServer:
+    """
+    serves the changes of a primary arborist to replicas over a local socket, on a background thread.
+    address is a (host, port), port 0 picking a free one, or the path of a unix socket.
+    Gives the arborist a ReplicationLog if it has none.
+    """
+
+    def __init__(self, arborist: 'PSMArborist', address: Union[Tuple[str, int], str] = ('127.0.0.1', 0)):
+        if arborist.replication is None:
+            arborist.replication = ReplicationLog()
+        server_type = _UnixServer if isinstance(address, str) else _TCPServer
+        self.server = server_type(address, _Handler)
+        self.server.arborist = arborist
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def address(self) -> Union[Tuple[str, int], str]:
+        return self.server.server_address
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FileDrop:
+    """
+    drops the changes of a primary arborist into directory, one file per drop(): a delta since the previous
+    drop, or a snapshot for the first drop, when the log no longer covers the previous drop, or on request.
+    A snapshot deletes the files before it. Files are written under a temporary name and then renamed, so
+    replicas never read a partial file. Gives the arborist a ReplicationLog if it has none.
+    """
+
+    def __init__(self, arborist: 'PSMArborist', directory: str):
+        if arborist.replication is None:
+            arborist.replication = ReplicationLog()
+        self.arborist = arborist
+        self.directory = directory
+        self.version = -1
+        os.makedirs(directory, exist_ok=True)
+
+    def drop(self, snapshot: bool = False) -> Optional[str]:
+        """
+        writes the next file and returns its path, or None if nothing changed since the previous drop
+        """
+        log = self.arborist.replication
+        message = changes(self.arborist, _NO_PRIMARY if snapshot or self.version < 0 else log.id, self.version)
+        _, kind, _, _, to_version, count = _HEADER.unpack_from(message)
+        if kind == DELTA and not count:
+            return None
+        file_name = os.path.join(self.directory, f'{to_version:020d}'
+                                                 f'{SNAPSHOT_EXTENSION if kind == SNAPSHOT else DELTA_EXTENSION}')
+        with open(file_name + '.tmp', "wb") as file:
+            file.write(message)
+        os.replace(file_name + '.tmp', file_name)
+        if kind == SNAPSHOT:
+            for old in os.listdir(self.directory):
+                if old != os.path.basename(file_name) and not old.endswith('.tmp'):
+                    os.remove(os.path.join(self.directory, old))
+        self.version = to_version
+        return file_name
@@ -0,0 +1,364 @@
+"""
+-------------- Shared --------------
+An arborist whose trees live in shared
+memory (multiprocessing.shared_memory), so
+that many processes search one copy of it.
+One process owns a SharedArboristWriter: it
+buffers new PSM's and publish() merges them
+into a new version of each changed tree.
+Any number of SharedArboristReaders attach
+by name and search the segments in place:
+no copy, no pickling, only the PSM's found
+are decoded.
+
+Segments:
+    [name]              : the manifest, a table of
+                          (charge, version, count)
+                          under a sequence lock
+    [name]_[charge]_[v] : version v of a tree:
+                          count, data size,
+                          mz[], rt[], ook0[] in mz order,
+                          data offsets[], data (repr)
+A published version is never changed. The
+writer unlinks a superseded one right away;
+readers still attached to it keep it mapped
+until they refresh.
+------------------------------------
+"""
+
+import ast
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from arboretum.boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds, get_mz_bounds_array, \
+    get_rt_bounds_array, get_ook0_bounds_array
+from arboretum.kernel import in_bounds, in_bounds_batch
+from arboretum.psm import PSM
+
+MAX_CHARGES = 64  # manifest entries
+_TREE_HEADER = struct.Struct('<QQ')  # psm count, data size
+_MANIFEST_HEADER = 2  # int64's before the entries: sequence, entry count
+
+
+def _attach(name: str) -> SharedMemory:
+    """
+    attaches an existing segment without letting this process' resource tracker unlink it when the process exits
+    (which, before python 3.13, it does for every segment a process opens)
+    """
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _unlink(shm: SharedMemory):
+    """
+    closes & unlinks a segment of the writer. A reader sharing the writer's resource tracker (in the writer's
+    process, or one it started) unregistered the segment on attaching, so it is registered again first, for unlink
+    to unregister.
+    """
+    shm.close()
+    resource_tracker.register(shm._name, 'shared_memory')
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class _SharedTree:
+    """
+    one version of a charge's tree: numpy views over its segment
+    """
+
+    def __init__(self, shm: SharedMemory, charge: int, version: int):
+        self.shm = shm
+        self.charge = charge
+        self.version = version
+        count, data_size = _TREE_HEADER.unpack_from(shm.buf)
+        position = _TREE_HEADER.size
+        self.mzs, self.rts, self.ook0s = [np.ndarray(count, dtype='<f8', buffer=shm.buf, offset=position + 8 * count * i)
+                                          for i in range(3)]
+        position += 24 * count
+        self.offsets = np.ndarray(count + 1, dtype='<u8', buffer=shm.buf, offset=position)
+        position += 8 * (count + 1)
+        self.data = np.ndarray(data_size, dtype=np.uint8, buffer=shm.buf, offset=position)
+
+    @staticmethod
+    def size(count: int, data_size: int) -> int:
+        return _TREE_HEADER.size + 32 * count + 8 + data_size
+
+    def psm(self, i: int) -> PSM:
+        data = self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+        return PSM(charge=self.charge,
+                   mz=float(self.mzs[i]),
+                   rt=float(self.rts[i]),
+                   ook0=float(self.ook0s[i]),
+                   data=ast.literal_eval(data))
+
+    def search(self, mz_boundary: Boundary, rt_boundary: Boundary, ook0_boundary: Boundary) -> List[PSM]:
+        start = int(np.searchsorted(self.mzs, mz_boundary.lower, side='left'))
+        end = int(np.searchsorted(self.mzs, mz_boundary.upper, side='right'))
+        indexes = in_bounds(self.mzs, self.rts, self.ook0s, start, end,
+                            float(mz_boundary.lower), float(mz_boundary.upper),
+                            float(rt_boundary.lower), float(rt_boundary.upper),
+                            float(ook0_boundary.lower), float(ook0_boundary.upper))
+        return [self.psm(i) for i in indexes.tolist()]
+
+    def search_array(self, mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper) -> List[List[PSM]]:
+        starts = np.searchsorted(self.mzs, mz_lower, side='left')
+        ends = np.searchsorted(self.mzs, mz_upper, side='right')
+        indexes, offsets = in_bounds_batch(self.mzs, self.rts, self.ook0s, starts, ends,
+                                           mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper)
+        psms = [self.psm(i) for i in indexes.tolist()]
+        offsets = offsets.tolist()
+        return [psms[offsets[q]:offsets[q + 1]] for q in range(len(starts))]
+
+    def __len__(self):
+        return len(self.mzs)
+
+    def close(self):
+        # the views must go before the segment can be closed
+        self.mzs = self.rts = self.ook0s = self.offsets = self.data = None
+        self.shm.close()
+
+
+def _write_tree(name: str, charge: int, version: int, old: Optional[_SharedTree], psms: List[PSM]) -> _SharedTree:
+    """
+    creates version `version` of a tree: the psm's of old (if any) merged with psms, which must be in mz order.
+    Each new psm goes after the old ones of equal mz, as with add on the in-process trees.
+    """
+    count = len(psms)
+    mzs = np.fromiter((psm.mz for psm in psms), dtype='<f8', count=count)
+    rts = np.fromiter((psm.rt for psm in psms), dtype='<f8', count=count)
+    ook0s = np.fromiter((psm.ook0 for psm in psms), dtype='<f8', count=count)
+    data = [repr(psm.data).encode('utf-8') for psm in psms]
+    lengths = np.fromiter((len(d) for d in data), dtype='<u8', count=count)
+
+    old_count = 0 if old is None else len(old)
+    old_data_size = 0 if old is None else len(old.data)
+    positions = np.zeros(count, dtype=np.int64) if old is None else np.searchsorted(old.mzs, mzs, side='right')
+    total = old_count + count
+    new_indexes = positions + np.arange(count)  # where each new psm lands
+    old_indexes = np.arange(old_count) + np.searchsorted(positions, np.arange(old_count), side='right')
+
+    shm = SharedMemory(name=f'{name}_{charge}_{version}', create=True,
+                       size=_SharedTree.size(total, old_data_size + int(lengths.sum())))
+    _TREE_HEADER.pack_into(shm.buf, 0, total, old_data_size + int(lengths.sum()))
+    tree = _SharedTree(shm, charge, version)
+
+    all_lengths = np.empty(total, dtype='<u8')
+    all_lengths[new_indexes] = lengths
+    for column, new_values in ((tree.mzs, mzs), (tree.rts, rts), (tree.ook0s, ook0s)):
+        column[new_indexes] = new_values
+    if old is not None:
+        all_lengths[old_indexes] = np.diff(old.offsets)
+        tree.mzs[old_indexes], tree.rts[old_indexes], tree.ook0s[old_indexes] = old.mzs, old.rts, old.ook0s
+    tree.offsets[0] = 0
+    np.cumsum(all_lengths, out=tree.offsets[1:])
+
+    # the data goes through memoryviews (cheap to slice), the old data in runs: the old psm's between two consecutive
+    # new ones stay contiguous
+    destination = memoryview(tree.data)
+    source = memoryview(old.data) if old is not None else None
+    offsets = tree.offsets.tolist()
+    old_offsets = old.offsets.tolist() if old is not None else [0]
+    bounds = [0] + positions.tolist() + [old_count]
+    for k in range(count + 1):
+        start, end = bounds[k], bounds[k + 1]
+        if start < end:
+            begin = offsets[start + k]
+            destination[begin:begin + old_offsets[end] - old_offsets[start]] = source[old_offsets[start]:old_offsets[end]]
+        if k < count:
+            begin = offsets[end + k]
+            destination[begin:begin + len(data[k])] = data[k]
+    return tree
+
+
+class _SharedArborist:
+    """
+    the searches shared by writer & reader, over self.trees
+    """
+    trees: Dict[int, _SharedTree]
+
+    def _refresh(self):
+        pass
+
+    def search(self, charge: int, mz: float, rt: float, ook0: float, ppm: float, rt_offset: float,
+               ook0_tolerance: float) -> List[PSM]:
+        self._refresh()
+        tree = self.trees.get(charge)
+        if tree is None:
+            return []
+        return tree.search(get_mz_bounds(mz, ppm), get_rt_bounds(rt, rt_offset), get_ook0_bounds(ook0, ook0_tolerance))
+
+    def search_array(self, charge, mz, rt, ook0, ppm: float, rt_offset: float,
+                     ook0_tolerance: float) -> List[List[PSM]]:
+        """
+        as PSMArborist.search_array
+        """
+        self._refresh()
+        mz_lower, mz_upper = get_mz_bounds_array(mz, ppm)
+        rt_lower, rt_upper = get_rt_bounds_array(rt, rt_offset)
+        ook0_lower, ook0_upper = get_ook0_bounds_array(ook0, ook0_tolerance)
+        charges = np.broadcast_to(np.asarray(charge), mz_lower.shape)
+
+        results = [[] for _ in range(len(mz_lower))]
+        for query_charge in np.unique(charges).tolist():
+            tree = self.trees.get(query_charge)
+            if tree is None:
+                continue
+            queries = np.flatnonzero(charges == query_charge)
+            charge_results = tree.search_array(mz_lower[queries], mz_upper[queries], rt_lower[queries],
+                                               rt_upper[queries], ook0_lower[queries], ook0_upper[queries])
+            for i, psms in zip(queries.tolist(), charge_results):
+                results[i] = psms
+        return results
+
+    @property
+    def sizes(self) -> Dict[int, int]:
+        self._refresh()
+        return {charge: len(tree) for charge, tree in self.trees.items()}
+
+    @property
+    def versions(self) -> Dict[int, int]:
+        self._refresh()
+        return {charge: tree.version for charge, tree in self.trees.items()}
+
+    def __len__(self):
+        return sum(self.sizes.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+
+class SharedArboristWriter(_SharedArborist):
+    """
+    Creates the shared arborist `name` and is its only writer. add & update buffer psm's in this process;
+    publish() makes them visible to readers. Trees only grow: psm's cannot be removed.
+    close() unlinks every segment, after which readers can no longer refresh.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trees = {}
+        self.pending: Dict[int, List[PSM]] = {}
+        self.manifest = SharedMemory(name=name, create=True, size=8 * (_MANIFEST_HEADER + 3 * MAX_CHARGES))
+        self._table = np.ndarray(_MANIFEST_HEADER + 3 * MAX_CHARGES, dtype='<i8', buffer=self.manifest.buf)
+        self._table[:] = 0
+
+    def add(self, charge: int, mz: float, rt: float, ook0: float, data: dict):
+        self.pending.setdefault(charge, []).append(PSM(charge, mz, rt, ook0, data))
+
+    def update(self, psms: Iterable[PSM]):
+        for psm in psms:
+            self.pending.setdefault(psm.charge, []).append(psm)
+
+    def publish(self) -> int:
+        """
+        writes a new version of every tree with pending psm's, then swaps them into the manifest at once.
+        Returns the number of psm's published.
+        """
+        if not self.pending:
+            return 0
+        if len(self.trees.keys() | self.pending.keys()) > MAX_CHARGES:
+            raise ValueError(f'a shared arborist holds at most {MAX_CHARGES} charges')
+
+        published = {}
+        for charge, psms in self.pending.items():
+            psms.sort(key=lambda x: x.mz)
+            old = self.trees.get(charge)
+            version = 1 if old is None else old.version + 1
+            published[charge] = _write_tree(self.name, charge, version, old, psms)
+        count = sum(len(psms) for psms in self.pending.values())
+        self.pending = {}
+
+        superseded = [self.trees[charge] for charge in published if charge in self.trees]
+        self.trees.update(published)
+        self._write_manifest()
+        for tree in superseded:
+            shm = tree.shm
+            tree.close()
+            _unlink(shm)
+        return count
+
+    def _write_manifest(self):
+        """
+        the sequence is odd while the entries are being written, so a reader that sees it odd, or changed, retries
+        """
+        entries = [(charge, tree.version, len(tree)) for charge, tree in sorted(self.trees.items())]
+        self._table[0] += 1
+        self._table[1] = len(entries)
+        self._table[_MANIFEST_HEADER:_MANIFEST_HEADER + 3 * len(entries)] = np.array(entries, dtype='<i8').ravel()
+        self._table[0] += 1
+
+    def close(self):
+        for tree in self.trees.values():
+            shm = tree.shm
+            tree.close()
+            _unlink(shm)
+        self.trees = {}
+        if self.manifest is not None:
+            self._table = None
+            _unlink(self.manifest)
+            self.manifest = None
+
+
+class SharedArboristReader(_SharedArborist):
+    """
+    Attaches to the shared arborist `name`. Every search first checks the manifest's sequence (one integer read)
+    and, if the writer published since, attaches the new versions of the changed trees.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trees = {}
+        self.manifest = _attach(name)
+        self._table = np.ndarray(_MANIFEST_HEADER + 3 * MAX_CHARGES, dtype='<i8', buffer=self.manifest.buf)
+        self.sequence = None  # manifest sequence the trees were attached at
+        self._refresh()
+
+    def _read_manifest(self):
+        while True:
+            sequence = int(self._table[0])
+            if sequence % 2 == 0:
+                count = int(self._table[1])
+                entries = self._table[_MANIFEST_HEADER:_MANIFEST_HEADER + 3 * count].reshape(-1, 3).tolist()
+                if int(self._table[0]) == sequence:
+                    return sequence, entries
+            time.sleep(0)
+
+    def _refresh(self):
+        while int(self._table[0]) != self.sequence:
+            sequence, entries = self._read_manifest()
+            try:
+                for charge, version, _ in entries:
+                    tree = self.trees.get(charge)
+                    if tree is None or tree.version != version:
+                        self.trees[charge] = _SharedTree(_attach(f'{self.name}_{charge}_{version}'), charge, version)
+                        if tree is not None:
+                            tree.close()
+            except FileNotFoundError:  # superseded by a publish since the manifest was read: read it again
+                continue
+            self.sequence = sequence
+
+    def close(self):
+        for tree in self.trees.values():
+            tree.close()
+        self.trees = {}
+        if self.manifest is not None:
+            self._table = None
+            self.manifest.close()
+            self.manifest = None
@@ -0,0 +1,316 @@
+"""
+-------------- Tracing --------------
+Hooks around the operations of an Arborist
+and of every PsmTree. Give an Arborist a
+Tracer (arborist.tracer = Tracer(...)), or
+every tree at once (PsmTree.tracer = ...),
+and each traced call reports a TraceEvent
+to the tracer's sinks before (pre) and
+after (post, with its duration, the number
+of psm's involved and any error) it runs.
+Without a tracer a traced arborist call
+costs one attribute check, and tree calls
+are not wrapped at all: tree operations are
+only wrapped while some tree type has a
+tracer.
+
+Sinks:
+    RingBufferSink : the latest events, in memory
+    JsonlSink      : one JSON object per event
+    ProfileSink    : cProfile over a time window
+    SamplingSink   : stack samples of every
+                     thread over a time window
+-------------------------------------
+"""
+
+import cProfile
+import json
+import sys
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import asdict, dataclass
+from functools import wraps
+from typing import IO, Callable, Iterable, List, Optional, Union
+
+
+@dataclass
+class TraceEvent:
+    operation: str  # method name, e.g. 'search'
+    source: str  # class of the traced object, e.g. 'PSMArborist' or 'PsmSortedList'
+    charge: Optional[int] = None  # for arborist operations on a single charge tree
+    timestamp: float = 0.0  # time.time() at the start of the call
+    duration: Optional[float] = None  # seconds, set on post events
+    count: Optional[int] = None  # psm's added, removed or returned, set on post events
+    error: Optional[str] = None  # exception type, if the call raised
+
+
+def _one(args, result) -> int:
+    return 1
+
+
+def _length(args, result) -> Optional[int]:
+    return len(args[0]) if args and hasattr(args[0], '__len__') else None
+
+
+def _result(args, result) -> Optional[int]:
+    return result if isinstance(result, int) else None
+
+
+def _results(args, result) -> int:
+    return len(result)
+
+
+def _nested_results(args, result) -> int:
+    return sum(len(psms) for psms in result)
+
+
+def _none(args, result) -> None:
+    return None
+
+
+# operation -> number of psm's involved, given the call's positional arguments and its result
+COUNTS = {
+    'add': _one,
+    'update': _length,
+    'rebuild': _length,
+    'remove': _one,
+    'remove_many': _result,
+    'retain': _result,
+    'recalibrate': _result,
+    'ingest': _result,
+    'search': _results,
+    'tsearch': _results,
+    'stab': _results,
+    'search_mass': _results,
+    'search_array': _nested_results,
+    'save': _none,
+    'load': _none,
+}
+
+_active = threading.local()  # ids of the objects with a traced call in progress on this thread
+
+
+def traced(operation: str, charged: bool = False):
+    """
+    decorates a method so that its calls are reported to self.tracer (when not None). With charged, the first
+    argument is reported as the charge. Calls made while another traced call on the same object is in progress
+    (e.g. a tree's update calling its add) are not reported separately.
+    """
+    count = COUNTS[operation]
+
+    def decorator(method: Callable) -> Callable:
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = self.tracer
+            if tracer is None:
+                return method(self, *args, **kwargs)
+
+            active = getattr(_active, 'objects', None)
+            if active is None:
+                active = _active.objects = set()
+            if id(self) in active:
+                return method(self, *args, **kwargs)
+
+            event = TraceEvent(operation, type(self).__name__, args[0] if charged and args else None, time.time())
+            tracer.pre(event)
+            active.add(id(self))
+            start = time.perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+                event.count = count(args, result)
+                return result
+            except BaseException as e:
+                event.error = type(e).__name__
+                raise
+            finally:
+                event.duration = time.perf_counter() - start
+                active.discard(id(self))
+                tracer.post(event)
+
+        wrapper.traced = operation
+        return wrapper
+
+    return decorator
+
+
+class TraceSink:
+    """
+    receives the events of a Tracer. Both methods may be called from any thread.
+    """
+
+    def pre(self, event: TraceEvent):
+        pass
+
+    def post(self, event: TraceEvent):
+        pass
+
+
+class Tracer:
+    """
+    hands every event to each of its sinks, in order
+    """
+
+    def __init__(self, sinks: Iterable[TraceSink] = ()):
+        self.sinks = list(sinks)
+
+    def pre(self, event: TraceEvent):
+        for sink in self.sinks:
+            sink.pre(event)
+
+    def post(self, event: TraceEvent):
+        for sink in self.sinks:
+            sink.post(event)
+
+
+class RingBufferSink(TraceSink):
+    """
+    keeps the post events of the latest capacity calls
+    """
+
+    def __init__(self, capacity: int = 10_000):
+        self.buffer = deque(maxlen=capacity)
+
+    def post(self, event: TraceEvent):
+        self.buffer.append(event)
+
+    @property
+    def events(self) -> List[TraceEvent]:
+        return list(self.buffer)
+
+    def slowest(self, n: int = 10) -> List[TraceEvent]:
+        return sorted(self.buffer, key=lambda event: event.duration, reverse=True)[:n]
+
+
+class JsonlSink(TraceSink):
+    """
+    writes every post event as one JSON object per line to a file name (appended to) or an open text file
+    """
+
+    def __init__(self, file: Union[str, IO]):
+        self._owned = isinstance(file, str)
+        self.file = open(file, "a") if self._owned else file
+        self._lock = threading.Lock()
+
+    def post(self, event: TraceEvent):
+        line = json.dumps(asdict(event)) + '\n'
+        with self._lock:
+            self.file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._owned:
+                self.file.close()
+            else:
+                self.file.flush()
+
+
+class _WindowSink(TraceSink):
+    """
+    runs a capture for window seconds, starting at the first event or, with trigger set, at the first call slower
+    than trigger seconds. Captures once; reset() arms the sink again.
+    """
+
+    def __init__(self, file_name: str, window: float = 10.0, trigger: Optional[float] = None):
+        self.file_name = file_name
+        self.window = window
+        self.trigger = trigger
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = None  # perf_counter() at the start of the capture
+        self.done = False
+
+    def pre(self, event: TraceEvent):
+        if self.trigger is None:
+            self._begin()
+        self._check()
+
+    def post(self, event: TraceEvent):
+        if self.trigger is not None and event.duration > self.trigger:
+            self._begin()
+        self._check()
+
+    def _begin(self):
+        with self._lock:
+            if self.started is not None or self.done:
+                return
+            self.started = time.perf_counter()
+            self._start()
+
+    def _check(self):
+        with self._lock:
+            if self.started is None or self.done or time.perf_counter() - self.started < self.window:
+                return
+            self.done = True
+            self._stop()
+
+    def _start(self):
+        pass
+
+    def _stop(self):
+        pass
+
+
+class ProfileSink(_WindowSink):
+    """
+    profiles the thread that starts the capture with cProfile and writes the stats to file_name
+    (view with: python -m pstats file_name). The capture ends at that thread's first traced call after the window:
+    a profile must be disabled on the thread that enabled it, so calls from other threads are not profiled and
+    do not end the capture.
+    """
+
+    def reset(self):
+        super().reset()
+        self.thread = None  # ident of the profiled thread
+
+    def _start(self):
+        self.thread = threading.get_ident()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def _check(self):
+        if threading.get_ident() == self.thread:
+            super()._check()
+
+    def _stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.file_name)
+
+
+class SamplingSink(_WindowSink):
+    """
+    samples the stack of every other thread each interval seconds, on a background thread, and writes
+    the counts in collapsed stack format ("file:function;file:function count" per line, root first), as read by
+    flamegraph.pl and speedscope. Unlike ProfileSink it sees every thread and barely slows them down.
+    The file is written by the sampling thread once the window has passed (join self.thread to wait for it).
+    """
+
+    def __init__(self, file_name: str, window: float = 10.0, trigger: Optional[float] = None,
+                 interval: float = 0.001):
+        self.interval = interval
+        super().__init__(file_name, window, trigger)
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._sample, args=(self.started,), daemon=True)
+        self.thread.start()
+
+    def _sample(self, started: float):
+        stacks = Counter()
+        own = threading.get_ident()
+        while time.perf_counter() - started < self.window:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{frame.f_code.co_filename}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+        with open(self.file_name, "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f'{stack} {count}\n')
+        self.done = True
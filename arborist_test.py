@@ -1,8 +1,7 @@
 import os
 import time
 import random
-from arborist import PSMArborist, TreeType, PSM
-from boundary import get_mz_bounds, get_rt_bounds, get_ook0_bounds
+from arboretum.arborist import PSMArborist, TreeType, PSM
 
 
 def generate_random_psm() -> PSM:
@@ -13,7 +12,7 @@ def generate_random_psm() -> PSM:
         mz=random.uniform(100, 1800),
         rt=random.uniform(0, 10_000),
         ook0=random.uniform(0.4, 1.8),
-        sequence=peptide_string
+        data={'sequence': peptide_string}
     )
 
 
@@ -42,7 +41,7 @@ for x in range(runs):
     # get add time
     start_time = time.time()
     for psm in leaves:
-        arb.add(psm)
+        arb.add(psm.charge, psm.mz, psm.rt, psm.ook0, psm.data)
     add_time = (time.time() - start_time)
     print(f"N: {canopy:,}, add_time: {add_time:,}")
 
@@ -51,14 +50,10 @@ for x in range(runs):
 
     query = [generate_random_psm() for i in range(int(leaf_count * 0.05))]  # 5% of the leaf_count (ex: 50k -> 500)
 
-    # get search time
+    # get search time (bounds for the whole batch of queries are computed at once)
     start_time = time.time()
-    for psm in query:
-        query_results = arb.search(psm.charge,
-                                   [get_mz_bounds(psm.mz, PPM).lower, get_mz_bounds(psm.mz, PPM).upper],
-                                   [get_rt_bounds(psm.rt, RT_OFF).lower, get_rt_bounds(psm.rt, RT_OFF).upper],
-                                   [get_ook0_bounds(psm.ook0, OOK0_TOL).lower,
-                                    get_ook0_bounds(psm.ook0, OOK0_TOL).upper])
+    query_results = arb.search_array([psm.charge for psm in query], [psm.mz for psm in query],
+                                     [psm.rt for psm in query], [psm.ook0 for psm in query], PPM, RT_OFF, OOK0_TOL)
 
     search_time = (time.time() - start_time)
     print(f"N: {canopy:,}, search_time: {search_time}")
@@ -0,0 +1,24 @@
+import random
+
+import numpy as np
+
+from arboretum.psm import PSM
+
+"""
+The random psm's shared by the benchmark and planning scripts.
+"""
+
+AMINOACIDS = 'ARNDCEQGHILKMFPSTWYV'
+
+
+def generate_random_psm(charge: int = 2, mz_mean: float = 1000, mz_sd: float = 250,
+                        gradient: float = 5000) -> PSM:
+    peptide_string = ''.join(random.choice(AMINOACIDS) for i in range(random.randint(6, 30)))
+    mz = np.random.normal(mz_mean, mz_sd)
+    return PSM(
+        charge=charge,
+        mz=mz,
+        rt=random.uniform(0, gradient),
+        ook0=mz/1000 + random.uniform(-0.2, 0.2),
+        data={'sequence': peptide_string}
+    )
@@ -0,0 +1,32 @@
+import statistics
+import subprocess
+import sys
+
+"""
+Measures the cold-start cost of importing arboretum, the way a short-lived CLI tool or worker process pays it.
+Each statement runs in a fresh interpreter, repeated [runs] times; the median is reported.
+"""
+
+runs = 10
+
+statements = {
+    'python (baseline)': 'pass',
+    'import arboretum': 'import arboretum',
+    'import arboretum.forest': 'import arboretum.forest',
+    'import arboretum.arborist': 'import arboretum.arborist',
+    'construct sorted_list': 'from arboretum.forest import psm_tree_constructor; psm_tree_constructor("sorted_list")',
+    'save & load compressed': 'import tempfile, os; from arboretum.arborist import PSMArborist; '
+                              'a = PSMArborist(); a.add(2, 500.0, 10.0, 1.0, {}); '
+                              'd = os.path.join(tempfile.mkdtemp(), "a"); a.save(d, compressed=True); '
+                              'PSMArborist().load(d)',
+}
+
+timer = 'import time; _start = time.perf_counter(); {statement}; print(time.perf_counter() - _start)'
+
+for label, statement in statements.items():
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', timer.format(statement=statement)],
+                                capture_output=True, text=True, check=True).stdout
+        times.append(float(output.split()[-1]))
+    print(f"{label:<28} median: {statistics.median(times) * 1000:8.2f} ms   min: {min(times) * 1000:8.2f} ms")
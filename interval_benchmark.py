@@ -0,0 +1,47 @@
+import random
+import time
+
+from arboretum.forest import TreeType, psm_tree_constructor
+from benchmark_psms import generate_random_psm
+
+"""
+Exclusion-list workload: every stored psm carries its own tolerance window, and each incoming precursor is a point
+query. Compares stabbing the interval tree (windows built once, at insert) against building a range around every
+query and searching the other tree types.
+"""
+
+num_psms = 50_000
+num_queries = 10_000
+PPM = 10
+RT_OFF = 30
+OOK0_TOL = 0.02
+
+psms = [generate_random_psm() for _ in range(num_psms)]
+# half of the queries re-hit a stored precursor (shifted inside its window), half are random
+queries = [(psm.mz * (1 + PPM / 2 / 1_000_000), psm.rt + RT_OFF / 2, psm.ook0) for psm in random.sample(psms, num_queries // 2)]
+queries += [(psm.mz, psm.rt, psm.ook0) for psm in (generate_random_psm() for _ in range(num_queries // 2))]
+
+interval_tree = psm_tree_constructor(TreeType.INTERVAL)
+start_time = time.time()
+for psm in psms:
+    interval_tree.add(psm, ppm=PPM, rt_offset=RT_OFF, ook0_tolerance=OOK0_TOL)
+print(f"{'INTERVAL':<16} add time per psm: {(time.time() - start_time) / num_psms * 1e6:8.2f} us", end='   ')
+
+start_time = time.time()
+hits = 0
+for mz, rt, ook0 in queries:
+    hits += len(interval_tree.stab(mz, rt, ook0))
+print(f"stab time per query: {(time.time() - start_time) / num_queries * 1e6:8.2f} us   hits: {hits}")
+
+for tree_type in [TreeType.SORTED_LIST, TreeType.HASHTABLE]:
+    tree = psm_tree_constructor(tree_type)
+    start_time = time.time()
+    for psm in psms:
+        tree.add(psm)
+    print(f"{tree_type.name:<16} add time per psm: {(time.time() - start_time) / num_psms * 1e6:8.2f} us", end='   ')
+
+    start_time = time.time()
+    hits = 0
+    for mz, rt, ook0 in queries:
+        hits += len(tree.tsearch(mz, rt, ook0, PPM, RT_OFF, OOK0_TOL))
+    print(f"search time per query: {(time.time() - start_time) / num_queries * 1e6:6.2f} us   hits: {hits}")
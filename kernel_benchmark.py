@@ -0,0 +1,61 @@
+import random
+import time
+
+import numpy as np
+
+from arboretum import kernel
+from arboretum.boundary import get_mz_bounds, get_rt_bounds, get_ook0_bounds, psm_attributes_in_bound
+from arboretum.forest import TreeType, psm_tree_constructor
+from benchmark_psms import generate_random_psm
+
+"""
+Cost per candidate of the in-bound filter: the Python comparison every backend runs per candidate
+(psm_attributes_in_bound), against the numpy and numba (if installed) kernels over coordinate columns.
+Then whole searches of the SORTED_LIST tree against the columnar BUFFERED_SORTED_LIST, which uses the kernel.
+"""
+
+num_psms = 200_000
+num_queries = 5_000
+PPM = 50
+RT_OFF = 100
+OOK0_TOL = 0.05
+
+psms = sorted((generate_random_psm() for _ in range(num_psms)), key=lambda psm: psm.mz)
+mzs = np.array([psm.mz for psm in psms])
+rts = np.array([psm.rt for psm in psms])
+ook0s = np.array([psm.ook0 for psm in psms])
+queries = random.sample(psms, num_queries)
+bounds = [(get_mz_bounds(psm.mz, PPM), get_rt_bounds(psm.rt, RT_OFF), get_ook0_bounds(psm.ook0, OOK0_TOL))
+          for psm in queries]
+ranges = [(int(np.searchsorted(mzs, mz_bounds.lower, side='left')),
+           int(np.searchsorted(mzs, mz_bounds.upper, side='right'))) for mz_bounds, _, _ in bounds]
+candidates = sum(end - start for start, end in ranges)
+print(f"{candidates / num_queries:.0f} candidates per query")
+
+start_time = time.time()
+hits = 0
+for (start, end), (mz_bounds, rt_bounds, ook0_bounds) in zip(ranges, bounds):
+    for psm in psms[start:end]:
+        hits += psm_attributes_in_bound(psm.mz, psm.rt, psm.ook0, mz_bounds, rt_bounds, ook0_bounds)
+print(f"{'python':<8} per candidate: {(time.time() - start_time) / candidates * 1e9:8.2f} ns   hits: {hits}")
+
+kernels = [('numpy', kernel._in_bounds_numpy)]
+if kernel.HAS_NUMBA:
+    kernel.in_bounds(mzs, rts, ook0s, 0, 1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)  # compile
+    kernels.append(('numba', kernel.in_bounds))
+for name, in_bounds in kernels:
+    start_time = time.time()
+    hits = 0
+    for (start, end), (mz_bounds, rt_bounds, ook0_bounds) in zip(ranges, bounds):
+        hits += len(in_bounds(mzs, rts, ook0s, start, end, mz_bounds.lower, mz_bounds.upper,
+                              rt_bounds.lower, rt_bounds.upper, ook0_bounds.lower, ook0_bounds.upper))
+    print(f"{name:<8} per candidate: {(time.time() - start_time) / candidates * 1e9:8.2f} ns   hits: {hits}")
+
+for tree_type in [TreeType.SORTED_LIST, TreeType.BUFFERED_SORTED_LIST]:
+    tree = psm_tree_constructor(tree_type)
+    tree.update(tree.order_psms(list(psms)))
+    tree.search(*bounds[0])  # compile
+    start_time = time.time()
+    hits = sum(len(tree.search(*query_bounds)) for query_bounds in bounds)
+    print(f"{tree_type.name:<21} search time per query: {(time.time() - start_time) / num_queries * 1e6:7.2f} us"
+          f"   hits: {hits}")
@@ -0,0 +1,41 @@
+import sys
+
+import numpy as np
+
+from arboretum.forest import TreeType, psm_tree_constructor
+from benchmark_psms import generate_random_psm
+
+"""
+Capacity planning: measures the deep memory of each tree type at a few sample sizes (see PsmTree.memory_usage),
+fits bytes = fixed + per_psm * N and projects the RAM needed for the psm counts given on the command line.
+usage: python memory_planner.py [N ...]
+"""
+
+sample_sizes = [5_000, 10_000, 20_000]
+projections = [int(n) for n in sys.argv[1:]] or [1_000_000, 10_000_000]
+
+psms = [generate_random_psm() for _ in range(max(sample_sizes))]
+
+print(f"{'tree type':<16}{'index/psm':>11}{'psm/psm':>9}{'data/psm':>10}" +
+      ''.join(f"{f'N={n:,}':>16}" for n in projections))
+for tree_type in TreeType:
+    try:
+        tree = psm_tree_constructor(tree_type)
+    except ImportError as e:
+        print(f"{tree_type.name:<16}skipped: {e}")
+        continue
+    if tree is NotImplementedError:
+        continue
+
+    usages = []
+    for size in sample_sizes:
+        tree.clear()
+        for psm in psms[:size]:
+            tree.add(psm)
+        usages.append(tree.memory_usage())
+
+    per_psm, fixed = np.polyfit(sample_sizes, [usage.total for usage in usages], 1)
+    largest = usages[-1]
+    print(f"{tree_type.name:<16}{largest.index / largest.count:>11.0f}{largest.psms / largest.count:>9.0f}"
+          f"{largest.payloads / largest.count:>10.0f}" +
+          ''.join(f"{(fixed + per_psm * n) / 2 ** 30:>13.2f} GB" for n in projections))
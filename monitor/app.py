@@ -1,26 +1,139 @@
+import hashlib
+import os
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
 import streamlit as st
 
+from arboretum.arborist import PSMArborist
+from arboretum.forest.treetypes import TreeType
+
+"""
+Loads a saved arborist once (cached across reruns, so moving a slider only re-runs the search) and searches it.
+Directories are loaded lazily: trees are read on first use and compressed (.blk) trees are searched straight from
+disk, block by block. Uploaded tree files ([charge].txt or .blk) are loaded into memory through a temporary directory,
+removed once they are read; other file names are skipped. Pickles are not accepted, as unpickling an uploaded file
+could run arbitrary code.
+"""
+
+UNBOUNDED = float('inf')
+MAX_ROWS = 1000  # result rows shown
+
+
+@st.cache_resource(show_spinner="Loading arborist...")
+def load_arborist(directory: str, tree_type: str) -> PSMArborist:
+    arborist = PSMArborist(tree_type)
+    arborist.load(directory, lazy=True)
+    return arborist
+
+
+@st.cache_resource(show_spinner="Loading uploaded trees...")
+def load_uploaded_arborist(key: Tuple[str, ...], tree_type: str, _files: List) -> PSMArborist:
+    """
+    key identifies the uploads (names & content digests); _files (not hashed by streamlit) holds their contents.
+    The trees are read eagerly, so the temporary directory does not outlive the call
+    """
+    arborist = PSMArborist(tree_type)
+    with tempfile.TemporaryDirectory(prefix='arborist_monitor_') as directory:
+        for file in _files:
+            with open(os.path.join(directory, os.path.basename(file.name)), "wb") as out:
+                out.write(file.getvalue())
+        arborist.load(directory)
+    return arborist
+
+
+def is_tree_file(name: str) -> bool:
+    """
+    whether name is [charge].txt or .blk, as PSMArborist.load expects
+    """
+    return os.path.splitext(os.path.basename(name))[0].isdigit()
+
+
+@st.cache_data(show_spinner="Counting psm's...")
+def tree_sizes(key: Tuple[str, ...], _arborist: PSMArborist) -> Dict[int, int]:
+    """
+    arborist.sizes, which reads every tree still on disk: counted once per key (the source & its files'
+    modification times, or the upload key) instead of on every rerun
+    """
+    return _arborist.sizes
+
+
+def directory_key(directory: str) -> Tuple[str, ...]:
+    return (directory,) + tuple(f'{entry.name}:{entry.stat().st_mtime_ns}' for entry in sorted(
+        os.scandir(directory), key=lambda entry: entry.name))
+
+
 st.title('Arborist Monitor')
 
-arborist_save_files = st.file_uploader("PSM pickle files", type=['.pkl'], accept_multiple_files=True)
+source = st.sidebar.radio('Source', ['Directory', 'Upload'])
+tree_types = [tree_type.name.lower() for tree_type in TreeType if tree_type != TreeType.KD]
+tree_type = st.sidebar.selectbox('Tree type', tree_types, index=tree_types.index('sorted_list'))
+if source == 'Directory':
+    directory = st.sidebar.text_input('Saved arborist directory')
+    arborist = load_arborist(directory, tree_type) if directory and os.path.isdir(directory) else None
+    key = directory_key(directory) if arborist is not None else ()
+else:
+    files = st.sidebar.file_uploader("Tree files ([charge].txt or .blk)", type=['txt', 'blk'],
+                                     accept_multiple_files=True)
+    skipped = [file.name for file in files if not is_tree_file(file.name)]
+    if skipped:
+        st.sidebar.warning(f"Skipped files not named [charge].txt or .blk: {', '.join(skipped)}")
+    files = [file for file in files if is_tree_file(file.name)]
+    key = tuple(sorted(f'{file.name}:{hashlib.sha1(file.getvalue()).hexdigest()}' for file in files))
+    arborist = load_uploaded_arborist(key, tree_type, files) if files else None
+
+if st.sidebar.button('Reload'):
+    load_arborist.clear()
+    load_uploaded_arborist.clear()
+    tree_sizes.clear()
+    st.rerun()
+
+if arborist is None:
+    st.info('Choose a saved arborist directory or upload its tree files.')
+    st.stop()
+
+sizes = tree_sizes(key, arborist)
+st.subheader('Trees')
+st.dataframe([{'charge': charge, 'psms': size, 'loaded': charge in arborist.loaded_charges}
+              for charge, size in sorted(sizes.items())])
+
+charges = st.multiselect('charge', sorted(sizes), default=sorted(sizes))
 
 col1, col2 = st.columns(2)
-mz = col1.number_input(label='mz', min_value=0.0, step=0.01)
-ppm = col2.number_input(label='ppm', min_value=0.0, step=0.01)
+mz = col1.number_input(label='mz', min_value=0.0, value=1000.0, step=0.01)
+ppm = col2.slider(label='ppm', min_value=0.0, max_value=200.0, value=50.0, step=0.5)
 
 col1, col2 = st.columns(2)
-rt = col1.number_input(label='rt', min_value=0.0, step=0.01)
-offset = col2.number_input(label='offset', min_value=0.0, step=0.01)
+rt = col1.number_input(label='rt', min_value=0.0, value=0.0, step=0.01)
+offset = col2.slider(label='offset', min_value=0.0, max_value=1000.0, value=100.0, step=1.0)
 
 col1, col2 = st.columns(2)
-ook0 = col1.number_input(label='ook0', min_value=0.0, step=0.01)
-tolerance = col2.number_input(label='tolerance', min_value=0.0, step=0.01)
+ook0 = col1.number_input(label='ook0', min_value=0.0, value=1.0, step=0.01)
+tolerance = col2.slider(label='tolerance', min_value=0.0, max_value=0.5, value=0.05, step=0.005)
 
-# Add other input
+# candidates are the psm's inside the mz window alone (what an mz-ordered tree scans); hits also match rt & ook0.
+# The candidate search centres its unbounded ook0 window on 1.0: ook0 windows scale with ook0, so an infinite
+# tolerance around an ook0 of 0 would give NaN bounds, while around 1.0 it gives (-inf, inf)
+stats = []
+hits = []
+for charge in charges:
+    start_time = time.perf_counter()
+    results = arborist.search(charge, mz, rt, ook0, ppm, offset, tolerance)
+    latency = time.perf_counter() - start_time
+    candidates = len(arborist.search(charge, mz, rt, 1.0, ppm, UNBOUNDED, UNBOUNDED))
+    stats.append({'charge': charge, 'latency (ms)': latency * 1000, 'candidates': candidates, 'hits': len(results),
+                  'hit ratio': len(results) / candidates if candidates else 0.0})
+    hits.extend(results)
 
-if st.button("Run"):
-    for file in arborist_save_files:
-        print(file.name)
-        # load into PSM tree
+st.subheader('Search')
+st.dataframe(stats)
 
+history = st.session_state.setdefault('latencies', [])
+history.append(sum(stat['latency (ms)'] for stat in stats))
+del history[:-200]
+st.line_chart({'search latency (ms)': history})
 
+st.subheader(f'Results ({len(hits)})')
+st.dataframe([{'charge': psm.charge, 'mz': psm.mz, 'rt': psm.rt, 'ook0': psm.ook0, **psm.data}
+              for psm in hits[:MAX_ROWS]])
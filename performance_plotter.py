@@ -4,9 +4,9 @@ import time
 import numpy as np
 from matplotlib import pyplot as plt
 
-from boundary import get_mz_bounds, get_rt_bounds, get_ook0_bounds
-from forest import TreeType, psm_tree_constructor
-from psm import PSM
+from arboretum.boundary import get_mz_bounds, get_rt_bounds, get_ook0_bounds
+from arboretum.forest import TreeType, psm_tree_constructor
+from arboretum.psm import PSM
 
 num_points = 10
 num_psms = 10_000
@@ -29,10 +29,11 @@ def generate_random_psm() -> PSM:
 linspace = [(i+1)*num_psms for i in range(num_points)]
 performance_dict = {}
 
-for tree_type in [TreeType.SORTED_LIST, TreeType.HASHTABLE, TreeType.HASHTABLE_LARGE, TreeType.AVL, TreeType.RB, TreeType.BINARY]:
+for tree_type in [TreeType.SORTED_LIST, TreeType.HASHTABLE, TreeType.HASHTABLE_LARGE, TreeType.AVL, TreeType.RB, TreeType.BINARY,
+                  TreeType.INTERVAL]:
     performance_dict[tree_type] = {'add_time':[], 'add_time_per_psm':[], 'search_time':[], 'search_time_per_psm':[],
                                    'remove_time':[], 'remove_time_per_psm':[], 'save_time':[], 'save_time_per_psm':[],
-                                   'load_time':[], 'load_time_per_psm':[]}
+                                   'load_time':[], 'load_time_per_psm':[], 'bytes_per_psm':[]}
     tree = psm_tree_constructor(tree_type)
     for i in range(num_points):
 
@@ -49,6 +50,7 @@ for tree_type in [TreeType.SORTED_LIST, TreeType.HASHTABLE, TreeType.HASHTABLE_L
 
         performance_dict[tree_type]['add_time'].append(add_time)
         performance_dict[tree_type]['add_time_per_psm'].append(add_time_per_psm)
+        performance_dict[tree_type]['bytes_per_psm'].append(tree.memory_usage().per_psm)
 
         search_start_time = time.time()
         for psm in psms[:n]:
@@ -98,7 +100,7 @@ ook0_list = [psm.ook0 for psm in psms]
 plt.scatter(mz_list,ook0_list)
 plt.show()
 
-f, (ax1, ax2, ax3, ax4, ax5) = plt.subplots(5, 1)
+f, (ax1, ax2, ax3, ax4, ax5, ax6) = plt.subplots(6, 1)
 f.tight_layout()
 
 for tree_type in performance_dict:
@@ -122,6 +124,10 @@ for tree_type in performance_dict:
     ax5.plot(linspace, performance_dict[tree_type]['load_time'], label=tree_type)
 ax5.title.set_text('Load Time')
 
+for tree_type in performance_dict:
+    ax6.plot(linspace, performance_dict[tree_type]['bytes_per_psm'], label=tree_type)
+ax6.title.set_text('Memory per PSM (bytes)')
+
 plt.legend()
 plt.show()
 
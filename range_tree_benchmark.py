@@ -0,0 +1,46 @@
+import time
+
+from arboretum.boundary import get_mz_bounds, get_rt_bounds, get_ook0_bounds
+from arboretum.forest import TreeType, psm_tree_constructor
+from benchmark_psms import generate_random_psm
+
+"""
+Long gradient, dense mz region, narrow rt window: compares how many candidates each search examines (and the search
+time) for the (mz, rt) RANGE tree against the mz-only SORTED_LIST.
+SORTED_LIST examines every psm in the mz window; RANGE examines those inside the rt window of the buckets
+overlapping the mz window.
+"""
+
+num_psms = 200_000
+num_queries = 2_000
+PPM = 50
+OOK0_TOL = 0.05
+GRADIENT = 7_200  # seconds
+
+psms = [generate_random_psm(mz_mean=800, mz_sd=50, gradient=GRADIENT) for _ in range(num_psms)]
+queries = [generate_random_psm(mz_mean=800, mz_sd=50, gradient=GRADIENT) for _ in range(num_queries)]
+
+sorted_list = psm_tree_constructor(TreeType.SORTED_LIST)
+sorted_list.update(sorted_list.order_psms(list(psms)))
+range_tree = psm_tree_constructor(TreeType.RANGE)
+range_tree.update(list(psms))
+
+print(f"N: {num_psms:,}, ppm: {PPM}")
+for rt_offset in [5, 30, 120, 600]:
+    bounds = [(get_mz_bounds(psm.mz, PPM), get_rt_bounds(psm.rt, rt_offset), get_ook0_bounds(psm.ook0, OOK0_TOL))
+              for psm in queries]
+
+    sorted_list_candidates = sum(len(sorted_list.tree[key]) for mz_bounds, _, _ in bounds
+                                 for key in sorted_list.tree.irange(mz_bounds.lower, mz_bounds.upper))
+    range_candidates = sum(range_tree.candidates(mz_bounds, rt_bounds) for mz_bounds, rt_bounds, _ in bounds)
+
+    times = {}
+    for tree_type, tree in [(TreeType.SORTED_LIST, sorted_list), (TreeType.RANGE, range_tree)]:
+        start_time = time.time()
+        hits = sum(len(tree._search(*query_bounds)) for query_bounds in bounds)
+        times[tree_type] = (time.time() - start_time) / num_queries
+
+    print(f"rt_offset: {rt_offset:>4}  hits/query: {hits / num_queries:7.2f}  "
+          f"candidates/query SORTED_LIST: {sorted_list_candidates / num_queries:8.1f}  RANGE: {range_candidates / num_queries:7.1f}  "
+          f"({sorted_list_candidates / max(range_candidates, 1):5.1f}x fewer)  "
+          f"search us/query SORTED_LIST: {times[TreeType.SORTED_LIST] * 1e6:7.1f}  RANGE: {times[TreeType.RANGE] * 1e6:7.1f}")
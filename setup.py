@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name='arboretum',
     version='0.0.1',
-    packages=['arboretum'],
+    packages=['arboretum', 'arboretum.forest'],
     url='https://github.com/JLane-scripps/Arboretum.git',
     license='',
     author='Jeff Lane, Patrick Garrett',
@@ -12,7 +12,12 @@ setup(
     install_requires = [
         'numpy~=1.23.1',
         'intervaltree~=3.1.0',
+        'sortedcontainers~=2.4.0',
         'ranged-bintrees @ git+https://github.com/pgarrett-scripps/ranged_bintrees.git',
         'ranged-kdtree @ git+https://github.com/pgarrett-scripps/ranged_kdtree.git'
-    ]
+    ],
+    extras_require={
+        'kernel': ['numba'],  # compiles the in-bound filter of kernel.py (numpy is used without it)
+        'arrow': ['pyarrow'],  # arrow.py: Arrow tables & parquet files
+    }
 )
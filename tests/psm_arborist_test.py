@@ -0,0 +1,774 @@
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import pyarrow
+except ImportError:  # optional: the arrow tests are skipped without it
+    pyarrow = None
+
+from arboretum.arborist import PSMArborist
+from arboretum.blockfile import BlockFile
+from arboretum.coalesce import Coalescing
+from arboretum.boundary import Boundary, get_mz_bounds, get_ook0_bounds, get_rt_bounds
+from arboretum.forest import TreeType, psm_tree_class
+from arboretum.forest.psmtree import PsmTree
+from arboretum.ingest import batch_psms, read_psms
+from arboretum.neutralmass import NeutralMassIndex, mz_of, neutral_mass
+from arboretum.occupancy import OccupancyGrid, Prefilter
+from arboretum.psm import PSM
+from arboretum.replay import OPERATIONS, Recorder, read_trace, replay
+from arboretum.replication import FileDrop, Replica, ReplicationLog, ReplicationServer, changes
+from arboretum.shared import SharedArboristReader, SharedArboristWriter
+from arboretum.tracing import JsonlSink, ProfileSink, RingBufferSink, SamplingSink, Tracer
+
+
+class PsmArboristTester(unittest.TestCase):
+
+    def setUp(self):
+        self.arborist = PSMArborist(TreeType.SORTED_LIST)
+        self.directory = tempfile.mkdtemp()
+        for i in range(100):
+            self.arborist.add(2, 500.0 + i, 100.0 + i, 1.0, {'sequence': 'PEPTIDE'})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_isolated_from_add(self):
+        snapshot = self.arborist.snapshot()
+        self.arborist.add(2, 505.0, 105.0, 1.0, {'sequence': 'NEW'})
+        self.arborist.add(3, 505.0, 105.0, 1.0, {'sequence': 'NEW'})
+        self.assertEqual(100, len(snapshot))
+        self.assertEqual(102, len(self.arborist))
+        self.assertEqual(1, len(snapshot.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))
+        self.assertEqual(2, len(self.arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))
+
+    def test_snapshot_isolated_from_remove(self):
+        snapshot = self.arborist.snapshot()
+        self.arborist.remove(2, 505.0, 105.0, 1.0, {'sequence': 'PEPTIDE'})
+        self.assertEqual(1, len(snapshot.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))
+        self.assertEqual(0, len(self.arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))
+
+    def test_snapshot_copied_outside_lock(self):
+        snapshot = self.arborist.snapshot()
+        tree = self.arborist.trees[2]
+        locked = []
+        copy = tree.copy
+        tree.copy = lambda: locked.append(self.arborist._lock.locked()) or copy()
+        self.arborist.add(2, 505.0, 105.0, 1.0, {'sequence': 'NEW'})
+        self.assertEqual([False], locked)  # copied once, without holding up searches & other writers
+        self.assertIsNot(tree, self.arborist.trees[2])
+        self.assertEqual(100, len(snapshot))
+        self.arborist.add(2, 506.0, 105.0, 1.0, {'sequence': 'NEW'})
+        self.assertEqual([False], locked)
+        self.assertEqual(102, len(self.arborist))
+
+    def test_snapshot_version(self):
+        snapshot = self.arborist.snapshot()
+        self.assertEqual(self.arborist.version, snapshot.version)
+        self.arborist.add(2, 505.0, 105.0, 1.0, {'sequence': 'NEW'})
+        self.assertEqual(snapshot.version + 1, self.arborist.version)
+
+    def test_search_array(self):
+        self.arborist.add(3, 505.0, 105.0, 1.0, {'sequence': 'CHARGE3'})
+        results = self.arborist.search_array([2, 3, 4, 2], [505.0, 505.0, 505.0, 900.0], [105.0] * 4, [1.0] * 4,
+                                             10, 1, 0.05)
+        self.assertEqual([1, 1, 0, 0], [len(psms) for psms in results])
+        self.assertEqual({'sequence': 'CHARGE3'}, results[1][0].data)
+        self.assertEqual(results[0], self.arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05))
+
+    def test_coalescing(self):
+        self.arborist.coalescing = Coalescing()
+        snapshot = self.arborist.snapshot()
+        self.arborist.add(2, 505.0, 105.5, 1.0, {'sequence': 'PEPTIDE'})
+        self.arborist.update([PSM(2, 505.0, 104.5, 1.0, {'sequence': 'PEPTIDE'}),
+                              PSM(2, 505.0, 105.0, 1.0, {'sequence': 'OTHER'}),
+                              PSM(2, 505.0, 105.0, 1.0, {'sequence': 'OTHER'})])
+        self.assertEqual(101, len(self.arborist))
+        results = self.arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)
+        self.assertEqual([{'sequence': 'PEPTIDE', 'count': 3, 'last_rt': 104.5},
+                          {'sequence': 'OTHER', 'count': 2, 'last_rt': 105.0}], [psm.data for psm in results])
+        results = snapshot.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)
+        self.assertEqual([{'sequence': 'PEPTIDE'}], [psm.data for psm in results])
+
+    def test_buffered_reads_during_adds(self):
+        arborist = PSMArborist(TreeType.BUFFERED_SORTED_LIST)
+        errors, done = [], threading.Event()
+
+        def read():
+            try:
+                while not done.is_set():
+                    arborist.search_array(2, [500.0, 1000.0], [100.0, 200.0], [1.0, 1.0], 10, 1, 0.1)
+                    arborist.search(2, 1000.0, 200.0, 1.0, 10, 1, 0.1)
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads often, to interleave reads with merges
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        try:
+            for reader in readers:
+                reader.start()
+            for i in range(50_000):
+                arborist.add(2, 500.0 + (i * 7919) % 1000, 100.0 + i % 200, 1.0, {})
+        finally:
+            done.set()
+            for reader in readers:
+                reader.join()
+            sys.setswitchinterval(interval)
+        self.assertEqual([], errors)
+        self.assertEqual(50_000, len(arborist))  # no psm merged twice or lost
+        self.assertEqual(50_000, len(arborist.search(2, 1000.0, 200.0, 1.0, 1e6, 1e6, 1)))
+        self.assertEqual(50_000, sum(map(len, arborist.search_array(2, [1000.0], [200.0], [1.0], 1e6, 1e6, 1))))
+
+    def test_prefilter_during_adds(self):
+        arborist = PSMArborist(TreeType.SORTED_LIST, prefilter=Prefilter(mz_cell=0.01, rt_cell=1.0))
+        arborist.add(2, 500.0, 100.0, 1.0, {})
+        errors, searches = [], 500
+
+        def read():
+            try:
+                for _ in range(searches):
+                    arborist.search(2, 1000.0, 5000.0, 1.0, 1e6, 1, 1)  # every mz cell checked, no rt cell hit
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        try:
+            for reader in readers:
+                reader.start()
+            for i in range(5000):
+                arborist.add(2, 500.0 + (i * 7919) % 1000 + i / 1e4, 100.0 + i % 900, 1.0, {})
+        finally:
+            for reader in readers:
+                reader.join()
+            sys.setswitchinterval(interval)
+        self.assertEqual([], errors)
+        self.assertEqual(2 * searches, arborist.prefilter.stats()['queries'])
+
+    def test_import_without_numpy(self):
+        code = 'import sys, arboretum.arborist; sys.exit("numpy" in sys.modules)'
+        self.assertEqual(0, subprocess.run([sys.executable, '-c', code]).returncode)  # numpy is imported on use
+
+    def test_recalibrate(self):
+        self.arborist.prefilter = Prefilter()
+        self.arborist.add(3, 505.0, 105.0, 1.0, {'sequence': 'OTHER'})
+        self.assertTrue(self.arborist.exists(2, 505.0, 105.0, 1.0, 1, 1, 0.05))
+        snapshot = self.arborist.snapshot()
+        self.assertEqual(101, self.arborist.recalibrate(lambda mzs, rts: 20.0 + rts / 100))  # 21.05 ppm at rt 105
+        self.assertFalse(self.arborist.exists(2, 505.0, 105.0, 1.0, 1, 1, 0.05))
+        results = self.arborist.search(2, 505.0 * (1 + 21.05e-6), 105.0, 1.0, 1, 1, 0.05)
+        self.assertEqual([{'sequence': 'PEPTIDE'}], [psm.data for psm in results])
+        self.assertEqual(1, len(self.arborist.search(3, 505.0 * (1 + 21.05e-6), 105.0, 1.0, 1, 1, 0.05)))
+        self.assertEqual(1, len(snapshot.search(2, 505.0, 105.0, 1.0, 1, 1, 0.05)))
+        with self.assertRaises(ValueError):
+            self.arborist.recalibrate([])
+
+    def test_search_mass(self):
+        mass = neutral_mass(505.0, 2)
+        self.arborist.add(3, mz_of(mass, 3), 105.5, 1.0, {'sequence': 'PEPTIDE', 'charge': 3})
+        self.arborist.add(1, mz_of(mass, 1), 105.0, 1.0, {'sequence': 'PEPTIDE', 'charge': 1})
+        self.arborist.add(4, mz_of(mass, 4), 150.0, 1.0, {})  # outside the rt window
+        expected = [{'sequence': 'PEPTIDE'}, {'sequence': 'PEPTIDE', 'charge': 3}, {'sequence': 'PEPTIDE', 'charge': 1}]
+        results = self.arborist.search_mass(mass, 105.0, 1.0, 10, 1, 0.05)
+        self.assertEqual(sorted(map(repr, expected)), sorted(repr(psm.data) for psm in results))
+
+        self.arborist.neutral_mass_index = NeutralMassIndex()
+        indexed = self.arborist.search_mass(mass, 105.0, 1.0, 10, 1, 0.05)
+        self.assertEqual(sorted(map(repr, results)), sorted(map(repr, indexed)))
+        self.assertEqual(103, len(self.arborist.neutral_mass_index))
+        self.arborist.remove(1, mz_of(mass, 1), 105.0, 1.0, {'sequence': 'PEPTIDE', 'charge': 1})
+        self.arborist.add(2, mz_of(mass + 0.001, 2), 105.0, 1.0, {'sequence': 'NEW'})
+        self.assertEqual(3, len(self.arborist.search_mass(mass, 105.0, 1.0, 10, 1, 0.05)))
+        self.arborist.retain(lambda psm: psm.charge != 3)
+        self.assertFalse(self.arborist.neutral_mass_index.built)
+        self.assertEqual(2, len(self.arborist.search_mass(mass, 105.0, 1.0, 10, 1, 0.05)))
+
+    def test_search_mass_coalesced(self):
+        self.arborist.coalescing = Coalescing()
+        self.arborist.neutral_mass_index = NeutralMassIndex()
+        mass = neutral_mass(505.0, 2)
+        self.assertEqual(1, len(self.arborist.search_mass(mass, 105.0, 1.0, 10, 1, 0.05)))
+        self.arborist.add(2, 505.0, 105.5, 1.0, {'sequence': 'PEPTIDE'})
+        self.arborist.update([PSM(2, 505.0, 104.5, 1.0, {'sequence': 'PEPTIDE'}),
+                              PSM(2, 505.0, 105.0, 1.0, {'sequence': 'OTHER'}),
+                              PSM(2, 505.0, 105.0, 1.0, {'sequence': 'OTHER'})])
+        self.assertTrue(self.arborist.neutral_mass_index.built)  # entries are swapped, not rebuilt
+        self.assertEqual(101, len(self.arborist.neutral_mass_index))
+        results = self.arborist.search_mass(mass, 105.0, 1.0, 10, 1, 0.05)
+        self.assertEqual([{'sequence': 'PEPTIDE', 'count': 3, 'last_rt': 104.5},
+                          {'sequence': 'OTHER', 'count': 2, 'last_rt': 105.0}], [psm.data for psm in results])
+
+    def test_coalesced_save_load(self):
+        self.arborist.coalescing = Coalescing(aggregates={'score': max})
+        self.arborist.add(2, 505.0, 105.5, 1.0, {'sequence': 'PEPTIDE', 'score': 2.5})
+        self.arborist.add(2, 505.0, 104.5, 1.0, {'sequence': 'PEPTIDE', 'score': 1.5})
+        directory = os.path.join(self.directory, 'saved')
+        self.arborist.save(directory)
+        loaded = PSMArborist(TreeType.SORTED_LIST)
+        loaded.load(directory)
+        results = loaded.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)
+        self.assertEqual([{'sequence': 'PEPTIDE', 'count': 3, 'last_rt': 104.5, 'score': 2.5}],
+                         [psm.data for psm in results])
+        self.assertEqual(100, len(loaded))
+
+    def test_prefilter(self):
+        self.arborist.prefilter = Prefilter()
+        self.assertTrue(self.arborist.exists(2, 505.0, 105.0, 1.0, 10, 1, 0.05))
+        self.assertFalse(self.arborist.exists(2, 505.0, 1000.0, 1.0, 10, 1, 0.05))  # no cell at that rt
+        self.assertFalse(self.arborist.exists(2, 505.0, 105.0, 2.0, 10, 1, 0.05))  # an occupied cell, no psm
+        self.arborist.add(2, 505.0, 1000.0, 1.0, {})
+        self.assertTrue(self.arborist.exists(2, 505.0, 1000.0, 1.0, 10, 1, 0.05))
+        self.arborist.remove(2, 505.0, 1000.0, 1.0, {})
+        self.assertEqual([[], [], [self.arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)[0]]],
+                         self.arborist.search_array(2, [505.0] * 3, [1000.0, 4000.0, 105.0], [1.0] * 3, 10, 1, 0.05))
+        self.assertEqual({'queries': 8, 'rejected': 3, 'hit_rate': 0.375, 'false_positive_rate': 0.2,
+                          'cells': {2: 100}}, self.arborist.prefilter.stats())
+
+        self.arborist.retain(lambda psm: psm.mz != 505.0)
+        self.assertFalse(self.arborist.exists(2, 505.0, 105.0, 1.0, 10, 1, 0.05))
+        self.assertEqual(4, self.arborist.prefilter.stats()['rejected'])
+
+    def test_occupancy_grid(self):
+        grid = OccupancyGrid(mz_cell=1.0, rt_cell=10.0)
+        grid.update([PSM(2, 500.5, 15.0, 1.0, {}), PSM(2, 500.7, 15.0, 1.0, {})])
+        self.assertTrue(grid.occupied(Boundary(500.9, 501.0), Boundary(19.0, 20.0)))  # same cells as the psm's
+        self.assertFalse(grid.occupied(Boundary(501.0, 502.0), Boundary(0.0, 100.0)))
+        self.assertFalse(grid.occupied(Boundary(0.0, 1000.0), Boundary(20.0, 30.0)))
+        self.assertTrue(grid.occupied(Boundary(float('-inf'), float('inf')), Boundary(float('-inf'), float('inf'))))
+        grid.remove(PSM(2, 500.5, 15.0, 1.0, {}))
+        self.assertEqual(1, len(grid))
+        grid.remove(PSM(2, 500.7, 15.0, 1.0, {}))
+        self.assertFalse(grid.occupied(Boundary(float('-inf'), float('inf')), Boundary(float('-inf'), float('inf'))))
+
+    def test_explain(self):
+        arborist = PSMArborist(TreeType.MULTI_INDEX)
+        arborist.update(self.arborist.snapshot().trees[2].psms)
+        plan = arborist.explain(2, 550.0, 150.0, 1.0, 100_000, 1, 0.05)
+        self.assertEqual(('rt', {'mz': 100, 'rt': 3, 'ook0': 100}), (plan.dimension, plan.candidates))
+        self.assertIsNone(arborist.explain(3, 550.0, 150.0, 1.0, 100_000, 1, 0.05))
+        self.assertRaises(ValueError, self.arborist.explain, 2, 550.0, 150.0, 1.0, 100_000, 1, 0.05)
+
+    def test_remove_many(self):
+        snapshot = self.arborist.snapshot()
+        psms = self.arborist.search(2, 505.0, 105.0, 1.0, 10_000, 10, 0.05)
+        self.assertEqual(11, len(psms))
+        self.assertEqual(11, self.arborist.remove_many(psms))
+        self.assertEqual(89, len(self.arborist))
+        self.assertEqual(100, len(snapshot))
+
+    def test_retain(self):
+        self.arborist.add(3, 505.0, 105.0, 1.0, {'sequence': 'PEPTIDE'})
+        self.assertEqual(50, self.arborist.retain(lambda psm: psm.rt < 150))
+        self.assertEqual(51, len(self.arborist))
+
+    def test_load_pickle_sizes(self):
+        self.arborist.add(3, 505.0, 105.0, 1.0, {'sequence': 'PEPTIDE'})
+        self.arborist.trees[2].save(os.path.join(self.directory, '2.pkl'), as_pickle=True)
+        self.arborist.trees[3].save(os.path.join(self.directory, '3.txt'))
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        arborist.load(self.directory, lazy=True)
+        self.assertEqual({2: 100, 3: 1}, arborist.sizes)
+        self.assertEqual(1, len(arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))
+
+    def test_merge(self):
+        directories = []
+        for i in range(3):
+            arborist = PSMArborist(TreeType.SORTED_LIST)
+            for j in range(50):
+                arborist.add(2, 500.0 + j * 3 + i, 100.0, 1.0, {'run': i})
+                arborist.add(3, 500.0 + j, 100.0, 1.0, {'sequence': 'SHARED'})
+            directories.append(os.path.join(self.directory, str(i)))
+            arborist.save(directories[-1], compressed=i == 1)
+        out_directory = os.path.join(self.directory, 'merged')
+
+        self.assertEqual({2: 150, 3: 150}, PSMArborist.merge(directories, out_directory))
+        self.assertEqual({2: 150, 3: 50}, PSMArborist.merge(directories, out_directory, dedup=True, compressed=True))
+        merged = PSMArborist(TreeType.SORTED_LIST)
+        merged.load(out_directory)
+        psms = merged.trees[2].psms
+        self.assertEqual(sorted(psm.mz for psm in psms), [psm.mz for psm in psms])
+        self.assertEqual(1, len(merged.search(2, 501.0, 100.0, 1.0, 1, 1, 0.05)))
+        with self.assertRaises(ValueError):
+            PSMArborist.merge(directories, directories[0])
+
+    def test_stab_windows(self):
+        arborist = PSMArborist(TreeType.INTERVAL, tree_options={'ppm': 5, 'rt_offset': 10},
+                               coalescing=Coalescing())
+        arborist.add(2, 1000.0, 250.0, 0.9, {'sequence': 'WIDE'}, ppm=50, rt_offset=100)
+        arborist.update([PSM(2, 1000.0, 250.0, 0.9, {'sequence': 'NARROW'})])
+        arborist.update([PSM(2, 1001.0, 250.0, 0.9, {'sequence': 'TIGHT'})], ppm=1, ook0_tolerance=0.01)
+        self.assertEqual(2, len(arborist.stab(2, 1000.004, 255.0, 0.9)))
+        self.assertEqual(['WIDE'], [psm.data['sequence'] for psm in arborist.stab(2, 1000.04, 255.0, 0.9)])
+        self.assertEqual(['WIDE'], [psm.data['sequence'] for psm in arborist.stab(2, 1000.0, 300.0, 0.9)])
+        self.assertEqual([], arborist.stab(2, 1001.004, 250.0, 0.9))
+        self.assertEqual([], arborist.stab(2, 1001.0, 250.0, 0.92))
+        arborist.add(2, 1000.0, 250.5, 0.9, {'sequence': 'WIDE'})  # coalesced: the entry keeps its window
+        self.assertEqual([{'sequence': 'WIDE', 'count': 2, 'last_rt': 250.5}],
+                         [psm.data for psm in arborist.stab(2, 1000.04, 255.0, 0.9)])
+        arborist.recalibrate(lambda mzs, rts: 0.0 * rts)  # windows move with their psm's
+        self.assertEqual(['WIDE'], [psm.data['sequence'] for psm in arborist.stab(2, 1000.04, 255.0, 0.9)])
+        with self.assertRaises(ValueError):
+            self.arborist.add(2, 1000.0, 250.0, 0.9, {}, ppm=50)
+        self.assertEqual(100, len(self.arborist))
+
+    def test_merge_unsorted(self):
+        arborist = PSMArborist(TreeType.INTERVAL)
+        for i in range(100):
+            arborist.add(2, 600.0 - i, 100.0, 1.0, {})
+        directories = [os.path.join(self.directory, 'pickle'), os.path.join(self.directory, 'text')]
+        for directory in directories:
+            os.makedirs(directory)
+        arborist.trees[2].save(os.path.join(directories[0], '2.pkl'), as_pickle=True)
+        with open(os.path.join(directories[1], '2.txt'), 'w') as file:  # written before text saves kept mz order
+            file.writelines(psm.serialize() for psm in sorted(arborist.trees[2].psms, key=lambda psm: -psm.mz))
+        out_directory = os.path.join(self.directory, 'merged')
+        self.assertEqual({2: 200}, PSMArborist.merge(directories, out_directory, tree_type=TreeType.INTERVAL))
+        merged = PSMArborist(TreeType.SORTED_LIST)
+        merged.load(out_directory)
+        mzs = [psm.mz for psm in merged.trees[2].psms]
+        self.assertEqual(sorted(mzs), mzs)
+
+    def test_memory_usage(self):
+        self.arborist.add(3, 505.0, 105.0, 1.0, {'sequence': 'PEPTIDE'})
+        usage = self.arborist.memory_usage()
+        self.assertEqual([2, 3], sorted(usage))
+        self.assertEqual(100, usage[2].count)
+        self.assertGreater(usage[2].total, 100 * usage[3].psms)
+
+    def test_save_load(self):
+        directory = os.path.join(self.directory, 'arborist')
+        self.arborist.save(directory)
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        arborist.load(directory)
+        self.assertEqual(len(self.arborist), len(arborist))
+
+    def test_save_load_compressed(self):
+        directory = os.path.join(self.directory, 'arborist')
+        self.arborist.save(directory, compressed=True)
+        self.assertEqual(['2.blk'], os.listdir(directory))
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        arborist.load(directory)
+        self.assertEqual(len(self.arborist), len(arborist))
+        self.assertEqual(1, len(arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))
+
+    def test_lazy_load(self):
+        for charge in (1, 3):
+            self.arborist.add(charge, 505.0, 105.0, 1.0, {'sequence': 'PEPTIDE'})
+        directory = os.path.join(self.directory, 'arborist')
+        self.arborist.save(directory, compressed=True)
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        arborist.load(directory, lazy=True)
+        self.assertEqual([], arborist.loaded_charges)
+        self.assertEqual(1, len(arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))
+        self.assertEqual([], arborist.loaded_charges)  # compressed trees are searched in place
+        arborist.add(3, 600.0, 100.0, 1.0, {'sequence': 'NEW'})
+        self.assertEqual([3], arborist.loaded_charges)
+        self.assertEqual(103, len(arborist))
+
+    def test_lazy_load_eviction(self):
+        for charge in (1, 3):
+            self.arborist.add(charge, 505.0, 105.0, 1.0, {'sequence': 'PEPTIDE'})
+        directory = os.path.join(self.directory, 'arborist')
+        self.arborist.save(directory)
+        arborist = PSMArborist(TreeType.SORTED_LIST, max_loaded_psms=50)
+        arborist.load(directory, lazy=True)
+        arborist.add(2, 600.0, 100.0, 1.0, {'sequence': 'NEW'})
+        arborist.add(1, 600.0, 100.0, 1.0, {'sequence': 'NEW'})
+        self.assertEqual([1], arborist.loaded_charges)  # charge 2 was written back to disk
+        self.assertEqual(1, len(arborist.search(2, 600.0, 100.0, 1.0, 10, 1, 0.05)))
+        self.assertEqual(104, len(arborist))
+
+    def test_lazy_load_eviction_spills(self):
+        for charge in (1, 3):
+            self.arborist.add(charge, 505.0, 105.0, 1.0, {'sequence': 'PEPTIDE'})
+        directory = os.path.join(self.directory, 'arborist')
+        self.arborist.save(directory)
+        saved = {file: os.path.getmtime(os.path.join(directory, file)) for file in os.listdir(directory)}
+        arborist = PSMArborist(TreeType.SORTED_LIST, max_loaded_psms=50)
+        arborist.load(directory, lazy=True)
+        for charge in (2, 1, 3, 2, 1):
+            arborist.add(charge, 600.0 + charge, 100.0, 1.0, {'sequence': 'NEW'})
+            self.assertEqual(sum(len(tree) for tree in arborist.trees.values()), arborist._loaded)
+        self.assertEqual(saved, {file: os.path.getmtime(os.path.join(directory, file)) for file in os.listdir(directory)})
+        self.assertEqual(2, len(arborist.search(2, 602.0, 100.0, 1.0, 10, 1, 0.05)))
+        self.assertEqual(107, len(arborist))
+        spill = arborist._spill
+        self.assertTrue(os.path.isdir(spill))
+        del arborist
+        self.assertFalse(os.path.exists(spill))
+
+    def test_block_file_search(self):
+        file_name = os.path.join(self.directory, '2.blk')
+        self.arborist.trees[2].save(file_name, as_blocks=True)
+        block_file = BlockFile(file_name)
+        self.assertEqual(100, len(block_file))
+        results = block_file.search(get_mz_bounds(505.0, 10), get_rt_bounds(105.0, 1), get_ook0_bounds(1.0, 0.05))
+        self.assertEqual(1, len(results))
+        self.assertEqual({'sequence': 'PEPTIDE'}, results[0].data)
+
+    def test_ingest_jsonl(self):
+        records = [{'mono_mz': 700.0 + i, 'rt': 10.0 * i, 'ook0': 1.1, 'charge': 1 + i % 3, 'sequence': 'PEP'}
+                   for i in range(1000)]
+        stream = io.StringIO(''.join(json.dumps(record) + '\n' for record in records))
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        self.assertEqual(1000, arborist.ingest(stream, batch_size=64, max_pending_batches=2))
+        self.assertEqual(1000, len(arborist))
+        results = arborist.search(2, 701.0, 10.0, 1.1, 10, 1, 0.05)
+        self.assertEqual([{'sequence': 'PEP'}], [psm.data for psm in results])
+
+    def test_ingest_save_load(self):
+        records = [{'mono_mz': 700.0 + i, 'rt': 10.0 * i, 'ook0': 1.1, 'charge': 2, 'sequence': 'PEP, TIDE',
+                    'score': i / 10, 'proteins': ['P1', 'P2']} for i in range(10)]
+        stream = io.StringIO(''.join(json.dumps(record) + '\n' for record in records))
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        arborist.ingest(stream)
+        directory = os.path.join(self.directory, 'saved')
+        arborist.save(directory)
+        loaded = PSMArborist(TreeType.SORTED_LIST)
+        loaded.load(directory)
+        results = loaded.search(2, 701.0, 10.0, 1.1, 10, 1, 0.05)
+        self.assertEqual([{'sequence': 'PEP, TIDE', 'score': 0.1, 'proteins': ['P1', 'P2']}],
+                         [psm.data for psm in results])
+
+    def test_ingest_stops_reader_on_error(self):
+        class Failing(PSMArborist):
+            def update(self, psms):
+                raise RuntimeError('full')
+
+        psms = (PSM(2, 500.0 + i, 100.0, 1.0, {}) for i in range(10_000))
+        with self.assertRaises(RuntimeError):
+            Failing().ingest(psms, batch_size=10, max_pending_batches=1)
+        self.assertFalse([thread for thread in threading.enumerate() if thread.name.endswith('(reader)')])
+
+    def test_ingest_directory(self):
+        for i in range(3):
+            with open(os.path.join(self.directory, f'{i}.jsonl'), 'w') as file:
+                file.write(json.dumps({'mono_mz': 700.0 + i, 'rt': 1.0, 'ook0': 1.1, 'charge': 2}) + '\n\n')
+        self.assertEqual(3, len(list(read_psms(self.directory))))
+
+    def test_batch_psms(self):
+        self.assertEqual([3, 3, 1], [len(batch) for batch in batch_psms(range(7), 3)])
+
+
+class TracingTester(unittest.TestCase):
+
+    def setUp(self):
+        self.arborist = PSMArborist(TreeType.SORTED_LIST)
+        self.directory = tempfile.mkdtemp()
+        self.buffer = RingBufferSink()
+
+    def tearDown(self):
+        PsmTree.tracer = None
+        shutil.rmtree(self.directory)
+
+    def test_arborist_events(self):
+        self.arborist.tracer = Tracer([self.buffer])
+        self.arborist.add(2, 500.0, 100.0, 1.0, {'sequence': 'PEPTIDE'})
+        self.arborist.search(2, 500.0, 100.0, 1.0, 10, 1, 0.05)
+        with self.assertRaises(ValueError):
+            self.arborist.remove(3, 500.0, 100.0, 1.0, {})
+        events = self.buffer.events
+        self.assertEqual(['add', 'search', 'remove'], [event.operation for event in events])
+        self.assertEqual([2, 2, 3], [event.charge for event in events])
+        self.assertEqual([1, 1, None], [event.count for event in events])
+        self.assertEqual('ValueError', events[2].error)
+        self.assertTrue(all(event.duration >= 0 and event.source == 'PSMArborist' for event in events))
+
+    def test_tree_events(self):
+        PsmTree.tracer = Tracer([self.buffer])
+        self.arborist.update([PSM(2, 500.0 + i, 100.0, 1.0, {}) for i in range(10)])
+        self.arborist.retain(lambda psm: psm.mz < 505)
+        self.assertEqual([('update', 10), ('retain', 5)],
+                         [(event.operation, event.count) for event in self.buffer.events])
+        self.assertEqual('PsmSortedList', self.buffer.events[0].source)
+
+    def test_tree_wrappers(self):
+        tree_type = psm_tree_class(TreeType.SORTED_LIST)
+        self.assertFalse(hasattr(tree_type.search, 'traced'))  # without a tracer, trees run unwrapped
+        PsmTree.tracer = Tracer([self.buffer])
+        self.assertEqual('search', tree_type.search.traced)
+        PsmTree.tracer = None
+        self.assertFalse(hasattr(tree_type.search, 'traced'))
+        self.assertFalse(hasattr(PsmTree.search, 'traced'))
+
+    def test_jsonl_sink(self):
+        file_name = os.path.join(self.directory, 'trace.jsonl')
+        sink = JsonlSink(file_name)
+        self.arborist.tracer = Tracer([sink])
+        self.arborist.add(2, 500.0, 100.0, 1.0, {})
+        self.arborist.save(os.path.join(self.directory, 'arborist'))
+        sink.close()
+        with open(file_name) as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(['add', 'save'], [record['operation'] for record in records])
+
+    def test_profile_sink(self):
+        file_name = os.path.join(self.directory, 'trace.prof')
+        sink = ProfileSink(file_name, window=0.0)
+        self.arborist.tracer = Tracer([sink])
+        self.arborist.add(2, 500.0, 100.0, 1.0, {})
+        self.assertTrue(sink.done)
+        self.assertTrue(os.path.exists(file_name))
+
+    def test_profile_sink_threads(self):
+        file_name = os.path.join(self.directory, 'trace.prof')
+        sink = ProfileSink(file_name, window=0.01)
+        self.arborist.tracer = Tracer([sink])
+        self.arborist.add(2, 500.0, 100.0, 1.0, {})
+        time.sleep(0.02)
+        thread = threading.Thread(target=self.arborist.add, args=(2, 501.0, 100.0, 1.0, {}))
+        thread.start()
+        thread.join()
+        self.assertFalse(sink.done)  # only the profiled thread stops its profile
+        self.arborist.add(2, 502.0, 100.0, 1.0, {})
+        self.assertTrue(sink.done)
+        self.assertTrue(os.path.exists(file_name))
+
+    def test_sampling_sink_trigger(self):
+        file_name = os.path.join(self.directory, 'trace.txt')
+        sink = SamplingSink(file_name, window=0.05, trigger=0.0)
+        self.arborist.tracer = Tracer([sink])
+        self.arborist.add(2, 500.0, 100.0, 1.0, {})
+        sink.thread.join()
+        self.assertTrue(os.path.exists(file_name))
+
+
+class ReplayTester(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.trace = os.path.join(self.directory, 'trace.bin.gz')
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        with Recorder(self.trace) as arborist.recorder:
+            arborist.add(2, 500.0, 100.0, 1.0, {'sequence': 'PEPTIDE'})
+            arborist.update([PSM(2, 500.0 + i, 100.0 + i, 1.0, {}) for i in range(10)] + [PSM(3, 500.0, 100.0, 1.0, {})])
+            arborist.remove(2, 501.0, 101.0, 1.0, {})
+            arborist.search(2, 500.0, 100.0, 1.0, 10, 1, 0.05)
+            arborist.search_array(2, [500.0, 505.0], [100.0, 105.0], [1.0, 1.0], 10, 1, 0.05)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_trace(self):
+        records = list(read_trace(self.trace))
+        self.assertEqual(['add', 'update', 'remove', 'search', 'search_array'],
+                         [OPERATIONS[operation] for _, operation, _ in records])
+        self.assertEqual([timestamp for timestamp, _, _ in records], sorted(timestamp for timestamp, _, _ in records))
+        self.assertEqual((PSM(2, 500.0, 100.0, 1.0, {'sequence': 'PEPTIDE'}),), records[0][2])
+        self.assertEqual(11, len(records[1][2][0]))
+        self.assertEqual((2, 500.0, 100.0, 1.0, 10, 1, 0.05), records[3][2])
+        self.assertEqual(([2, 2], [500.0, 505.0], [100.0, 105.0], [1.0, 1.0], 10, 1, 0.05), records[4][2])
+
+    def test_replay(self):
+        for tree_type in (TreeType.SORTED_LIST, TreeType.MULTI_INDEX):
+            report = replay(self.trace, tree_type, speed=100.0)
+            self.assertEqual({'add': 1, 'update': 1, 'remove': 1, 'search': 1, 'search_array': 1},
+                             {operation: len(latencies) for operation, latencies in report.latencies.items()})
+            self.assertEqual(5, report.operations)
+            self.assertGreater(report.throughput, 0)
+            percentiles = report.percentiles('search', (50, 99))
+            self.assertLessEqual(percentiles[50], percentiles[99])
+
+    def test_replay_changes(self):
+        saved = os.path.join(self.directory, 'saved')
+        PSMArborist(TreeType.SORTED_LIST, trees={}).save(saved)
+        trace = os.path.join(self.directory, 'changes.bin')
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        with Recorder(trace) as arborist.recorder:
+            arborist.load(saved)
+            arborist.update([PSM(2, 500.0 + i, 100.0 + i, 1.0, {'i': i}) for i in range(20)])
+            with self.assertRaises(ValueError):
+                arborist.remove(4, 500.0, 100.0, 1.0, {})  # not recorded: it failed
+            arborist.add(4, 500.0, 100.0, 1.0, {})
+            arborist.remove_many([PSM(2, 500.0, 100.0, 1.0, {'i': 0}), PSM(2, 501.0, 101.0, 1.0, {'i': 1})])
+            arborist.retain(lambda psm: psm.data.get('i', 0) % 3)
+            arborist.recalibrate([5.0])
+            arborist.recalibrate(lambda mzs, rts: 1.0 + 0.0 * mzs)  # a marker only
+        self.assertEqual(['load', 'update', 'add', 'remove_many', 'retain', 'recalibrate', 'recalibrate'],
+                         [OPERATIONS[operation] for _, operation, _ in read_trace(trace)])
+        report = replay(trace)
+        self.assertEqual(arborist.sizes, report.sizes)
+        self.assertEqual({2: 12, 4: 0}, report.sizes)
+
+
+@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+class ArrowTester(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.arborist = PSMArborist(TreeType.BUFFERED_SORTED_LIST)
+        self.psms = [PSM(2, 500.0 + i, 100.0 + i, 1.0, {'sequence': 'PEPTIDE', 'score': i / 10}) for i in range(10)] + \
+                    [PSM(3, 600.0, 200.0, 1.1, {'mixed': 1}), PSM(3, 601.0, 201.0, 1.1, {'mixed': 'one'})]
+        self.arborist.update(self.psms)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_to_arrow(self):
+        table = self.arborist.to_arrow()
+        self.assertEqual(['charge', 'mz', 'rt', 'ook0', 'sequence', 'score', 'mixed'], table.schema.names)
+        self.assertEqual(12, table.num_rows)
+        self.assertEqual([2] * 10 + [3] * 2, table.column('charge').to_pylist())
+        self.assertEqual([None] * 10 + [1, 'one'], [None if value is None else eval(value)
+                                                    for value in table.column('mixed').to_pylist()])
+        tree = self.arborist.trees[2]
+        tree.merge()
+        table = self.arborist.to_arrow()
+        self.assertEqual(tree.mzs.ctypes.data, table.column('mz').chunk(0).buffers()[1].address)  # not copied
+
+    def test_round_trip(self):
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        self.assertEqual(12, arborist.from_arrow(self.arborist.to_arrow()))
+        self.assertEqual(sorted(self.psms, key=repr), sorted(arborist.trees[2].psms + arborist.trees[3].psms, key=repr))
+
+    def test_parquet(self):
+        file_name = os.path.join(self.directory, 'psms.parquet')
+        self.arborist.save_parquet(file_name)
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        self.assertEqual(12, arborist.ingest(file_name, batch_size=5))
+        self.assertEqual(sorted(self.psms, key=repr), sorted(arborist.trees[2].psms + arborist.trees[3].psms, key=repr))
+
+    def test_empty(self):
+        table = PSMArborist().to_arrow()
+        self.assertEqual(0, table.num_rows)
+        self.assertEqual(['charge', 'mz', 'rt', 'ook0'], table.schema.names)
+
+
+class ReplicationTester(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.primary = PSMArborist(TreeType.SORTED_LIST)
+        for i in range(10):
+            self.primary.add(2, 500.0 + i, 100.0 + i, 1.0, {'sequence': 'PEPTIDE'})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _change(self, i: int = 0):
+        self.primary.add(3, 600.0, 100.0, 1.0, {})
+        self.primary.update([PSM(2, 700.0, 100.0, 1.0, {}), PSM(4, 800.0, 100.0, 1.0, {})])
+        self.primary.remove(2, 500.0 + i, 100.0 + i, 1.0, {'sequence': 'PEPTIDE'})
+        self.primary.remove_many([PSM(2, 501.0 + i, 101.0 + i, 1.0, {'sequence': 'PEPTIDE'}),
+                                  PSM(2, 502.0 + i, 102.0 + i, 1.0, {'sequence': 'PEPTIDE'})])
+
+    def _assert_replicated(self, replica: Replica):
+        self.assertEqual(self.primary.version, replica.version)
+        self.assertEqual({charge: size for charge, size in self.primary.sizes.items() if size},
+                         {charge: size for charge, size in replica.arborist.sizes.items() if size})
+        self.assertEqual(self.primary.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05),
+                         replica.arborist.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05))
+
+    def test_server(self):
+        with ReplicationServer(self.primary) as server:
+            replica = Replica()
+            replica.connect(server.address)
+            self.assertTrue(replica.pull())  # a snapshot
+            self._assert_replicated(replica)
+            arborist = replica.arborist
+            self._change()
+            self.assertTrue(replica.pull())
+            self.assertIs(arborist, replica.arborist)  # applied as a delta
+            self._assert_replicated(replica)
+            self.assertFalse(replica.pull())
+
+            replica.close()  # catches up after reconnecting
+            self._change(3)
+            replica.connect(server.address)
+            self.assertTrue(replica.pull())
+            self.assertIs(arborist, replica.arborist)
+            self._assert_replicated(replica)
+
+            self.primary.retain(lambda psm: psm.charge == 2)  # cannot be replayed
+            self.assertTrue(replica.pull())
+            self.assertIsNot(arborist, replica.arborist)
+            self._assert_replicated(replica)
+            replica.close()
+
+    def test_trimmed_log(self):
+        self.primary.replication = ReplicationLog(max_psms=2)
+        replica = Replica()
+        replica.apply(io.BytesIO(changes(self.primary)))
+        arborist = replica.arborist
+        self.primary.add(3, 600.0, 100.0, 1.0, {})
+        self.primary.update([PSM(2, 700.0, 100.0, 1.0, {}), PSM(4, 800.0, 100.0, 1.0, {})])
+        replica.apply(io.BytesIO(changes(self.primary, replica.primary, replica.version)))
+        self.assertIsNot(arborist, replica.arborist)  # the add was dropped from the log: a snapshot
+        self._assert_replicated(replica)
+
+    def test_file_drop(self):
+        drop = FileDrop(self.primary, os.path.join(self.directory, 'drop'))
+        self.assertTrue(drop.drop().endswith('.snapshot'))
+        self._change()
+        self.assertTrue(drop.drop().endswith('.delta'))
+        self.assertIsNone(drop.drop())
+        replica = Replica()
+        self.assertEqual(2, replica.apply_directory(drop.directory))
+        self._assert_replicated(replica)
+        self._change(3)
+        drop.drop()
+        self.assertEqual(1, replica.apply_directory(drop.directory))
+        self._assert_replicated(replica)
+        drop.drop(snapshot=True)
+        self.assertEqual(1, len(os.listdir(drop.directory)))
+        self.assertEqual(0, replica.apply_directory(drop.directory))  # already at its version
+
+
+def _shared_search(name, queue):
+    with SharedArboristReader(name) as reader:
+        queue.put([psm.data for psm in reader.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)])
+
+
+class SharedArboristTester(unittest.TestCase):
+
+    def setUp(self):
+        self.writer = SharedArboristWriter(f'arboretum_test_{os.getpid()}')
+        self.writer.update([PSM(2, 500.0 + i, 100.0 + i, 1.0, {'sequence': 'PEPTIDE'}) for i in range(100)])
+        self.writer.publish()
+
+    def tearDown(self):
+        self.writer.close()
+
+    def test_search(self):
+        arborist = PSMArborist(TreeType.SORTED_LIST)
+        arborist.update([PSM(2, 500.0 + i, 100.0 + i, 1.0, {'sequence': 'PEPTIDE'}) for i in range(100)])
+        with SharedArboristReader(self.writer.name) as reader:
+            self.assertEqual(arborist.search(2, 505.0, 105.0, 1.0, 10_000, 10, 0.05),
+                             reader.search(2, 505.0, 105.0, 1.0, 10_000, 10, 0.05))
+            self.assertEqual(arborist.search_array([2, 3, 2], [505.0, 505.0, 550.0], [105.0] * 3, [1.0] * 3,
+                                                   10, 1, 0.05),
+                             reader.search_array([2, 3, 2], [505.0, 505.0, 550.0], [105.0] * 3, [1.0] * 3,
+                                                 10, 1, 0.05))
+
+    def test_publish(self):
+        with SharedArboristReader(self.writer.name) as reader:
+            self.writer.add(2, 505.0, 105.0, 1.0, {'sequence': 'NEW'})
+            self.writer.add(3, 505.0, 105.0, 1.0, {'sequence': 'NEW'})
+            self.assertEqual(1, len(reader.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)))  # not published yet
+            self.assertEqual(2, self.writer.publish())
+            self.assertEqual({2: 2, 3: 1}, reader.versions)
+            self.assertEqual({2: 101, 3: 1}, reader.sizes)
+            self.assertEqual([{'sequence': 'PEPTIDE'}, {'sequence': 'NEW'}],
+                             [psm.data for psm in reader.search(2, 505.0, 105.0, 1.0, 10, 1, 0.05)])
+
+    def test_reader_process(self):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_shared_search, args=(self.writer.name, queue))
+        process.start()
+        self.assertEqual([{'sequence': 'PEPTIDE'}], queue.get(timeout=60))
+        process.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,21 @@
+import gc
 import os
 import unittest
 import random
+import tempfile
 import time
+from enum import Enum
+from types import BuiltinFunctionType, FunctionType, MethodType, ModuleType
 
 import numpy as np
 
-from arboretum.forest import TreeType, psm_tree_constructor
-from arboretum.boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds
-from psm import PSM
+from arboretum.forest import PsmMultiIndexTree, PsmPartitionedTree, TreeType, psm_tree_constructor
+from arboretum.boundary import Boundary, get_mz_bounds, get_rt_bounds, get_ook0_bounds, get_mz_bounds_array, \
+    get_rt_bounds_array, get_ook0_bounds_array
+from arboretum import kernel
+from arboretum.calibration import mz_shift
+from arboretum.coalesce import Coalescing
+from arboretum.psm import PSM
 
 
 def generate_random_psm() -> PSM:
@@ -23,6 +31,23 @@ def generate_random_psm() -> PSM:
     )
 
 
+def mutable_objects(obj) -> dict:
+    """
+    id -> object, for every mutable object reachable from obj other than psm's (which trees share on purpose)
+    """
+    found, seen, stack = {}, set(), [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (PSM, type, ModuleType, FunctionType, BuiltinFunctionType, MethodType,
+                                               Enum, str, bytes, int, float, complex, frozenset, type(None))):
+            continue
+        seen.add(id(obj))
+        if not isinstance(obj, tuple):
+            found[id(obj)] = obj
+        stack.extend(gc.get_referents(obj))
+    return found
+
+
 def test_by_psm_tree_type(tree_type: TreeType):
     class PsmTreeTester(unittest.TestCase):
         PPM = 50
@@ -44,6 +69,17 @@ def test_by_psm_tree_type(tree_type: TreeType):
         def test_add(self):
             self.tree.add(self.psms[0])
 
+        def test_copy(self):
+            for psm in self.psms:
+                self.tree.add(psm)
+            copy = self.tree.copy()
+            original = mutable_objects(self.tree)
+            shared = [obj for key, obj in mutable_objects(copy).items() if key in original]
+            self.assertEqual([], shared)  # copy-on-write: changing either tree must leave the other as it was
+            copy.add(PSM(1, 1005.0, 250, 0.9, {'sequence': 'COPY'}))
+            self.assertEqual(len(self.psms), len(self.tree))
+            self.assertEqual(len(self.psms) + 1, len(copy))
+
         def test_add_negative(self):
             psm = PSM(-1, -1005.0, -250, -0.9, {'sequence':'PEPTIDE'})
             self.tree.add(psm)
@@ -74,6 +110,35 @@ def test_by_psm_tree_type(tree_type: TreeType):
                 self.tree.remove(psm)
                 self.assertEqual(len(self.psms) - i, len(self.tree))
 
+        def test_remove_many(self):
+            for psm in self.psms + self.psms[:2]:
+                self.tree.add(psm)
+            removed = self.tree.remove_many(self.psms[:3] + [PSM(1, 1.0, 1.0, 1.0, {})])
+            self.assertEqual(3, removed)
+            self.assertEqual(len(self.psms) - 1, len(self.tree))
+            for psm in self.psms[3:] + self.psms[:2]:
+                self.assertTrue(psm in self.tree.psms)
+
+        def test_retain(self):
+            for psm in self.psms:
+                self.tree.add(psm)
+            self.assertEqual(4, self.tree.retain(lambda psm: psm.rt != 250))
+            self.assertEqual(len(self.psms) - 4, len(self.tree))
+            psm = self.psms[1]
+            results = self.tree.search(get_mz_bounds(psm.mz, PsmTreeTester.PPM),
+                                       get_rt_bounds(psm.rt, PsmTreeTester.RT_OFF),
+                                       get_ook0_bounds(psm.ook0, PsmTreeTester.OOK0_TOL))
+            self.assertTrue(psm in results)
+
+        def test_memory_usage(self):
+            for psm in self.psms:
+                self.tree.add(psm)
+            usage = self.tree.memory_usage()
+            self.assertEqual(len(self.psms), usage.count)
+            self.assertTrue(usage.index > 0 and usage.psms > 0 and usage.payloads > 0)
+            self.tree.add(PSM(1, 1005.0, 250, 0.9, {'sequence': 'PEPTIDE' * 1000}))
+            self.assertGreater(self.tree.memory_usage().payloads, usage.payloads + 7000)
+
         def test_get(self):
             self.tree.add(self.psms[0])
             self.assertEqual(self.psms[0], self.tree.get(self.psms[0].mz, self.psms[0].rt, self.psms[0].ook0)[0])
@@ -106,6 +171,19 @@ def test_by_psm_tree_type(tree_type: TreeType):
                                            get_ook0_bounds(psm.ook0, PsmTreeTester.OOK0_TOL))
                 self.assertTrue(psm in results)
 
+        def test_search_array(self):
+            for psm in self.psms:
+                self.tree.add(psm)
+            mz_lower, mz_upper = get_mz_bounds_array([psm.mz for psm in self.psms], PsmTreeTester.PPM)
+            rt_lower, rt_upper = get_rt_bounds_array([psm.rt for psm in self.psms], PsmTreeTester.RT_OFF)
+            ook0_lower, ook0_upper = get_ook0_bounds_array([psm.ook0 for psm in self.psms], PsmTreeTester.OOK0_TOL)
+            results = self.tree.search_array(mz_lower, mz_upper, rt_lower, rt_upper, ook0_lower, ook0_upper)
+            self.assertEqual(len(self.psms), len(results))
+            for psm, psm_results in zip(self.psms, results):
+                self.assertTrue(psm in psm_results)
+                self.assertEqual(psm_results, self.tree.tsearch(psm.mz, psm.rt, psm.ook0, PsmTreeTester.PPM,
+                                                                PsmTreeTester.RT_OFF, PsmTreeTester.OOK0_TOL))
+
         def test_dup(self):
             self.tree.add(self.psms[0])
             self.tree.add(self.psms[0])
@@ -113,6 +191,40 @@ def test_by_psm_tree_type(tree_type: TreeType):
             self.tree.add(self.psms[0])
             self.assertEqual(4, len(self.tree))
 
+        def test_coalesce(self):
+            coalescing = Coalescing(aggregates={'score': max})
+            for psm in self.psms:
+                self.tree.add(psm)
+            entry, merged = self.tree.coalesce(PSM(1, 1005.00005, 250.5, 0.9, {'sequence': 'PEPTIDE', 'score': 3}),
+                                               coalescing)
+            self.assertEqual(self.psms[0], entry)
+            self.assertEqual(2, merged.data['count'])
+            self.assertTrue(self.tree.coalesce(PSM(1, 1005.0, 249.5, 0.9, {'sequence': 'PEPTIDE', 'score': 2}),
+                                               coalescing))
+            self.assertFalse(self.tree.coalesce(PSM(1, 1005.0, 250, 0.9, {'sequence': 'PEPTIDES'}), coalescing))
+            self.assertFalse(self.tree.coalesce(PSM(1, 1005.0, 252, 0.9, {'sequence': 'PEPTIDE'}), coalescing))
+            self.assertEqual(len(self.psms) + 2, len(self.tree))
+            entry = self.tree.get(1005.0, 250, 0.9)[0]
+            self.assertEqual({'sequence': 'PEPTIDE', 'count': 3, 'last_rt': 249.5, 'score': 3}, entry.data)
+            self.assertEqual({'sequence': 'PEPTIDE'}, self.psms[0].data)
+
+        def test_recalibrate(self):
+            for psm in self.psms:
+                self.tree.add(psm)
+            self.assertEqual(len(self.psms), self.tree.recalibrate(mz_shift([10.0])))  # keeps the mz order
+            self.assertEqual(len(self.psms), self.tree.recalibrate(mz_shift(
+                lambda mzs, rts: np.where(np.round(mzs) == 1150.0, -50000.0, 0.0))))  # 1150 moves below 1100
+            self.assertEqual(len(self.psms), len(self.tree))
+            for psm in self.psms:
+                mz = psm.mz * (1 + 10.0 * 1e-6)
+                mz = mz * 0.95 if psm.mz == 1150.0 else mz
+                results = self.tree.search(get_mz_bounds(mz, 0.01), get_rt_bounds(psm.rt, 0),
+                                           get_ook0_bounds(psm.ook0, 0))
+                self.assertIn(psm.data, [result.data for result in results if result.charge == psm.charge])
+                self.assertFalse(self.tree.search(get_mz_bounds(psm.mz, 1), get_rt_bounds(psm.rt, 0),
+                                                  get_ook0_bounds(psm.ook0, 0)))
+            self.assertEqual(1150.0, self.psms[2].mz)  # the psm's added are not changed
+
         def test_edges(self):
             for x in self.psms:
                 self.tree.add(x)
@@ -215,14 +327,31 @@ def test_by_psm_tree_type(tree_type: TreeType):
         def test_save_load(self):
             for psm in self.psms:
                 self.tree.add(psm)
-            start_time = time.time()
-            self.tree.save('temp.txt')
-            save_time = time.time() - start_time
-            tree2 = psm_tree_constructor(tree_type)
-
-            start_time = time.time()
-            tree2.load('temp.txt')
-            load_time = time.time() - start_time
+            with tempfile.TemporaryDirectory() as directory:
+                file_name = os.path.join(directory, 'temp.txt')
+                start_time = time.time()
+                self.tree.save(file_name)
+                save_time = time.time() - start_time
+                tree2 = psm_tree_constructor(tree_type)
+
+                start_time = time.time()
+                tree2.load(file_name)
+                load_time = time.time() - start_time
+            for psm in self.psms:
+                results = tree2.search(get_mz_bounds(psm.mz, PsmTreeTester.PPM),
+                                       get_rt_bounds(psm.rt, PsmTreeTester.RT_OFF),
+                                       get_ook0_bounds(psm.ook0, PsmTreeTester.OOK0_TOL))
+                self.assertTrue(psm in results)
+
+        def test_save_load_blocks(self):
+            for psm in self.psms:
+                self.tree.add(psm)
+            with tempfile.TemporaryDirectory() as directory:
+                file_name = os.path.join(directory, 'temp.blk')
+                self.tree.save(file_name, as_blocks=True)
+                tree2 = psm_tree_constructor(tree_type)
+                tree2.load(file_name, as_blocks=True)
+            self.assertEqual(len(self.psms), len(tree2))
             for psm in self.psms:
                 results = tree2.search(get_mz_bounds(psm.mz, PsmTreeTester.PPM),
                                        get_rt_bounds(psm.rt, PsmTreeTester.RT_OFF),
@@ -232,6 +361,8 @@ def test_by_psm_tree_type(tree_type: TreeType):
     return PsmTreeTester
 
 
+test_by_psm_tree_type.__test__ = False  # a tester factory, not a test
+
 """ ----------- Repeats each function above for each respective Tree Type -------------- """
 
 
@@ -241,9 +372,192 @@ def test_by_psm_tree_type(tree_type: TreeType):
 
 #class SLLTreeTester(test_by_psm_tree_type(TreeType.SORTED_LINKED_LIST)): pass
 
-#class IntervalTreeTester(test_by_psm_tree_type(TreeType.INTERVAL)):pass
+class IntervalTreeTester(test_by_psm_tree_type(TreeType.INTERVAL)):
+    def test_stab(self):
+        tree = psm_tree_constructor(TreeType.INTERVAL)
+        wide = PSM(1, 1000.0, 250, 0.9, {'sequence': 'WIDE'})
+        narrow = PSM(1, 1000.0, 250, 0.9, {'sequence': 'NARROW'})
+        tree.add(wide, ppm=50, rt_offset=100, ook0_tolerance=0.05)
+        tree.add(narrow, ppm=5, rt_offset=10, ook0_tolerance=0.05)
+        self.assertEqual(2, len(tree.stab(1000.004, 255, 0.9)))
+        self.assertEqual([wide], tree.stab(1000.04, 255, 0.9))
+        self.assertEqual([wide], tree.stab(1000.0, 300, 0.9))
+        self.assertEqual([], tree.stab(1000.06, 255, 0.9))
+
+    def test_recalibrate_keeps_windows(self):
+        tree = psm_tree_constructor(TreeType.INTERVAL)
+        tree.add(PSM(1, 500.0, 100.0, 1.0, {}), ppm=100, rt_offset=50, ook0_tolerance=0.5)
+        self.assertEqual(1, len(tree.stab(500.04, 140.0, 1.3)))
+        tree.recalibrate(mz_shift([0.0]))
+        self.assertEqual(1, len(tree.stab(500.04, 140.0, 1.3)))
+        tree.recalibrate(mz_shift([10.0]))  # 500.005
+        self.assertEqual(1, len(tree.stab(500.045, 140.0, 1.3)))
+        self.assertEqual([], tree.stab(500.0, 160.0, 1.0))
+
+    def test_default_window(self):
+        tree = psm_tree_constructor(TreeType.INTERVAL, ppm=5, rt_offset=10)
+        tree.add(PSM(1, 1000.0, 250, 0.9, {}))
+        self.assertEqual(1, len(tree.stab(1000.004, 255, 0.9)))
+        self.assertEqual([], tree.stab(1000.04, 255, 0.9))
+        self.assertEqual([], tree.stab(1000.0, 300, 0.9))
+
+
+class PsmSortedList(test_by_psm_tree_type(TreeType.SORTED_LIST)):
+    def test_recalibrate_in_order(self):
+        tree = psm_tree_constructor(TreeType.SORTED_LIST)
+        for i in range(10):
+            tree.add(PSM(1, 1000.0 + i, 250, 0.9, {}))
+        tree.order_psms = None  # an order-keeping correction must not sort
+        self.assertEqual(10, tree.recalibrate(mz_shift([10.0])))
+        self.assertEqual([(1000.0 + i) * (1 + 10e-6) for i in range(10)], [psm.mz for psm in tree.psms])
+        del tree.order_psms
+        self.assertEqual(10, tree.recalibrate(mz_shift(lambda mzs, rts: (3000.0 / mzs - 2) * 1e6)))  # 3000 - mz
+        self.assertEqual(sorted(psm.mz for psm in tree.psms), [psm.mz for psm in tree.psms])
+
+class RangeTreeTester(test_by_psm_tree_type(TreeType.RANGE)):
+    def test_split(self):
+        tree = psm_tree_constructor(TreeType.RANGE)
+        psms = [generate_random_psm() for i in range(2000)]
+        psms += [PSM(1, 1000.0, i, 0.9, {'sequence': 'SAME'}) for i in range(1000)]
+        for psm in psms:
+            tree.add(psm)
+        self.assertGreater(len(tree.tree), 1)
+        self.assertEqual(len(psms), len(tree))
+        for psm in psms[::10]:
+            results = tree.search(get_mz_bounds(psm.mz, 0), get_rt_bounds(psm.rt, 0), get_ook0_bounds(psm.ook0, 0))
+            self.assertTrue(psm in results)
+        for psm in psms:
+            tree.remove(psm)
+        self.assertEqual(0, len(tree))
+
+    def test_bulk_update(self):
+        tree = psm_tree_constructor(TreeType.RANGE)
+        psms = [generate_random_psm() for i in range(2000)]
+        tree.update(psms)
+        self.assertEqual(len(psms), len(tree))
+        for psm in psms[::10]:
+            results = tree.search(get_mz_bounds(psm.mz, 0), get_rt_bounds(psm.rt, 0), get_ook0_bounds(psm.ook0, 0))
+            self.assertTrue(psm in results)
+
+class PartitionedTreeTester(test_by_psm_tree_type(TreeType.PARTITIONED)):
+    def test_split_merge(self):
+        tree = psm_tree_constructor(TreeType.PARTITIONED)
+        tree.max_segment_size = 100
+        psms = [generate_random_psm() for i in range(2000)]
+        for psm in psms:
+            tree.add(psm)
+        self.assertGreater(len(tree.tree), 20)
+        self.assertTrue(all(len(segment) <= 100 for segment in tree.tree))
+        self.assertEqual(sorted(psm.mz for psm in psms), [psm.mz for psm in tree.psms])
+        for psm in psms[::10]:
+            results = tree.search(get_mz_bounds(psm.mz, 50), get_rt_bounds(psm.rt, 0), get_ook0_bounds(psm.ook0, 0))
+            self.assertTrue(psm in results)
+        tree.remove_many(psms[:1900])
+        self.assertEqual(100, len(tree))
+        self.assertLessEqual(len(tree.tree), 8)
+
+    def test_search_dispatch(self):
+        tree = psm_tree_constructor(TreeType.PARTITIONED)
+        tree.max_segment_size = 4
+        tree.update([PSM(1, float(mz), 100, 0.9, {}) for mz in range(100, 200)])
+        self.assertEqual(2, len(tree.overlapping_segments(Boundary(110.5, 112.5))))
+        self.assertEqual(11, len(tree.search(Boundary(110, 120), Boundary(0, 200), Boundary(0, 1))))
+        self.assertEqual([11, 0], [len(psms) for psms in tree.search_array([110, 300], [120, 400], [0, 0],
+                                                                           [200, 200], [0, 0], [1, 1])])
+
+    def test_fixed_segments(self):
+        tree = PsmPartitionedTree(mz_mins=[float('-inf'), 1000.0, 1100.0], max_segment_size=None)
+        tree.update(self.psms)
+        self.assertEqual(3, len(tree.tree))
+        self.assertEqual([0, 2, 6], [len(segment) for segment in tree.tree])
+
+
+class BufferedSortedListTester(test_by_psm_tree_type(TreeType.BUFFERED_SORTED_LIST)):
+    def test_merge(self):
+        tree = psm_tree_constructor(TreeType.BUFFERED_SORTED_LIST)
+        tree.max_buffer_size = 16
+        psms = [generate_random_psm() for i in range(1000)]
+        psms += [PSM(1, 1000.0, i, 0.9, {'sequence': 'SAME'}) for i in range(20)]
+        for psm in psms:
+            tree.add(psm)
+        self.assertEqual(len(psms), len(tree))
+        self.assertGreater(len(tree.buffer), 0)
+        for psm in psms[::10]:
+            results = tree.search(get_mz_bounds(psm.mz, 0), get_rt_bounds(psm.rt, 0), get_ook0_bounds(psm.ook0, 0))
+            self.assertTrue(psm in results)
+        self.assertEqual(sorted(psm.mz for psm in psms), [psm.mz for psm in tree.psms])
+        self.assertGreater(len(tree.buffer), 0)  # reads do not merge
+        self.assertEqual([psm.rt for psm in tree.psms if psm.mz == 1000.0],
+                         [psm.rt for psm in tree.search_array([1000.0], [1000.0], [0], [20], [0.9], [0.9])[0]])
+        tree.merge()
+        self.assertEqual([], tree.buffer)
+        self.assertEqual(tree.mzs.tolist(), [psm.mz for psm in tree.psms])
+        self.assertEqual(tree.rts.tolist(), [psm.rt for psm in tree.psms])
+        self.assertEqual(list(range(20)), [psm.rt for psm in tree.psms if psm.mz == 1000.0])  # insertion order
+
+    def test_buffer_grows(self):
+        tree = psm_tree_constructor(TreeType.BUFFERED_SORTED_LIST)
+        tree.rebuild([PSM(1, 500.0 + i / 100, 100.0, 0.9, {}) for i in range(40_000)])
+        for i in range(399):  # 2 * sqrt(40,000) = 400: merges copy the whole tree, so they get rarer as it grows
+            tree.add(PSM(1, 1000.0 + i, 100.0, 0.9, {}))
+        self.assertEqual(399, len(tree.buffer))
+        tree.add(PSM(1, 2000.0, 100.0, 0.9, {}))
+        self.assertEqual([], tree.buffer)
+        self.assertEqual(40_400, len(tree))
+
+
+class MultiIndexTreeTester(test_by_psm_tree_type(TreeType.MULTI_INDEX)):
+    def test_plan(self):
+        tree = psm_tree_constructor(TreeType.MULTI_INDEX)
+        tree.update([PSM(2, 1000.0 + i / 100, float(i), 1.0, {}) for i in range(1000)])
+        wide_mz, narrow_rt, ook0 = Boundary(900.0, 1100.0), Boundary(10.0, 12.0), Boundary(0.0, 2.0)
+        self.assertEqual(3, len(tree.search(wide_mz, narrow_rt, ook0)))
+        psms, plan = tree.planned_search(wide_mz, narrow_rt, ook0)
+        self.assertEqual(3, len(psms))
+        self.assertEqual('rt', plan.dimension)
+        self.assertEqual({'mz': 1000, 'rt': 3, 'ook0': 1000}, plan.candidates)
+        self.assertEqual(3, plan.hits)
+
+        narrow_mz, wide_rt = Boundary(1000.0, 1000.015), Boundary(0.0, 1000.0)
+        self.assertEqual('mz', tree.explain(narrow_mz, wide_rt, ook0).dimension)
+        tree.remove(tree.get(1000.01, 1.0, 1.0)[0])
+        psms, plan = tree.planned_search(narrow_mz, wide_rt, ook0)
+        self.assertEqual(1, len(psms))
+        self.assertEqual({'mz': 1, 'rt': 999, 'ook0': 999}, plan.candidates)
+
+    def test_secondary(self):
+        tree = PsmMultiIndexTree(secondary=('rt',))
+        self.assertEqual(['rt'], list(tree.indexes))
+        tree.add(PSM(2, 1000.0, 10.0, 1.0, {}))
+        psms, plan = tree.planned_search(Boundary(0.0, 2000.0), Boundary(9.0, 11.0), Boundary(0.0, 2.0))
+        self.assertEqual(1, len(psms))
+        self.assertEqual({'mz': 1, 'rt': 1}, plan.candidates)
+        self.assertRaises(ValueError, PsmMultiIndexTree, secondary=('mz',))
+
+
+class KernelTester(unittest.TestCase):
+    def setUp(self):
+        self.mzs = np.sort(np.random.normal(1000, 10, 1000))
+        self.rts = np.random.uniform(0, 250, 1000)
+        self.ook0s = np.random.uniform(0.8, 1.2, 1000)
+        self.bounds = (995.0, 1005.0, 50.0, 150.0, 0.9, 1.1)
+
+    def test_in_bounds(self):
+        expected = [i for i in range(100, 900) if self.bounds[0] <= self.mzs[i] <= self.bounds[1] and
+                    self.bounds[2] <= self.rts[i] <= self.bounds[3] and self.bounds[4] <= self.ook0s[i] <= self.bounds[5]]
+        for in_bounds in (kernel.in_bounds, kernel._in_bounds_numpy, kernel._in_bounds_loop):
+            self.assertEqual(expected, in_bounds(self.mzs, self.rts, self.ook0s, 100, 900, *self.bounds).tolist())
+
+    def test_in_bounds_batch(self):
+        starts, ends = np.array([0, 500, 10]), np.array([1000, 500, 20])
+        bounds = [np.full(3, bound) for bound in self.bounds]
+        for in_bounds_batch in (kernel.in_bounds_batch, kernel._in_bounds_batch_numpy, kernel._in_bounds_batch_loop):
+            indexes, offsets = in_bounds_batch(self.mzs, self.rts, self.ook0s, starts, ends, *bounds)
+            for q in range(3):
+                self.assertEqual(kernel.in_bounds(self.mzs, self.rts, self.ook0s, starts[q], ends[q],
+                                                  *self.bounds).tolist(),
+                                 indexes[offsets[q]:offsets[q + 1]].tolist())
 
-class PsmSortedList(test_by_psm_tree_type(TreeType.SORTED_LIST)):pass
 
 class PsmHashtable(test_by_psm_tree_type(TreeType.HASHTABLE)):pass
 
@@ -0,0 +1,33 @@
+import sys
+
+from arboretum.forest import TreeType
+from arboretum.replay import replay
+
+"""
+Replays a trace recorded with replay.Recorder (arborist.recorder = Recorder(file)) against each tree type given,
+and prints its throughput and per operation latency percentiles.
+usage: python trace_replay.py TRACE [TREE_TYPE ...] [--speed X]
+    TREE_TYPE : names as in psm_tree_constructor (sorted_list, multi_index, ...), default sorted_list
+    --speed X : start operations at X times the recorded pace (default: one after the other, flat out)
+"""
+
+args = sys.argv[1:]
+speed = None
+if '--speed' in args:
+    i = args.index('--speed')
+    speed = float(args[i + 1])
+    del args[i:i + 2]
+if not args:
+    sys.exit('usage: python trace_replay.py TRACE [TREE_TYPE ...] [--speed X]')
+trace, tree_types = args[0], args[1:] or [TreeType.SORTED_LIST.name.lower()]
+
+PERCENTS = (50, 90, 99, 99.9)
+print(f"{'tree type':<22}{'operation':<14}{'calls':>9}" + ''.join(f"{f'p{p} (us)':>13}" for p in PERCENTS))
+for tree_type in tree_types:
+    report = replay(trace, tree_type, speed=speed)
+    for operation, latencies in report.latencies.items():
+        percentiles = report.percentiles(operation, PERCENTS)
+        print(f"{tree_type:<22}{operation:<14}{len(latencies):>9}" +
+              ''.join(f"{percentiles[p] * 1e6:>13.1f}" for p in PERCENTS))
+    print(f"{tree_type:<22}{report.operations:,} operations, {report.throughput:,.0f} / s in the arborist, "
+          f"{report.duration:.1f} s replay" + (f", {report.lag * 1000:.1f} ms max lag" if speed else ''))